@@ -1,3 +1,13 @@
 from .arguments import *
+from .cache import *
+from .client import *
+from .codec import *
+from .compression import *
 from .exceptions import *
+from .metrics import *
+from .pool import *
 from .protocol import *
+from .recording import *
+from .scheduling import *
+from .server import *
+from .streams import *
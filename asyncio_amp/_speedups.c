@@ -0,0 +1,300 @@
+/*
+ * C implementations of `encode_box` and `scan_boxes` from asyncio_amp.codec.
+ *
+ * These are optional. When this extension can't be compiled, the pure Python
+ * versions in codec.py are used. Both implementations should produce exactly
+ * the same results; see the conformance tests in tests.py.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#define MAX_KEY_LENGTH 0xff
+#define MAX_VALUE_LENGTH 0xffff
+
+static PyObject *TooLongError = NULL;
+
+
+/* Return the ASCII encoding of a key as a new bytes object. */
+static PyObject *
+encode_key(PyObject *key)
+{
+    if (!PyUnicode_Check(key)) {
+        PyErr_Format(PyExc_TypeError, "AMP keys should be str, got %.200s",
+                     Py_TYPE(key)->tp_name);
+        return NULL;
+    }
+    return PyUnicode_AsASCIIString(key);
+}
+
+
+static void
+write_length(char **out, Py_ssize_t length)
+{
+    (*out)[0] = (char)((length >> 8) & 0xff);
+    (*out)[1] = (char)(length & 0xff);
+    *out += 2;
+}
+
+
+/*
+ * Encode a list of (key, value) tuples. Keys are encoded first, so that we
+ * know the total size before allocating the result.
+ */
+static PyObject *
+encode_items(PyObject *items)
+{
+    Py_ssize_t count = PyList_GET_SIZE(items);
+    Py_ssize_t total = 2;
+    Py_ssize_t i;
+    PyObject **keys;
+    Py_buffer *values;
+    Py_ssize_t acquired = 0;
+    PyObject *result = NULL;
+    char *out;
+
+    keys = PyMem_Malloc(sizeof(PyObject *) * (count ? count : 1));
+    values = PyMem_Malloc(sizeof(Py_buffer) * (count ? count : 1));
+    if (keys == NULL || values == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    for (i = 0; i < count; i++) {
+        PyObject *item = PyList_GET_ITEM(items, i);
+
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+            PyErr_SetString(PyExc_TypeError, "items() should return pairs");
+            goto done;
+        }
+
+        keys[i] = encode_key(PyTuple_GET_ITEM(item, 0));
+        if (keys[i] == NULL)
+            goto done;
+
+        if (PyObject_GetBuffer(PyTuple_GET_ITEM(item, 1), &values[i], PyBUF_SIMPLE) < 0) {
+            Py_DECREF(keys[i]);
+            goto done;
+        }
+        acquired++;
+
+        if (PyBytes_GET_SIZE(keys[i]) > MAX_KEY_LENGTH ||
+                values[i].len > MAX_VALUE_LENGTH) {
+            PyErr_SetNone(TooLongError);
+            goto done;
+        }
+        total += 4 + PyBytes_GET_SIZE(keys[i]) + values[i].len;
+    }
+
+    result = PyBytes_FromStringAndSize(NULL, total);
+    if (result == NULL)
+        goto done;
+    out = PyBytes_AS_STRING(result);
+
+    for (i = 0; i < count; i++) {
+        Py_ssize_t key_length = PyBytes_GET_SIZE(keys[i]);
+
+        write_length(&out, key_length);
+        memcpy(out, PyBytes_AS_STRING(keys[i]), key_length);
+        out += key_length;
+
+        write_length(&out, values[i].len);
+        memcpy(out, values[i].buf, values[i].len);
+        out += values[i].len;
+    }
+    out[0] = out[1] = 0;
+
+done:
+    for (i = 0; i < acquired; i++) {
+        Py_DECREF(keys[i]);
+        PyBuffer_Release(&values[i]);
+    }
+    PyMem_Free(keys);
+    PyMem_Free(values);
+    return result;
+}
+
+
+PyDoc_STRVAR(encode_box_doc,
+"encode_box(packet)\n\
+\n\
+Encode dict to network bytes.");
+
+static PyObject *
+encode_box(PyObject *self, PyObject *packet)
+{
+    PyObject *items;
+    PyObject *result;
+
+    items = PyMapping_Items(packet);
+    if (items == NULL)
+        return NULL;
+
+    if (!PyList_Check(items)) {
+        PyObject *list = PySequence_List(items);
+        Py_DECREF(items);
+        if (list == NULL)
+            return NULL;
+        items = list;
+    }
+
+    result = encode_items(items);
+    Py_DECREF(items);
+    return result;
+}
+
+
+PyDoc_STRVAR(scan_boxes_doc,
+"scan_boxes(buf, pos, packet, key, min_view_size=-1)\n\
+\n\
+Walk `buf` once, starting at offset `pos`, and collect every box that is\n\
+completed in there. Returns a tuple (packets, pos, packet, key). Values of\n\
+at least `min_view_size` bytes are memoryview slices of `buf`.");
+
+static PyObject *
+scan_boxes(PyObject *self, PyObject *args)
+{
+    PyObject *buf_obj;
+    Py_ssize_t pos;
+    PyObject *packet;
+    PyObject *key;
+    Py_ssize_t min_view_size = -1;
+    Py_buffer view;
+    const unsigned char *buf;
+    Py_ssize_t end;
+    PyObject *packets = NULL;
+    PyObject *memory = NULL; /* memoryview of buf, for the slices. */
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "OnOO|n:scan_boxes", &buf_obj, &pos, &packet, &key, &min_view_size))
+        return NULL;
+
+    if (PyObject_GetBuffer(buf_obj, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+
+    buf = (const unsigned char *)view.buf;
+    end = view.len;
+
+    if (pos < 0 || pos > end) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "pos out of range");
+        return NULL;
+    }
+
+    packets = PyList_New(0);
+    if (packets == NULL)
+        goto done;
+
+    Py_INCREF(packet);
+    Py_INCREF(key);
+
+    while (pos + 2 <= end) {
+        Py_ssize_t length = (buf[pos] << 8) | buf[pos + 1];
+
+        if (key == Py_None) {
+            /* NULL (two NULL bytes) means the end of a packet. */
+            if (length == 0) {
+                int error = PyList_Append(packets, packet);
+                Py_DECREF(packet);
+                packet = PyDict_New();
+                if (error < 0 || packet == NULL)
+                    goto fail;
+                pos += 2;
+                continue;
+            }
+
+            if (pos + 2 + length > end)
+                break;
+
+            Py_DECREF(key);
+            key = PyUnicode_DecodeASCII((const char *)buf + pos + 2, length, NULL);
+            if (key == NULL)
+                goto fail;
+        }
+        else {
+            PyObject *value;
+            int error;
+
+            if (pos + 2 + length > end)
+                break;
+
+            if (min_view_size >= 0 && length >= min_view_size) {
+                PyObject *start, *stop, *slice;
+
+                if (memory == NULL) {
+                    memory = PyMemoryView_FromObject(buf_obj);
+                    if (memory == NULL)
+                        goto fail;
+                }
+                start = PyLong_FromSsize_t(pos + 2);
+                stop = PyLong_FromSsize_t(pos + 2 + length);
+                slice = (start && stop) ? PySlice_New(start, stop, NULL) : NULL;
+                Py_XDECREF(start);
+                Py_XDECREF(stop);
+                if (slice == NULL)
+                    goto fail;
+                value = PyObject_GetItem(memory, slice);
+                Py_DECREF(slice);
+            }
+            else
+                value = PyBytes_FromStringAndSize((const char *)buf + pos + 2, length);
+            if (value == NULL)
+                goto fail;
+            error = PyObject_SetItem(packet, key, value);
+            Py_DECREF(value);
+            if (error < 0)
+                goto fail;
+
+            Py_DECREF(key);
+            Py_INCREF(Py_None);
+            key = Py_None;
+        }
+
+        pos += 2 + length;
+    }
+
+    result = Py_BuildValue("(OnNN)", packets, pos, packet, key);
+    goto done;
+
+fail:
+    Py_XDECREF(packet);
+    Py_XDECREF(key);
+
+done:
+    Py_XDECREF(packets);
+    Py_XDECREF(memory);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+
+static PyMethodDef speedups_methods[] = {
+    {"encode_box", (PyCFunction)encode_box, METH_O, encode_box_doc},
+    {"scan_boxes", (PyCFunction)scan_boxes, METH_VARARGS, scan_boxes_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    "asyncio_amp._speedups",
+    "C implementations of the AMP box codec.",
+    -1,
+    speedups_methods
+};
+
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    PyObject *exceptions;
+
+    exceptions = PyImport_ImportModule("asyncio_amp.exceptions");
+    if (exceptions == NULL)
+        return NULL;
+    TooLongError = PyObject_GetAttrString(exceptions, "TooLongError");
+    Py_DECREF(exceptions);
+    if (TooLongError == NULL)
+        return NULL;
+
+    return PyModule_Create(&speedups_module);
+}
@@ -1,4 +1,13 @@
-__all__ = ('Argument', 'Integer', 'Bytes', 'Float', 'Boolean', 'String', )
+import array
+import itertools
+import sys
+from struct import Struct
+
+from .codec import encode_key, encode_value, scan_boxes, _unpack_length
+
+__all__ = ('Argument', 'Integer', 'Bytes', 'Float', 'Boolean', 'String',
+           'Int32', 'Int64', 'Double', 'ListOf', 'AmpList', 'PackedArray',
+           'BigBytes', 'BigString', 'SharedBytes', 'Stream', )
 
 
 # Parts of the following code are ported from the Twisted source:
@@ -22,6 +31,18 @@ class Argument:
         """ Convert a Python object into bytes for passing over the network.  """
         raise NotImplementedError
 
+    def to_box(self, name, obj, protocol):
+        """
+        Return the (key, bytes) pairs that represent this argument in a box.
+        Most arguments use only one key, `name`. Override this (together with
+        `from_box`) for arguments that need more keys, or the protocol.
+        """
+        return [(name, self.encode(obj))]
+
+    def from_box(self, name, packet, protocol):
+        """ Read this argument from a received box. """
+        return self.decode(packet[name])
+
 
 class Integer(Argument):
     """ Encode any integer values of any size on the wire. """
@@ -81,4 +102,227 @@ class String(Argument):
         return obj.encode(self.encoding)
 
     def decode(self, data):
-        return data.decode(self.encoding)
+        try:
+            return data.decode(self.encoding)
+        except AttributeError:
+            # A memoryview, from `ZeroCopyBoxParser`.
+            return str(data, self.encoding)
+
+
+_int32 = Struct('!i')
+_int64 = Struct('!q')
+_double = Struct('!d')
+
+
+class Int32(Argument):
+    """ A signed 32 bit integer, as 4 bytes (big-endian) on the wire. """
+    type = int
+    encode = _int32.pack
+
+    def decode(self, data):
+        return _int32.unpack(data)[0]
+
+
+class Int64(Argument):
+    """ A signed 64 bit integer, as 8 bytes (big-endian) on the wire. """
+    type = int
+    encode = _int64.pack
+
+    def decode(self, data):
+        return _int64.unpack(data)[0]
+
+
+class Double(Argument):
+    """ A floating-point value, as 8 bytes (IEEE 754, big-endian) on the wire. """
+    type = float
+    encode = _double.pack
+
+    def decode(self, data):
+        return _double.unpack(data)[0]
+
+
+class ListOf(Argument):
+    """
+    A list of values of the given Argument type. Every element is prefixed by
+    its length, like a value in a box. (This is compatible with `ListOf` in
+    Twisted.) For long lists of numbers, `PackedArray` is more compact.
+    """
+    type = list
+
+    def __init__(self, element_type, optional=False):
+        super().__init__(optional)
+        self.element_type = element_type
+
+    def encode(self, obj):
+        encode = self.element_type.encode
+        return b''.join([encode_value(encode(item)) for item in obj])
+
+    def decode(self, data):
+        decode = self.element_type.decode
+        result = []
+        pos = 0
+
+        # (The elements are decoded from bytes, not from memoryviews.)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        while pos < len(data):
+            length = _unpack_length(data, pos)[0]
+            result.append(decode(data[pos + 2:pos + 2 + length]))
+            pos += 2 + length
+        return result
+
+
+class AmpList(Argument):
+    """
+    A list of dicts, each encoded as a nested box with the given (name,
+    Argument) pairs. (This is compatible with `AmpList` in Twisted.)
+    """
+    type = list
+
+    def __init__(self, arguments, optional=False):
+        super().__init__(optional)
+        self.arguments = [(name, encode_key(name), argument) for name, argument in arguments]
+
+    def encode(self, obj):
+        data_buffer = []
+        write = data_buffer.append
+
+        for values in obj:
+            for name, key, argument in self.arguments:
+                if name in values:
+                    write(key)
+                    write(encode_value(argument.encode(values[name])))
+            write(b'\x00\x00')
+        return b''.join(data_buffer)
+
+    def decode(self, data):
+        packets = scan_boxes(data, 0, { }, None)[0]
+        return [{ name: argument.decode(packet[name]) for name, key, argument in self.arguments }
+                for packet in packets]
+
+
+class PackedArray(Argument):
+    """
+    An array of numbers, packed as fixed-width little-endian values. The
+    typecode is one of 'i' (32 bit integers), 'q' (64 bit integers) or 'd'
+    (doubles).
+
+    Accepts an `array.array` of the same typecode (which is not copied on
+    little-endian machines) or any sequence of numbers. Decodes to a
+    read-only memoryview of numbers, without copying. (Or to an
+    `array.array`, on big-endian machines.) Like other values, the encoded
+    array is limited to 65535 bytes.
+    """
+    type = memoryview
+    _swap = sys.byteorder != 'little'
+
+    def __init__(self, typecode, optional=False):
+        if typecode not in ('i', 'q', 'd'):
+            raise ValueError('Unsupported typecode: %r' % typecode)
+        super().__init__(optional)
+        self.typecode = typecode
+
+    def encode(self, obj):
+        if not isinstance(obj, array.array) or obj.typecode != self.typecode or self._swap:
+            obj = array.array(self.typecode, obj)
+            if self._swap:
+                obj.byteswap()
+        return memoryview(obj).cast('B')
+
+    def decode(self, data):
+        if self._swap:
+            result = array.array(self.typecode, data)
+            result.byteswap()
+            return result
+        return memoryview(data).cast(self.typecode)
+
+
+class BigBytes(Argument):
+    """
+    Like `Bytes`, but values longer than the AMP limit are split over
+    several keys: "name", "name.2", "name.3", etc... (This is compatible with
+    `BigString` in Twisted.) The whole value is still kept in memory; see
+    `Stream` for payloads that shouldn't be.
+    """
+    type = bytes
+    chunk_size = 0xffff
+
+    def encode(self, obj):
+        return obj
+
+    def decode(self, data):
+        return data
+
+    def to_box(self, name, obj, protocol):
+        data = memoryview(self.encode(obj))
+        size = self.chunk_size
+
+        fields = [(name, data[:size])]
+        for counter, pos in enumerate(range(size, len(data), size), 2):
+            fields.append(('%s.%i' % (name, counter), data[pos:pos + size]))
+        return fields
+
+    def from_box(self, name, packet, protocol):
+        chunks = [packet[name]]
+
+        for counter in itertools.count(2):
+            chunk = packet.get('%s.%i' % (name, counter))
+            if chunk is None:
+                break
+            chunks.append(chunk)
+
+        # (Don't copy a value that fits in one key.)
+        return self.decode(chunks[0] if len(chunks) == 1 else b''.join(chunks))
+
+
+class BigString(BigBytes):
+    """ Like `String`, but split over several keys when it's too long. """
+    encoding = 'utf-8'
+    type = str
+
+    def encode(self, obj):
+        return obj.encode(self.encoding)
+
+    def decode(self, data):
+        try:
+            return data.decode(self.encoding)
+        except AttributeError:
+            # A memoryview, from `ZeroCopyBoxParser`.
+            return str(data, self.encoding)
+
+
+class SharedBytes(BigBytes):
+    """
+    Like `BigBytes`, but when both protocols have agreed to use shared
+    memory, values of at least `shared_memory_threshold` bytes are written
+    to shared memory, and only a reference is sent in the box. Such values
+    decode to a read-only memoryview of the mapped memory, without copying.
+    """
+    def to_box(self, name, obj, protocol):
+        segments = protocol._shared_memory if protocol is not None else None
+
+        if segments is not None and len(obj) >= protocol.shared_memory_threshold:
+            return [(name + '.shm', segments.write(obj))]
+        return super().to_box(name, obj, protocol)
+
+    def from_box(self, name, packet, protocol):
+        if name + '.shm' in packet:
+            return protocol._open_shared_memory(packet[name + '.shm'])
+        return super().from_box(name, packet, protocol)
+
+
+class Stream(Argument):
+    """
+    A stream of bytes, sent as separate chunks after the command or answer
+    itself, so that neither side has to hold the whole payload in memory.
+
+    When sending, pass an iterable of bytes objects, or an object with a
+    `read()` coroutine that returns the next chunk, and b'' at the end. (Like
+    `StreamReader`.) When receiving, this decodes to a `StreamReader`.
+    """
+    def to_box(self, name, obj, protocol):
+        return [(name, str(protocol._open_stream(obj)).encode('ascii'))]
+
+    def from_box(self, name, packet, protocol):
+        return protocol._claim_stream_reader(int(packet[name]))
@@ -0,0 +1,123 @@
+import time
+from collections import OrderedDict
+
+from .codec import decode_box
+
+__all__ = ('ResponseCache', )
+
+
+_TERMINATOR = bytes((0, 0))
+
+# The keys of a call that are not arguments. ('_timeout' and '_compressed'
+# have been removed already.)
+_CALL_KEYS = ('_command', '_ask')
+
+
+class ResponseCache:
+    """
+    Cache of the encoded answers to commands with `cacheable = True`. Assign
+    an instance to the `response_cache` attribute of a protocol class, to
+    share it between all its connections.
+
+    Entries are keyed by the command name and the encoded arguments, exactly
+    as received. A hit sends the stored answer bytes, without decoding the
+    arguments, calling the responder or encoding the result. Only successful
+    answers are stored.
+
+    At most `max_entries` answers are kept; the least recently used one is
+    evicted first. With `ttl`, answers expire after that many seconds.
+    Expired entries are counted as evictions too.
+    """
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Key -> (expiry time, { encoding: answer bytes }), least recently
+        # used first. (The encoding is the compression of the connection.)
+        self._entries = OrderedDict()
+
+        # Incremented by every invalidation, so that answers of responders
+        # that started before it are not stored.
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(command_name, packet):
+        """ The key for the arguments of a received packet. """
+        return (command_name, frozenset(item for item in packet.items() if item[0] not in _CALL_KEYS))
+
+    def get(self, key, encoding):
+        """ Return the stored answer bytes, or None. """
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            expires, answers = entry
+            if expires is not None and time.monotonic() >= expires:
+                del self._entries[key]
+                self.evictions += 1
+            else:
+                answer = answers.get(encoding)
+                if answer is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return answer
+
+        self.misses += 1
+
+    def put(self, key, generation, encoding, answer):
+        """
+        Store the answer bytes, unless the cache has been invalidated since
+        `generation`.
+        """
+        if generation != self.generation:
+            return
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1][encoding] = answer
+            self._entries.move_to_end(key)
+            return
+
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (expires, { encoding: answer })
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, command=None, **kwargs):
+        """
+        Remove answers from the cache. Without arguments, everything.
+        Otherwise, all answers to `command`, or with keyword arguments, the
+        answer to the call of `command` with exactly these arguments.
+
+        ::
+
+            self.response_cache.invalidate(GetUserCommand, id=user_id)
+        """
+        self.generation += 1
+
+        if command is None:
+            self._entries.clear()
+
+        elif kwargs:
+            packet = decode_box(command._encode_arguments(kwargs, _TERMINATOR))
+            self._entries.pop(self.key(command.__name__, packet), None)
+
+        else:
+            for key in [key for key in self._entries if key[0] == command.__name__]:
+                del self._entries[key]
+
+    def snapshot(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,158 @@
+import asyncio
+import random
+
+from .exceptions import ClientClosedError, ConnectionLostError
+from .protocol import AMPProtocol
+
+__all__ = ('ReconnectingClient', )
+
+
+class ReconnectingClient:
+    """
+    Client for one server, that connects again when the connection has been
+    lost. Calls of commands with `idempotent = True` that were waiting for
+    an answer are sent again over the new connection, at most `max_replays`
+    times. Other calls fail right away with `ConnectionLostError`, because
+    we can't know whether the server has executed them.
+
+    ::
+
+        client = ReconnectingClient('localhost', 8000)
+        result = yield from client.call_remote(EchoCommand, text='text')
+
+    After the connection has been lost, we wait a random time between 0 and
+    `min_backoff` seconds before connecting again, so that all the clients
+    of a restarted server don't come back at the same moment. When
+    connecting fails, the maximum of this random time doubles after every
+    failure, up to `max_backoff` seconds. (Full jitter.)
+
+    While not connected, idempotent calls wait until we are connected again;
+    use a timeout to limit that. Other calls fail with the error of the
+    next connection attempt.
+    """
+    def __init__(self, host, port, protocol_factory=AMPProtocol,
+                 min_backoff=.1, max_backoff=30., max_replays=3, loop=None):
+        self.host = host
+        self.port = port
+        self.protocol_factory = protocol_factory
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_replays = max_replays
+
+        self.protocol = None
+        self.reconnects = 0 # Connections made after the first one.
+        self.replays = 0 # Calls that have been sent again.
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._connecting = None # Task, while connecting.
+        self._failures = 0
+        self._closed = False
+
+    @property
+    def connected(self):
+        return self.protocol is not None and self.protocol.transport is not None
+
+    @asyncio.coroutine
+    def call_remote(self, command, _timeout=None, **kwargs):
+        """
+        Call the command. This returns the same results and raises the same
+        exceptions as `AMPProtocol.call_remote`. `_timeout` includes the time
+        spent reconnecting and replaying.
+        """
+        if self._closed:
+            raise ClientClosedError()
+
+        timeout = command.timeout if _timeout is None else _timeout
+
+        if timeout is None:
+            return (yield from self._call(command, kwargs, None))
+        else:
+            deadline = self._loop.time() + timeout
+            return (yield from asyncio.wait_for(self._call(command, kwargs, deadline), timeout))
+
+    @asyncio.coroutine
+    def _call(self, command, kwargs, deadline):
+        replays = 0
+
+        while True:
+            protocol = yield from self._get_protocol(retry=command.idempotent)
+
+            # Send the remaining time along with the call.
+            timeout = None if deadline is None else max(0, deadline - self._loop.time())
+            try:
+                return (yield from protocol.call_remote(command, _timeout=timeout, **kwargs))
+            except ConnectionLostError:
+                if not command.idempotent or self._closed or replays >= self.max_replays:
+                    raise
+
+            replays += 1
+            self.replays += 1
+
+    @asyncio.coroutine
+    def _get_protocol(self, retry):
+        """
+        Return the connected protocol. When connecting fails, raise the error,
+        or with `retry`, keep trying.
+        """
+        while True:
+            if self._closed:
+                raise ClientClosedError()
+            if self.connected:
+                return self.protocol
+
+            if self._connecting is None:
+                self._connecting = asyncio.Task(self._connect())
+                self._connecting.add_done_callback(_retrieve_exception)
+
+            # (`wait` doesn't cancel the connection attempt when a call
+            # times out.)
+            connecting = self._connecting
+            yield from asyncio.wait([connecting])
+
+            if not connecting.cancelled():
+                e = connecting.exception()
+                if e is not None and not (retry and isinstance(e, OSError)):
+                    raise e
+
+    @asyncio.coroutine
+    def _connect(self):
+        try:
+            if self._failures:
+                limit = min(self.max_backoff, self.min_backoff * 2 ** (self._failures - 1))
+                yield from asyncio.sleep(random.uniform(0, limit))
+            elif self.protocol is not None:
+                # The connection has been lost.
+                yield from asyncio.sleep(random.uniform(0, self.min_backoff))
+
+            try:
+                transport, protocol = yield from self._loop.create_connection(
+                        self.protocol_factory, self.host, self.port)
+            except OSError:
+                self._failures += 1
+                raise
+
+            if self.protocol is not None:
+                self.reconnects += 1
+            self.protocol = protocol
+            self._failures = 0
+        finally:
+            self._connecting = None
+
+    def close(self):
+        """
+        Close the connection. Calls in progress fail with
+        `ConnectionLostError`, and new calls with `ClientClosedError`.
+        """
+        self._closed = True
+
+        if self._connecting is not None:
+            self._connecting.cancel()
+            self._connecting = None
+        if self.connected:
+            self.protocol.transport.close()
+
+
+def _retrieve_exception(task):
+    # Nobody may be waiting for a failed connection attempt anymore.
+    if not task.cancelled():
+        task.exception()
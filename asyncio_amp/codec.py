@@ -0,0 +1,271 @@
+"""
+Wire encoding and decoding of AMP boxes.
+
+An AMP box is a sequence of (key, value) pairs. Every key and value is
+prefixed by its length as a 2 byte unsigned big-endian integer. An empty key
+(two NULL bytes) terminates the box.
+"""
+from struct import Struct, pack
+
+from .exceptions import TooLongError
+
+__all__ = ('BoxParser', 'LegacyBoxParser', 'ZeroCopyBoxParser', )
+
+
+# The longest key allowed
+MAX_KEY_LENGTH = 0xff
+
+# The longest value allowed
+MAX_VALUE_LENGTH = 0xffff
+
+
+pack_length = Struct('!H').pack
+_unpack_length = Struct('!H').unpack_from
+
+
+def encode_key(key):
+    """
+    Encode a key, together with its length prefix. (For keys that are known
+    in advance, this can be cached.)
+    """
+    key = key.encode('ascii')
+    if len(key) > MAX_KEY_LENGTH:
+        raise TooLongError()
+    return pack_length(len(key)) + key
+
+
+def encode_value(value):
+    """ Encode a value, together with its length prefix. """
+    if len(value) > MAX_VALUE_LENGTH:
+        raise TooLongError()
+    return pack_length(len(value)) + value
+
+
+def _py_encode_box(packet):
+    """ Encode dict to network bytes. """
+    data_buffer = []
+    write = data_buffer.append
+
+    for k, v in packet.items():
+        k = k.encode('ascii')
+
+        key_length = len(k)
+        value_length = len(v)
+
+        if key_length > MAX_KEY_LENGTH:
+            raise TooLongError()
+
+        if value_length > MAX_VALUE_LENGTH:
+            raise TooLongError()
+
+        # Write key
+        write(pack("!H", key_length))
+        write(k)
+
+        # Write value
+        write(pack("!H", value_length))
+        write(v)
+
+    data_buffer.append(bytes((0, 0)))
+    return b''.join(data_buffer)
+
+
+def _py_scan_boxes(buf, pos, packet, key, min_view_size=-1):
+    """
+    Walk `buf` once, starting at offset `pos`, and collect every box that is
+    completed in there.
+
+    `packet` and `key` are the state of a box that was only partially
+    received in a previous call: the dict of fields received so far and the
+    key that is still waiting for its value (or None).
+
+    Returns a tuple (packets, pos, packet, key), where `pos` is the offset of
+    the first byte that has not been consumed, because the token starting
+    there is incomplete.
+
+    Values of at least `min_view_size` bytes are memoryview slices of `buf`,
+    instead of copies, when that is not negative. (Then `buf` has to be
+    immutable, because the slices outlive this call.)
+    """
+    end = len(buf)
+    if not 0 <= pos <= end:
+        raise ValueError('pos out of range')
+
+    packets = []
+    view = memoryview(buf)
+
+    try:
+        while pos + 2 <= end:
+            length = _unpack_length(buf, pos)[0]
+
+            if key is None:
+                # NULL (two NULL bytes) means the end of a packet.
+                if length == 0:
+                    packets.append(packet)
+                    packet = { }
+                    pos += 2
+                    continue
+
+                if pos + 2 + length > end:
+                    break
+                key = str(view[pos + 2:pos + 2 + length], 'ascii')
+            else:
+                if pos + 2 + length > end:
+                    break
+                if 0 <= min_view_size <= length:
+                    packet[key] = view[pos + 2:pos + 2 + length]
+                else:
+                    packet[key] = bytes(view[pos + 2:pos + 2 + length])
+                key = None
+
+            pos += 2 + length
+    finally:
+        # Release the view, so that the caller is able to resize `buf`.
+        view.release()
+
+    return packets, pos, packet, key
+
+
+# Use the C implementations when the extension has been compiled.
+try:
+    from ._speedups import encode_box, scan_boxes
+    has_speedups = True
+except ImportError:
+    encode_box, scan_boxes = _py_encode_box, _py_scan_boxes
+    has_speedups = False
+
+
+def decode_box(data):
+    """ Decode one complete box, like the value of a nested box. """
+    packets, pos, packet, key = scan_boxes(data, 0, { }, None)
+    if len(packets) != 1 or pos != len(data):
+        raise ValueError('Invalid box')
+    return packets[0]
+
+
+class BoxParser:
+    """
+    Incremental parser that turns a stream of bytes into AMP boxes.
+
+    Every call to `feed` walks the received data only once and returns all
+    the boxes that were completed, as a list of dicts. Only when a partial
+    token is left over at the end, the remaining bytes are kept in a buffer
+    for the next call.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._packet = { }
+        self._key = None
+
+    def feed(self, data):
+        if self._buffer:
+            self._buffer += data
+            buf = self._buffer
+        else:
+            buf = data
+
+        packets, pos, self._packet, self._key = scan_boxes(buf, 0, self._packet, self._key)
+
+        # Compact: keep only the bytes of the incomplete token.
+        if buf is self._buffer:
+            del buf[:pos]
+        elif pos < len(buf):
+            self._buffer = bytearray(buf[pos:])
+
+        return packets
+
+
+class ZeroCopyBoxParser(BoxParser):
+    """
+    Parser that doesn't copy large values: values of at least `min_view_size`
+    bytes are read-only memoryview slices of the received data. `Bytes`
+    arguments and `Stream` chunks are passed on as such; they can be sent
+    again without being copied to a bytes object first.
+
+    Only the values that are split over two reads are copied. Note that a
+    memoryview keeps the whole chunk that it was received in alive.
+    """
+    min_view_size = 1024
+
+    def feed(self, data):
+        if type(data) is not bytes:
+            data = bytes(data)
+
+        pos = 0
+        packets = []
+
+        # Complete the token that was cut off at the end of the previous
+        # read, in the buffer.
+        if self._buffer:
+            buf = self._buffer
+            view = memoryview(data)
+            while True:
+                token_size = 2 if len(buf) < 2 else 2 + _unpack_length(buf, 0)[0]
+                if len(buf) == token_size:
+                    break
+
+                chunk = view[pos:pos + token_size - len(buf)]
+                if not chunk:
+                    return packets
+                buf += chunk
+                pos += len(chunk)
+
+            packets, _, self._packet, self._key = scan_boxes(buf, 0, self._packet, self._key)
+            self._buffer = bytearray()
+
+        more, pos, self._packet, self._key = scan_boxes(
+                data, pos, self._packet, self._key, self.min_view_size)
+        packets.extend(more)
+
+        if pos < len(data):
+            self._buffer = bytearray(memoryview(data)[pos:])
+        return packets
+
+
+class LegacyBoxParser:
+    """
+    The original generator driven parser. Slower than `BoxParser`, because it
+    copies the remaining buffer for every token, but kept for comparison.
+    """
+    def __init__(self):
+        self._parser_generator = self._parser()
+        self._waiting_for_bytes = self._parser_generator.send(None)
+        self._buffer = b''
+        self._packets = []
+
+    def feed(self, data):
+        self._buffer += data
+
+        while self._waiting_for_bytes <= len(self._buffer):
+            token, self._buffer = self._buffer[:self._waiting_for_bytes], self._buffer[self._waiting_for_bytes:]
+            self._waiting_for_bytes = self._parser_generator.send(token)
+
+        packets, self._packets = self._packets, []
+        return packets
+
+    def _parser(self):
+        """
+        Parse loop:
+        (It's a generator that yields the amount of characters it wants to
+        receive for the next 'token'. The state in the state machine is
+        actually the progress in this generator function.)
+        """
+        packet = { }
+        name = None
+
+        while True:
+            # First, receive the SIZE or double NULL.
+            length = _unpack_length((yield 2))[0]
+
+            # A SIZE means receiving a name or value.
+            if name is not None:
+                value = yield length
+                packet[name] = value
+                name = None
+
+            # NULL (two NULL bytes) means the end of a packet
+            elif length == 0:
+                self._packets.append(packet)
+                packet = { }
+            else:
+                name = (yield length).decode('ascii')
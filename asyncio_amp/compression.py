@@ -0,0 +1,61 @@
+"""
+Compression algorithms for values, as negotiated between two protocols.
+Only algorithms from the standard library are used; when one of them isn't
+available in this Python build, it's simply not offered to the other side.
+"""
+from .codec import MAX_VALUE_LENGTH
+from .exceptions import DecompressionError
+
+__all__ = ('COMPRESSORS', )
+
+
+# Map of algorithm name to (compress, decompress) functions.
+COMPRESSORS = { }
+
+
+try:
+    import zlib
+except ImportError:
+    pass
+else:
+    def _zlib_decompress(data):
+        # Values are never longer than MAX_VALUE_LENGTH before compression.
+        # Refuse to decompress more than that.
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, MAX_VALUE_LENGTH + 1)
+        if len(result) > MAX_VALUE_LENGTH or not decompressor.eof:
+            raise DecompressionError('Invalid compressed value')
+        return result
+
+    COMPRESSORS['zlib'] = (zlib.compress, _zlib_decompress)
+
+
+try:
+    import lzma
+except ImportError:
+    pass
+else:
+    def _lzma_decompress(data):
+        decompressor = lzma.LZMADecompressor()
+        result = decompressor.decompress(data, MAX_VALUE_LENGTH + 1)
+        if len(result) > MAX_VALUE_LENGTH or not decompressor.eof:
+            raise DecompressionError('Invalid compressed value')
+        return result
+
+    COMPRESSORS['lzma'] = (lzma.compress, _lzma_decompress)
+
+
+def decompress_packet(packet):
+    """
+    Decompress the values of a received packet in place. The '_compressed'
+    key contains the algorithm and the compressed keys, like b'zlib:a,b'.
+    """
+    algorithm, keys = packet.pop('_compressed').decode('ascii').split(':', 1)
+
+    try:
+        decompress = COMPRESSORS[algorithm][1]
+    except KeyError:
+        raise DecompressionError('Unknown compression algorithm: %r' % algorithm)
+
+    for key in keys.split(','):
+        packet[key] = decompress(packet[key])
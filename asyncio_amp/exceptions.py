@@ -1,5 +1,8 @@
 __all__ = (
+	'ClientClosedError',
 	'ConnectionLostError',
+	'DecompressionError',
+	'PoolClosedError',
 	'RemoteAmpError',
 	'TooLongError',
 	'UnhandledCommandError',
@@ -16,6 +19,18 @@ class ConnectionLostError(Exception):
 		self.exception = exc
 
 
+class ClientClosedError(AmpError):
+    """ The ReconnectingClient has been closed. """
+
+
+class DecompressionError(AmpError):
+    """ A compressed value could not be decompressed. """
+
+
+class PoolClosedError(AmpError):
+    """ The ConnectionPool has been closed, or is being drained. """
+
+
 class RemoteAmpError(AmpError):
     def __init__(self, error_code, error_description):
         self.error_code = error_code
@@ -0,0 +1,173 @@
+import bisect
+import time
+
+__all__ = ('Metrics', 'Histogram', 'merge_snapshots', )
+
+
+# Snapshot values that are a current level, instead of a running total.
+# (When merging, these only make sense for processes that are still alive.)
+GAUGES = ('in_flight', )
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets. (The upper bounds are in seconds.)
+    """
+    bounds = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+              .1, .25, .5, 1., 2.5, 5., 10., float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """
+        Return the upper bound of the bucket that contains the `p`-th
+        percentile (0 < p <= 100), or None when there are no observations.
+        """
+        if not self.count:
+            return None
+
+        rank = self.count * p / 100.
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': list(zip(self.bounds, self.counts)),
+        }
+
+
+class CommandStats:
+    """ Call and error counts and latencies for one Command. """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def record(self, duration, failed):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.latency.observe(duration)
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class Metrics:
+    """
+    Counters for what an `AMPProtocol` is doing. Assign an instance to the
+    `metrics` attribute of a protocol class to collect metrics for all its
+    connections, or to the attribute of one protocol instance for only that
+    connection.
+
+    `client` contains the stats of our `call_remote` calls, `server` those
+    of the responders, both by Command name.
+    """
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.packets_in = 0
+        self.packets_out = 0
+        self.in_flight = 0
+        self.coalesced_calls = 0
+        self.client = { }
+        self.server = { }
+
+    def received(self, size, packets):
+        self.bytes_in += size
+        self.packets_in += packets
+
+    def sent(self, size):
+        self.bytes_out += size
+        self.packets_out += 1
+
+    def call_started(self):
+        """ Called when `call_remote` starts. Returns the start time. """
+        self.in_flight += 1
+        return time.perf_counter()
+
+    def call_finished(self, command_name, start, failed):
+        self.in_flight -= 1
+        self._stats(self.client, command_name).record(time.perf_counter() - start, failed)
+
+    def call_coalesced(self):
+        """ Called when `call_remote` shares the answer of another call. """
+        self.coalesced_calls += 1
+
+    def responder_started(self):
+        """ Called before a responder is called. Returns the start time. """
+        return time.perf_counter()
+
+    def responder_finished(self, command_name, start, failed):
+        self._stats(self.server, command_name).record(time.perf_counter() - start, failed)
+
+    @staticmethod
+    def _stats(stats, command_name):
+        try:
+            return stats[command_name]
+        except KeyError:
+            result = stats[command_name] = CommandStats()
+            return result
+
+    def snapshot(self):
+        """
+        Return all metrics as a dict of plain Python objects, that can be
+        exported to another metrics system.
+        """
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'packets_in': self.packets_in,
+            'packets_out': self.packets_out,
+            'in_flight': self.in_flight,
+            'coalesced_calls': self.coalesced_calls,
+            'client': { name: s.snapshot() for name, s in self.client.items() },
+            'server': { name: s.snapshot() for name, s in self.server.items() },
+        }
+
+
+def merge_snapshots(snapshots):
+    """
+    Combine the results of several `Metrics.snapshot()` calls (for instance,
+    of the worker processes of a server) into one snapshot.
+
+    The `GAUGES` are summed as well; leave out (or set to 0) those of
+    processes that have exited.
+    """
+    result = Metrics().snapshot()
+
+    for snapshot in snapshots:
+        for key in ('bytes_in', 'bytes_out', 'packets_in', 'packets_out', 'coalesced_calls') + GAUGES:
+            result[key] += snapshot[key]
+
+        for side in ('client', 'server'):
+            for name, stats in snapshot[side].items():
+                total = result[side].get(name)
+                if total is None:
+                    total = result[side][name] = CommandStats().snapshot()
+
+                total['calls'] += stats['calls']
+                total['errors'] += stats['errors']
+                total['latency']['count'] += stats['latency']['count']
+                total['latency']['sum'] += stats['latency']['sum']
+                total['latency']['buckets'] = [
+                        (bound, count + other_count) for (bound, count), (_, other_count)
+                        in zip(total['latency']['buckets'], stats['latency']['buckets'])]
+    return result
@@ -0,0 +1,162 @@
+import asyncio
+
+from .exceptions import PoolClosedError
+from .protocol import AMPProtocol
+
+__all__ = ('ConnectionPool', )
+
+
+class _PoolConnection:
+    """
+    One connection slot in the pool.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.protocol = None
+        self.connecting = None # Task, while connecting.
+
+        # Backoff state.
+        self.failures = 0
+        self.retry_at = 0
+
+    @property
+    def connected(self):
+        return self.protocol is not None and self.protocol.transport is not None
+
+
+class ConnectionPool:
+    """
+    Client that keeps `size` connections to each of the given (host, port)
+    endpoints, and spreads the calls over them. Every call goes to the
+    connection that has the least calls waiting for an answer.
+
+    Connections are made when they are needed. When connecting fails, we
+    wait before trying that connection again; twice as long after every
+    failure, starting from `min_backoff` up to `max_backoff` seconds.
+
+    ::
+
+        pool = ConnectionPool([('localhost', 8000)], size=4)
+        result = yield from pool.call_remote(EchoCommand, text='text')
+    """
+    def __init__(self, endpoints, size=1, protocol_factory=AMPProtocol,
+                 min_backoff=.1, max_backoff=30., loop=None):
+        self.protocol_factory = protocol_factory
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._connections = [_PoolConnection(host, port)
+                             for host, port in endpoints for i in range(size)]
+        self._last_error = None
+        self._closed = False
+        self._active_calls = 0
+        self._idle_waiters = []
+
+    @property
+    def protocols(self):
+        """ The protocols of the connections that are currently connected. """
+        return [c.protocol for c in self._connections if c.connected]
+
+    @asyncio.coroutine
+    def call_remote(self, command, **kwargs):
+        """
+        Call the command over one of the connections. This returns the same
+        results and raises the same exceptions as `AMPProtocol.call_remote`.
+        """
+        if self._closed:
+            raise PoolClosedError()
+
+        self._active_calls += 1
+        try:
+            protocol = yield from self._get_protocol()
+            return (yield from protocol.call_remote(command, **kwargs))
+        finally:
+            self._active_calls -= 1
+            if not self._active_calls:
+                for waiter in self._idle_waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+                self._idle_waiters = []
+
+    @asyncio.coroutine
+    def _get_protocol(self):
+        """
+        Return the connected protocol with the least outstanding calls.
+        Raises `ConnectionError` when none can be connected right now.
+        (Chained to the last error from connecting, if any.)
+        """
+        self._connect_missing()
+
+        while True:
+            protocols = self.protocols
+            if protocols:
+                return min(protocols, key=lambda p: len(p._queries))
+
+            # Wait for one of the connections in progress.
+            connecting = [c.connecting for c in self._connections if c.connecting is not None]
+            if not connecting:
+                # (A new exception for every call, so that the tracebacks of
+                # the callers don't pile up on one instance.)
+                if self._last_error is None:
+                    raise ConnectionError('No connection available.')
+                raise ConnectionError('Could not connect: %s' % self._last_error) from self._last_error
+
+            yield from asyncio.wait(connecting, return_when=asyncio.FIRST_COMPLETED)
+
+    def _connect_missing(self):
+        """
+        Start connecting the slots that are not connected, unless we are
+        backing off.
+        """
+        now = self._loop.time()
+
+        for c in self._connections:
+            if not c.connected and c.connecting is None and now >= c.retry_at:
+                c.connecting = asyncio.Task(self._connect(c))
+
+    @asyncio.coroutine
+    def _connect(self, connection):
+        try:
+            transport, protocol = yield from self._loop.create_connection(
+                    self.protocol_factory, connection.host, connection.port)
+        except Exception as e:
+            self._last_error = e
+
+            delay = min(self.max_backoff, self.min_backoff * 2 ** connection.failures)
+            connection.failures += 1
+            connection.retry_at = self._loop.time() + delay
+        else:
+            connection.protocol = protocol
+            connection.failures = 0
+        finally:
+            connection.connecting = None
+
+    @asyncio.coroutine
+    def drain(self):
+        """
+        Stop accepting new calls, wait for the calls in progress to finish,
+        and close all connections.
+        """
+        self._closed = True
+
+        if self._active_calls:
+            waiter = asyncio.Future()
+            self._idle_waiters.append(waiter)
+            yield from waiter
+
+        self.close()
+
+    def close(self):
+        """
+        Close all connections right away. Calls in progress fail with
+        `ConnectionLostError`.
+        """
+        self._closed = True
+
+        for c in self._connections:
+            if c.connecting is not None:
+                c.connecting.cancel()
+            if c.connected:
+                c.protocol.transport.close()
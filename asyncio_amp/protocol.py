@@ -1,7 +1,27 @@
 import asyncio
-from struct import pack, unpack
+import functools
+import heapq
+import inspect
+import itertools
+from collections import Counter
+from collections.abc import Mapping
 
-from .arguments import String, Integer
+from .arguments import Argument, Boolean, String, Integer, Float, Stream
+from .codec import (
+    BoxParser,
+    decode_box,
+    encode_box,
+    encode_key,
+    encode_value,
+    pack_length,
+
+    MAX_KEY_LENGTH,
+    MAX_VALUE_LENGTH,
+)
+from .compression import COMPRESSORS, decompress_packet
+from . import sharedmemory
+from .queries import QueryTable
+from .streams import StreamReader
 from .exceptions import (
     ConnectionLostError,
     RemoteAmpError,
@@ -13,249 +33,1586 @@ from .exceptions import (
     UNKNOWN_ERROR_CODE,
 )
 
-__all__ = ('Command', 'AMPProtocol', )
+__all__ = ('Command', 'AMPProtocol', 'LazyArguments', 'NegotiateCompression',
+           'NegotiateSharedMemory', )
+
+
+
+# Argument instances for the special keys.
+_string = String()
+_integer = Integer()
+_float = Float()
+
+_COMPRESSED_KEY = encode_key('_compressed')
+_BATCH_KEY = encode_key('_batch')
+
+
+def _uses_box(argument):
+    """ True when the argument overrides `to_box`/`from_box`. """
+    return (type(argument).to_box is not Argument.to_box or
+            type(argument).from_box is not Argument.from_box)
+
+
+def _compile_encoder(arguments):
+    """
+    Create a function that encodes the given (name, Argument) pairs to
+    network bytes. The keys are encoded only once, here.
+
+    The returned function takes a dict of values, the bytes to append after
+    the encoded arguments (this should end with the NULL terminator) and the
+    protocol, for the arguments that need it.
+
+    When the protocol has negotiated compression, values of at least
+    `protocol.compression_threshold` bytes are compressed, if that makes them
+    smaller. Their keys are listed in a '_compressed' field.
+    """
+    fields = [(name, argument.encode, encode_key(name),
+               argument.to_box if _uses_box(argument) else None)
+              for name, argument in arguments]
+
+    def encode(values, tail, protocol=None):
+        data_buffer = []
+        write = data_buffer.append
+
+        compression = protocol._compression if protocol is not None else None
+        if compression is not None:
+            prefix, compress = compression
+            threshold = protocol.compression_threshold
+            compressed_keys = []
+
+        for name, encode_argument, key, to_box in fields:
+            if name in values:
+                if to_box is None:
+                    value = encode_argument(values[name])
+                    if len(value) > MAX_VALUE_LENGTH:
+                        raise TooLongError()
+                    if compression is not None and len(value) >= threshold:
+                        c = compress(value)
+                        if len(c) < len(value):
+                            value = c
+                            compressed_keys.append(name)
+                    write(key)
+                    write(pack_length(len(value)))
+                    write(value)
+                else:
+                    for k, value in to_box(name, values[name], protocol):
+                        if len(value) > MAX_VALUE_LENGTH:
+                            raise TooLongError()
+                        if compression is not None and len(value) >= threshold:
+                            c = compress(value)
+                            if len(c) < len(value):
+                                value = c
+                                compressed_keys.append(k)
+                        write(encode_key(k))
+                        write(pack_length(len(value)))
+                        write(value)
+
+        if compression is not None and compressed_keys:
+            write(_COMPRESSED_KEY)
+            write(encode_value(prefix + ','.join(compressed_keys).encode('ascii')))
+
+        write(tail)
+        return b''.join(data_buffer)
+    return encode
+
+
+def _compile_decoder(arguments):
+    """
+    Create a function that decodes the given (name, Argument) pairs from a
+    received packet into a dict of Python objects.
+    """
+    fields = [(name, argument.decode, argument.from_box if _uses_box(argument) else None)
+              for name, argument in arguments]
+
+    def decode(packet, protocol=None):
+        return { name: decode_argument(packet[name]) if from_box is None else from_box(name, packet, protocol)
+                 for name, decode_argument, from_box in fields }
+    return decode
+
 
+def _join_batch(items, tail):
+    """
+    Encode a batch: the given encoded boxes become the values of the keys
+    '0', '1', ... (So every item is limited to MAX_VALUE_LENGTH bytes.)
+    """
+    data_buffer = [_BATCH_KEY, encode_value(_integer.encode(len(items)))]
+    write = data_buffer.append
 
+    for i, item in enumerate(items):
+        write(encode_key(str(i)))
+        write(encode_value(item))
 
-class Command:
+    write(tail)
+    return b''.join(data_buffer)
+
+
+def _split_batch(packet):
+    """ Return the decoded boxes of a received batch. """
+    items = [decode_box(packet[str(i)]) for i in range(_integer.decode(packet['_batch']))]
+
+    for item in items:
+        if '_compressed' in item:
+            decompress_packet(item)
+    return items
+
+
+def _compile_batch_encoder(encode):
+    """
+    Create a function that encodes a list of value dicts with the given
+    compiled encoder, as one batch.
+    """
+    def encode_batch(items, tail, protocol=None):
+        return _join_batch([encode(values, _TERMINATOR, protocol) for values in items], tail)
+    return encode_batch
+
+
+def _error_for_exception(command_cls, e):
+    """ Return the (error_code, description) to send for a responder exception. """
+    if isinstance(e, TooLongError):
+        return UNKNOWN_ERROR_CODE, 'Response too long'
+    else:
+        error_code = (type(e).__name__ if type(e).__name__ in command_cls.errors else UNKNOWN_ERROR_CODE)
+        return error_code, str(e)
+
+
+def _exception_for_error(command_cls, error_code, description):
+    """ Return the exception to raise for an error received from the other side. """
+    if error_code == UNKNOWN_ERROR_CODE:
+        return UnknownRemoteError(description)
+
+    elif error_code == UNHANDLED_ERROR_CODE:
+        return UnhandledCommandError(description)
+
+    elif error_code in command_cls.errors:
+        return command_cls.errors[error_code](description)
+    else:
+        return RemoteAmpError(error_code, description)
+
+
+class CommandMeta(type):
+    """
+    Compile the arguments and response of each Command into specialized
+    encoders and decoders, once, when the class is created.
+    """
+    def __new__(cls, name, bases, attrs):
+        command = super().__new__(cls, name, bases, attrs)
+
+        command._command_field = encode_key('_command') + encode_value(_string.encode(name))
+        command._encode_arguments = staticmethod(_compile_encoder(command.arguments))
+        command._encode_argument_batch = staticmethod(_compile_batch_encoder(command._encode_arguments))
+        command._decode_arguments = staticmethod(_compile_decoder(command.arguments))
+        command._argument_decoders = {
+                name: (argument.decode, argument.from_box if _uses_box(argument) else None)
+                for name, argument in command.arguments }
+        command._stream_arguments = tuple(
+                name for name, argument in command.arguments if isinstance(argument, Stream))
+        command._response_stream_arguments = tuple(
+                name for name, argument in command.response if isinstance(argument, Stream))
+        command._encode_response = staticmethod(_compile_encoder(command.response))
+        command._decode_response = staticmethod(_compile_decoder(command.response))
+
+        if command.cacheable and any(isinstance(argument, Stream)
+                for name, argument in itertools.chain(command.arguments, command.response)):
+            raise TypeError('Commands with Stream arguments cannot be cacheable.')
+        return command
+
+
+class Command(metaclass=CommandMeta):
     arguments = []
     response = []
     errors = dict()
 
+    # When the responders of a protocol are limited, incoming commands with
+    # a higher priority are dispatched first.
+    priority = 0
+
+    # Default timeout for `call_remote`, in seconds. (None means no timeout.)
+    timeout = None
+
+    # When False, calls are sent without '_ask'. The other side won't
+    # answer, and `call_remote` returns None as soon as it has been sent.
+    requires_answer = True
+
+    # Run the responders of this command in an executor, instead of on the
+    # event loop. True means the `executor` of the protocol; or set this to
+    # a `concurrent.futures.Executor` instance.
+    executor = None
+
+    # When True, calls can safely be executed twice. `ReconnectingClient`
+    # sends them again when the connection was lost before the answer came.
+    idempotent = False
+
+    # When True, the answers are a pure function of the arguments. A protocol
+    # with a `response_cache` stores them, and answers the same calls again
+    # without calling the responder.
+    cacheable = False
+
     @classmethod
-    def responder(cls, methodfunc):
+    def responder(cls, methodfunc=None, executor=None, lazy=False):
+        """
+        Decorator for the responder of this command. `executor` overrides
+        the `executor` attribute of the command. (Use it as
+        `@Command.responder(executor=True)`.)
+
+        Responders that run in an executor are called without `self`, because
+        they run in another thread or process. Their arguments are decoded
+        before, and their result is encoded after running them.
+
+        With `lazy`, the responder receives one `arguments` parameter: a
+        `LazyArguments` mapping that decodes every argument when it's
+        accessed for the first time.
+        """
+        if methodfunc is None:
+            return functools.partial(cls.responder, executor=executor, lazy=lazy)
+
         methodfunc._responds_to_amp_command = cls
+        methodfunc._amp_lazy = lazy
+
+        if executor is None:
+            executor = cls.executor
+        if executor:
+            # Keep the function itself, so that it can be pickled for a
+            # ProcessPoolExecutor.
+            methodfunc._amp_executor = executor
+            return methodfunc
+
+        coroutine = asyncio.coroutine(methodfunc)
+
+        # Keep the original function, so that AMPProtocolMeta can tell
+        # whether it's a coroutine.
+        coroutine._amp_function = methodfunc
+        return coroutine
+
+    @classmethod
+    def batch_responder(cls, methodfunc):
+        """
+        Responder for the calls of `call_remote_many`. It receives a list for
+        every argument, and returns a list of results, in the same order.
+        (Exception instances in this list are sent as errors of that item.)
+        Without a batch responder, the normal responder is called for every
+        item of a batch.
+        """
+        methodfunc._responds_to_amp_batch = cls
         return asyncio.coroutine(methodfunc)
 
 
-def _serialize_command(command, kwargs):
-    return { k: v.encode(kwargs[k]) for k, v in command.arguments if k in kwargs }
+class LazyArguments(Mapping):
+    """
+    The arguments of a call, for a responder that is declared with
+    `lazy=True`. Every argument is decoded when it's accessed for the first
+    time, so a responder that uses only a few arguments of a large command
+    doesn't pay for decoding the others. (`Stream` arguments are decoded
+    right away, so that their chunks are not kept around.)
+
+    `raw(name)` returns the encoded value as it was received. With
+    `ZeroCopyBoxParser`, large values are memoryview slices of the received
+    data, that can be sent again without being copied.
+    """
+    def __init__(self, command, packet, protocol):
+        self._decoders = command._argument_decoders
+        self._packet = packet
+        self._protocol = protocol
+        self._decoded = { }
+
+        for name in command._stream_arguments:
+            self[name]
+
+    def __getitem__(self, name):
+        try:
+            return self._decoded[name]
+        except KeyError:
+            decode, from_box = self._decoders[name]
+            if from_box is None:
+                value = decode(self._packet[name])
+            else:
+                value = from_box(name, self._packet, self._protocol)
+
+            self._decoded[name] = value
+            return value
+
+    def __iter__(self):
+        return iter(self._decoders)
+
+    def __len__(self):
+        return len(self._decoders)
+
+    def raw(self, name):
+        """ The value of this argument, as received. """
+        return self._packet[name]
+
+    def _discard_unread(self):
+        """ Remove the shared memory segments of the arguments that were not accessed. """
+        directory = self._protocol._peer_shared_memory
+        if directory is not None:
+            for key, value in self._packet.items():
+                if key.endswith('.shm') and key[:-4] not in self._decoded:
+                    sharedmemory.remove_segment(directory, value)
 
-def _deserialize_command(command_cls, packet):
-    return { k: v.decode(packet[k]) for k, v in command_cls.arguments }
+    def __reduce__(self):
+        # (For a responder in a ProcessPoolExecutor: send everything decoded.)
+        return (dict, (dict(self), ))
 
-def _serialize_answer(command_cls, answer_dict):
-    return { k: v.encode(answer_dict[k]) for k, v in command_cls.response if k in answer_dict }
 
-def _deserialize_answer(command_cls, packet):
-    return { k: v.decode(packet[k]) for k, v in command_cls.response }
+class NegotiateCompression(Command):
+    """
+    Sent by `AMPProtocol` when the connection is made, if it has a
+    `compression` setting. `algorithms` is a comma separated list, in order
+    of preference. The answer is the chosen algorithm, or an empty string.
+    """
+    arguments = [
+        ('algorithms', String()),
+    ]
+    response = [
+        ('algorithm', String()),
+    ]
 
 
-# The longest key allowed
-MAX_KEY_LENGTH = 0xff
+class NegotiateSharedMemory(Command):
+    """
+    Sent by `AMPProtocol` when the connection is made, if it has the
+    `shared_memory` setting. `directory` is where the sender will write
+    values, and contains a probe file with `token`. The answer tells whether
+    the other side can read from there.
+    """
+    arguments = [
+        ('directory', String()),
+        ('token', String()),
+    ]
+    response = [
+        ('accepted', Boolean()),
+    ]
 
-# The longest value allowed
-MAX_VALUE_LENGTH = 0xffff
+
+_ASK_KEY = encode_key('_ask')
+_TIMEOUT_KEY = encode_key('_timeout')
+_ANSWER_KEY = encode_key('_answer')
+_TERMINATOR = bytes((0, 0))
 
 
 class AMPProtocolMeta(type):
     def __new__(cls, name, bases, attrs):
         if not 'responders' in attrs:
-            for a in attrs:
-                try:
-                    attrs[a]._responds_to_amp_command
-                except: pass
-            attrs['responders'] = {
+            # Inherit the responders of the base classes.
+            responders = { }
+            for base in reversed(bases):
+                responders.update(getattr(base, 'responders', { }))
+
+            responders.update({
                     attr._responds_to_amp_command.__name__: attr
                     for attr in attrs.values()
                     if hasattr(attr, '_responds_to_amp_command')
-            }
+            })
+            attrs['responders'] = responders
+
+        if not '_batch_responders' in attrs:
+            batch_responders = { }
+            for base in reversed(bases):
+                batch_responders.update(getattr(base, '_batch_responders', { }))
+
+            batch_responders.update({
+                    attr._responds_to_amp_batch.__name__: attr
+                    for attr in attrs.values()
+                    if hasattr(attr, '_responds_to_amp_batch')
+            })
+            attrs['_batch_responders'] = batch_responders
+
+        # Responders that are plain functions instead of coroutines. These
+        # are called inline, without creating a Task. (Neither generator
+        # functions, nor `async def` functions.)
+        attrs['_sync_responders'] = {
+                command: responder._amp_function
+                for command, responder in attrs['responders'].items()
+                if hasattr(responder, '_amp_function') and
+                        not inspect.isgeneratorfunction(responder._amp_function) and
+                        not inspect.iscoroutinefunction(responder._amp_function)
+        }
+
+        # The commands whose answers can be stored in the `response_cache`.
+        attrs['_cacheable_commands'] = frozenset(
+                command for command, responder in attrs['responders'].items()
+                if responder._responds_to_amp_command.cacheable)
+
+        # Responders that receive `LazyArguments`.
+        attrs['_lazy_responders'] = frozenset(
+                command for command, responder in attrs['responders'].items()
+                if getattr(responder, '_amp_lazy', False))
+
+        # The names of the `Stream` arguments of the commands that have
+        # responders, for the commands that have any.
+        attrs['_stream_commands'] = {
+                responder_cls.__name__: responder_cls._stream_arguments
+                for responder_cls in itertools.chain(
+                        (r._responds_to_amp_command for r in attrs['responders'].values()),
+                        (r._responds_to_amp_batch for r in attrs['_batch_responders'].values()))
+                if responder_cls._stream_arguments
+        }
+
+        # Responders that run in an executor.
+        attrs['_executor_responders'] = {
+                command: responder
+                for command, responder in attrs['responders'].items()
+                if hasattr(responder, '_amp_executor')
+        }
         return super().__new__(cls, name, bases, attrs)
 
 
 class AMPProtocol(asyncio.Protocol, metaclass=AMPProtocolMeta):
+    # Class that turns the incoming byte stream into packets. (Set to
+    # `LegacyBoxParser` for the original generator based parser.)
+    parser_class = BoxParser
+
+    # Write coalescing. When enabled, packets that are sent during the same
+    # loop iteration are collected and written to the transport at once.
+    # The buffer is flushed earlier when it holds `coalesce_max_bytes` bytes
+    # or `coalesce_max_packets` packets. When `coalesce_delay` is set, we
+    # wait up to that many seconds before flushing, instead of flushing at the
+    # end of the current loop iteration.
+    coalesce_writes = False
+    coalesce_max_bytes = 0x10000
+    coalesce_max_packets = 1024
+    coalesce_delay = 0
+
+    # Call coalescing. When enabled, a `call_remote` of an idempotent command
+    # with the same arguments and timeout as a call that is still waiting
+    # for an answer doesn't send anything, but waits for the same answer.
+    coalesce_calls = False
+
+    # Flow control. The high and low water marks of the transport's write
+    # buffer (None means the transport's defaults), and the maximum number
+    # of calls that can wait for an answer at the same time (None means
+    # unlimited). Callers of `call_remote` wait when these limits are hit.
+    write_buffer_high = None
+    write_buffer_low = None
+    max_queries = None
+
+    # Responder limits. The maximum number of responders that run at the same
+    # time for this connection, and the maximum number of incoming commands
+    # that can wait for that. (We stop reading from the transport when that
+    # amount is reached.) `responder_slots` can be set to a `ResponderSlots`
+    # instance to share a limit between all connections of a server. None
+    # means unlimited.
+    max_concurrent_responders = None
+    max_pending_commands = None
+    responder_slots = None
+
+    # The amount of bytes of a received `Stream` that can wait to be read,
+    # before we stop reading from the transport.
+    stream_buffer_size = 0x40000
+
+    # Set to a `Metrics` instance to collect metrics for all connections.
+    metrics = None
+
+    # Set to a `TrafficRecorder` to write the boxes of all connections to a
+    # capture file.
+    recorder = None
+
+    # The executor for the responders that are declared with `executor=True`.
+    # (None means the default executor of the event loop.) When
+    # `max_executor_jobs` of them are running or queued for this
+    # connection, we stop reading from the transport.
+    executor = None
+    max_executor_jobs = None
+
+    # Compression of large values. A tuple of algorithm names ('zlib',
+    # 'lzma'), in order of preference. When set, we agree on an algorithm
+    # with the other side when the connection is made, and compress the
+    # values of at least `compression_threshold` bytes from then on.
+    compression = None
+    compression_threshold = 1024
+
+    # Shared memory for `SharedBytes` values of at least
+    # `shared_memory_threshold` bytes, when both sides set `shared_memory`
+    # and run on the same host. (Checked when the connection is made.)
+    # Below about 1MB, creating and mapping a file costs more than sending
+    # the value through a Unix socket.
+    shared_memory = False
+    shared_memory_threshold = 0x100000
+
+    # Set to a `ResponseCache` instance to store the answers to commands with
+    # `cacheable = True`, for all connections.
+    response_cache = None
+
     def __init__(self):
-        self._queries = { }
-        self._counter = 0
+        self._queries = QueryTable()
+
+        self._paused = False
+        self._drain_waiters = []
+        self._query_slots = asyncio.Semaphore(self.max_queries) if self.max_queries else None
+
+        self._pending_commands = [] # Heap of (-priority, sequence, packet, deadline).
+        self._pending_counter = itertools.count()
+        self._running_responders = 0
+        self._executor_jobs = 0
+
+        # The reasons why reading from the transport is paused.
+        self._read_pauses = set()
+
+        # Outgoing streams: counter and the streams that still have to be
+        # started. Incoming streams: StreamReader instances by ID.
+        self._stream_counter = 0
+        self._pending_streams = []
+        self._incoming_streams = { }
+
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._flush_handle = None
+
+        # Tasks of the calls that can be shared, by (command, timeout, arguments).
+        self._coalesced_calls = { }
+
+        # Number of flushes, by the amount of packets that they carried.
+        self.packets_per_flush = Counter()
+
+        # (prefix, compress) for the negotiated compression algorithm, and
+        # the Task that negotiates it, if `compression` is set.
+        self._compression = None
+        self.compression_negotiated = None
+
+        # The `SharedMemorySegments` to which we write the values that we
+        # send, and the directory from which we read the received values,
+        # once agreed on. And the Task that negotiates this.
+        self._shared_memory = None
+        self._peer_shared_memory = None
+        self.shared_memory_negotiated = None
 
     def connection_made(self, transport):
         self.transport = transport
+        self._box_parser = self.parser_class()
+
+        if self.recorder is not None:
+            self._recording_id = self.recorder.new_connection()
+
+        if self.write_buffer_high is not None or self.write_buffer_low is not None:
+            transport.set_write_buffer_limits(high=self.write_buffer_high, low=self.write_buffer_low)
+
+        if self.compression:
+            self.compression_negotiated = asyncio.Task(self._negotiate_compression())
 
-        self._parser_generator = self._parser()
-        self._waiting_for_bytes = self._parser_generator.send(None)
-        self._buffer = b''
+        if self.shared_memory and sharedmemory.AVAILABLE:
+            self.shared_memory_negotiated = asyncio.Task(self._negotiate_shared_memory())
 
     def connection_lost(self, exc):
-        for k, v in self._queries.items():
-            v.set_exception(ConnectionLostError(exc))
+        self._queries.fail_all(lambda: ConnectionLostError(exc))
+
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionLostError(exc))
+        self._drain_waiters = []
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._write_buffer = []
+        self._write_buffer_size = 0
+
+        for reader in self._incoming_streams.values():
+            reader.set_exception(ConnectionLostError(exc))
+        self._incoming_streams = { }
+
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory = None
 
         self.transport = None
-        self._queries = { }
+        self._paused = False
+        self._pending_commands = []
 
-    def data_received(self, data):
-        self._buffer += data
+    def outstanding_calls(self, count=10):
+        """
+        Return (id, command, age in seconds) tuples for the `count` oldest
+        calls that are waiting for an answer, oldest first.
+        """
+        return self._queries.oldest(count)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
 
-        while self._waiting_for_bytes <= len(self._buffer):
-            token, self._buffer = self._buffer[:self._waiting_for_bytes], self._buffer[self._waiting_for_bytes:]
-            self._waiting_for_bytes = self._parser_generator.send(token)
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters = []
 
-    def _parser(self):
+    @asyncio.coroutine
+    def _drain(self):
         """
-        Parse loop:
-        (It's a generator that yields the amount of characters it wants to
-        receive for the next 'token'. The state in the state machine is
-        actually the progress in this generator function.)
+        Wait until the transport accepts writes again. (Returns immediately
+        when it's not paused.) Raises `ConnectionLostError` when there's no
+        connection.
         """
-        packet = { }
-        name = None
+        if self.transport is None:
+            raise ConnectionLostError(None)
 
-        while True:
-            # First, receive the SIZE or double NULL.
-            length = unpack('!H', (yield 2))[0]
+        while self._paused:
+            waiter = asyncio.Future()
+            self._drain_waiters.append(waiter)
+            yield from waiter
 
-            # NULL (two NULL bytes) means the end of a packet
-            if length == 0:
-                self._handle_incoming_packet(packet)
-                packet = { }
-            # A SIZE means receiving a name or value.
-            elif name is None:
-                name = (yield length).decode('ascii')
-            else:
-                value = yield length
-                packet[name] = value
-                name = None
+    @property
+    def compression_algorithm(self):
+        """ Name of the compression algorithm that we use, or None. """
+        return self._compression[0][:-1].decode('ascii') if self._compression else None
+
+    def _activate_compression(self, algorithm):
+        if algorithm in COMPRESSORS:
+            self._compression = (algorithm.encode('ascii') + b':', COMPRESSORS[algorithm][0])
+
+    @asyncio.coroutine
+    def _negotiate_compression(self):
+        """
+        Agree on a compression algorithm with the other side. When it
+        doesn't know `NegotiateCompression`, we don't compress.
+        """
+        algorithms = [a for a in self.compression if a in COMPRESSORS]
+        try:
+            result = yield from self.call_remote(NegotiateCompression, algorithms=','.join(algorithms))
+        except (RemoteAmpError, UnhandledCommandError, UnknownRemoteError, ConnectionLostError):
+            return
+        self._activate_compression(result['algorithm'])
+
+    @NegotiateCompression.responder
+    def _negotiate_compression_responder(self, algorithms):
+        supported = [a for a in (self.compression or ()) if a in COMPRESSORS]
+
+        for algorithm in algorithms.split(','):
+            if algorithm in supported:
+                self._activate_compression(algorithm)
+                return { 'algorithm': algorithm }
+        return { 'algorithm': '' }
+
+    @property
+    def uses_shared_memory(self):
+        """ True when we send large `SharedBytes` values in shared memory. """
+        return self._shared_memory is not None
+
+    @asyncio.coroutine
+    def _negotiate_shared_memory(self):
+        """
+        Ask the other side whether it can read the values that we write to
+        shared memory. When it can't, or doesn't know
+        `NegotiateSharedMemory`, we send everything over the connection.
+        """
+        try:
+            segments = sharedmemory.SharedMemorySegments()
+        except OSError:
+            return
+
+        try:
+            result = yield from self.call_remote(NegotiateSharedMemory,
+                    directory=segments.directory, token=segments.token)
+        except (RemoteAmpError, UnhandledCommandError, UnknownRemoteError, ConnectionLostError):
+            result = { 'accepted': False }
+
+        if result['accepted'] and self.transport is not None:
+            self._shared_memory = segments
+        else:
+            segments.close()
+
+    @NegotiateSharedMemory.responder
+    def _negotiate_shared_memory_responder(self, directory, token):
+        accepted = (bool(self.shared_memory) and sharedmemory.AVAILABLE and
+                    sharedmemory.check_directory(directory, token))
+        if accepted:
+            self._peer_shared_memory = directory
+        return { 'accepted': accepted }
+
+    def _open_shared_memory(self, name):
+        """ Called when a `SharedBytes` value in shared memory is decoded. """
+        if self._peer_shared_memory is None:
+            raise ValueError('Received a value in shared memory, without agreeing on it.')
+        return sharedmemory.open_segment(self._peer_shared_memory, name)
+
+    def _pause_reading(self, reason):
+        """ Stop reading from the transport, until `_resume_reading(reason)`. """
+        if reason not in self._read_pauses:
+            if not self._read_pauses and self.transport:
+                self.transport.pause_reading()
+            self._read_pauses.add(reason)
+
+    def _resume_reading(self, reason):
+        if reason in self._read_pauses:
+            self._read_pauses.remove(reason)
+            if not self._read_pauses and self.transport:
+                self.transport.resume_reading()
+
+    def data_received(self, data):
+        packets = self._box_parser.feed(data)
+
+        if self.metrics is not None:
+            self.metrics.received(len(data), len(packets))
+
+        if self.recorder is not None:
+            for packet in packets:
+                self.recorder.received(self._recording_id, encode_box(packet))
+
+        for packet in packets:
+            self._handle_incoming_packet(packet)
 
     def _handle_incoming_packet(self, packet):
+        if '_compressed' in packet:
+            decompress_packet(packet)
+
+        # Incoming stream chunk.
+        if '_stream' in packet:
+            self._handle_stream_packet(packet)
+
         # Incoming query.
-        if '_command' in packet:
-            asyncio.Task(self._handle_command_packet(packet))
+        elif '_command' in packet:
+            if self._stream_commands:
+                names = self._stream_commands.get(_string.decode(packet['_command']))
+                if names:
+                    self._expect_streams(names, packet)
+
+            # The time after which the caller doesn't wait anymore. (The
+            # timeout is sent relative, because our clocks can differ.)
+            if '_timeout' in packet:
+                deadline = asyncio.get_event_loop().time() + _float.decode(packet.pop('_timeout'))
+            else:
+                deadline = None
+
+            if (self.max_concurrent_responders is None and self.max_pending_commands is None and
+                    self.responder_slots is None):
+                self._dispatch_command(packet, deadline)
+            else:
+                self._schedule_command(packet, deadline)
 
         # Incoming answer.
         elif '_answer' in packet:
-            id = Integer().decode(packet.pop('_answer'))
-            future = self._queries.get(id, None)
-            if future is not None:
-                del self._queries[id] # XXX: add unit test which fails if we delete this line.
+            ask = packet.pop('_answer')
+            query = self._queries.pop(ask)
+            if query is not None and not query[0].cancelled():
+                future, command, start = query
+                if command._response_stream_arguments:
+                    self._expect_streams(command._response_stream_arguments, packet)
                 future.set_result(packet)
+            elif query is not None or self._queries.is_late(ask):
+                # A late answer to a call that timed out, or was cancelled.
+                self._discard_shared_memory(packet)
             else:
                 raise Exception('Received answer to unknown query.')
 
         # Incoming error
         elif '_error' in packet:
-            id = Integer().decode(packet.pop('_error'))
-            error_code = String().decode(packet.pop('_error_code'))
-            error_description = String().decode(packet.pop('_error_description'))
-
-            future = self._queries.get(id, None)
-            if future is not None:
-                del self._queries[id] # add unit test which fails if we delete this line.
-                future.set_exception(RemoteAmpError(error_code, error_description))
-            else:
+            ask = packet.pop('_error')
+            error_code = _string.decode(packet.pop('_error_code'))
+            error_description = _string.decode(packet.pop('_error_description'))
+
+            query = self._queries.pop(ask)
+            if query is not None:
+                future = query[0]
+                if not future.cancelled():
+                    future.set_exception(RemoteAmpError(error_code, error_description))
+            elif not self._queries.is_late(ask):
                 raise Exception('Received answer to unknown query.')
         else:
             raise Exception('Received unknown packet.')
 
-    def _send_packet(self, packet):
-        # Write to transport.
-        if self.transport:
-            self.transport.write(self._encode_packet(packet))
+    def _schedule_command(self, packet, deadline):
+        """
+        Queue an incoming command, until a responder slot becomes available.
+        """
+        command = _string.decode(packet['_command'])
+        if command in self.responders:
+            priority = self.responders[command]._responds_to_amp_command.priority
+        elif command in self._batch_responders:
+            priority = self._batch_responders[command]._responds_to_amp_batch.priority
+        else:
+            priority = 0
+
+        heapq.heappush(self._pending_commands, (-priority, next(self._pending_counter), packet, deadline))
+        self._dispatch_commands()
+
+        # Stop reading when too many commands are waiting.
+        if (self.max_pending_commands is not None and
+                len(self._pending_commands) >= self.max_pending_commands):
+            self._pause_reading('commands')
+
+    def _dispatch_commands(self):
+        """
+        Start the responders for the queued commands that fit in the limits.
+        """
+        while self._pending_commands and (self.max_concurrent_responders is None or
+                self._running_responders < self.max_concurrent_responders):
+            if self.responder_slots is not None and not self.responder_slots.acquire(self._dispatch_commands):
+                break
+
+            priority, sequence, packet, deadline = heapq.heappop(self._pending_commands)
+            self._running_responders += 1
+            task = self._dispatch_command(packet, deadline)
+
+            if task is None:
+                # Handled inline.
+                self._running_responders -= 1
+                if self.responder_slots is not None:
+                    self.responder_slots.release()
+            else:
+                task.add_done_callback(self._responder_done)
+
+        if (self.max_pending_commands is not None and
+                len(self._pending_commands) < self.max_pending_commands):
+            self._resume_reading('commands')
+
+    def _responder_done(self, task):
+        self._running_responders -= 1
+        if self.responder_slots is not None:
+            self.responder_slots.release()
+        self._dispatch_commands()
+
+    def _open_stream(self, source):
+        """
+        Called when a `Stream` argument is encoded. Returns the stream ID.
+        The chunks are sent after the packet itself; see `_start_streams`.
+        """
+        self._stream_counter += 1
+        self._pending_streams.append((self._stream_counter, source))
+        return self._stream_counter
+
+    def _encode_with_streams(self, encode, values, tail):
+        """
+        Encode a packet with the given compiled encoder. Returns the data and
+        the streams that have to be started after sending it.
+        """
+        try:
+            return encode(values, tail, self), self._pending_streams
+        finally:
+            self._pending_streams = []
+
+    def _start_streams(self, streams):
+        for id, source in streams:
+            asyncio.Task(self._send_stream(id, source))
+
+    @asyncio.coroutine
+    def _send_stream(self, id, source):
+        """
+        Send the chunks of an outgoing stream. `source` is an iterable of
+        bytes, or has a `read()` coroutine.
+        """
+        id = _integer.encode(id)
+        read = getattr(source, 'read', None)
+        iterator = None if read else iter(source)
+
+        try:
+            while True:
+                if read:
+                    chunk = yield from read()
+                    if not chunk:
+                        break
+                else:
+                    try:
+                        chunk = next(iterator)
+                    except StopIteration:
+                        break
+
+                for i in range(0, len(chunk), MAX_VALUE_LENGTH):
+                    yield from self._drain()
+                    self._send_packet({ '_stream': id, '_chunk': chunk[i:i + MAX_VALUE_LENGTH] })
+        except Exception as e:
+            if self.transport:
+                self._send_packet({ '_stream': id, '_stream_error': _string.encode(str(e)) })
         else:
+            self._send_packet({ '_stream': id, '_end': b'' })
+
+    def _handle_stream_packet(self, packet):
+        id = _integer.decode(packet['_stream'])
+        reader = self._incoming_streams.get(id)
+
+        # Drop the chunks of streams that we don't expect, or that have been
+        # discarded, because their command never reached a responder.
+        if reader is None:
+            return
+
+        if '_chunk' in packet:
+            reader.feed_chunk(packet['_chunk'])
+        else:
+            if '_end' in packet:
+                reader.feed_eof()
+            else:
+                reader.set_exception(UnknownRemoteError(_string.decode(packet['_stream_error'])))
+
+            # Forget about it, unless it still has to be decoded.
+            if reader._claimed:
+                del self._incoming_streams[id]
+
+    def _get_stream_reader(self, id):
+        try:
+            return self._incoming_streams[id]
+        except KeyError:
+            reader = self._incoming_streams[id] = StreamReader(self, self.stream_buffer_size)
+            return reader
+
+    def _stream_ids(self, names, packet):
+        """ The IDs of the `Stream` values of a received packet or batch. """
+        items = _split_batch(packet) if '_batch' in packet else (packet, )
+        return [int(item[name]) for item in items for name in names if name in item]
+
+    def _expect_streams(self, names, packet):
+        """
+        Create the readers for the streams of a received packet, when it
+        arrives. (The chunks can arrive before the packet has been decoded,
+        and are kept until then.)
+        """
+        for id in self._stream_ids(names, packet):
+            self._get_stream_reader(id)
+
+    def _discard_streams(self, command, packet):
+        """
+        Close and forget the streams of a received command, after it has been
+        handled or dropped. The chunks that still arrive are dropped.
+        """
+        names = self._stream_commands.get(command)
+        if names:
+            for id in self._stream_ids(names, packet):
+                reader = self._incoming_streams.pop(id, None)
+                if reader is not None:
+                    reader.close()
+
+    def _discard_shared_memory(self, packet):
+        """
+        Remove the shared memory segments of a received packet or batch that
+        is dropped without decoding it. (Otherwise, they would only be
+        removed when the connection is closed.)
+        """
+        directory = self._peer_shared_memory
+        if directory is not None:
+            for item in (_split_batch(packet) if '_batch' in packet else (packet, )):
+                for key, value in item.items():
+                    if key.endswith('.shm'):
+                        sharedmemory.remove_segment(directory, value)
+
+    def _discard_packet(self, command, packet):
+        """ Discard the streams and shared memory of a dropped command. """
+        self._discard_streams(command, packet)
+        self._discard_shared_memory(packet)
+
+    def _track_packet(self, command, packet, task):
+        """
+        Discard the streams of a command when its Task is done, and its
+        shared memory when the Task is cancelled. (Also when that happens
+        before the packet has been decoded.) Returns the task.
+        """
+        if command in self._stream_commands:
+            task.add_done_callback(lambda task: self._discard_streams(command, packet))
+
+        if self._peer_shared_memory is not None:
+            def done(task):
+                if task.cancelled():
+                    self._discard_shared_memory(packet)
+            task.add_done_callback(done)
+        return task
+
+    def _claim_stream_reader(self, id):
+        """ Called when a `Stream` argument is decoded. """
+        reader = self._get_stream_reader(id)
+        reader._claimed = True
+
+        if reader.finished:
+            del self._incoming_streams[id]
+        return reader
+
+    def _send_packet(self, packet):
+        self._send_data(self._encode_packet(packet))
+
+    def _send_data(self, data):
+        if not self.transport:
             raise Exception('Not connected')# TODO: Add better exception and unittest.
 
+        if self.metrics is not None:
+            self.metrics.sent(len(data))
+
+        if self.recorder is not None:
+            self.recorder.sent(self._recording_id, data)
+
+        # Write to transport.
+        if not self.coalesce_writes:
+            self.transport.write(data)
+            return
+
+        # Or add to the write buffer.
+        self._write_buffer.append(data)
+        self._write_buffer_size += len(data)
+
+        if (self._write_buffer_size >= self.coalesce_max_bytes or
+                len(self._write_buffer) >= self.coalesce_max_packets):
+            self.flush()
+
+        elif self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            if self.coalesce_delay:
+                self._flush_handle = loop.call_later(self.coalesce_delay, self.flush)
+            else:
+                self._flush_handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        """ Write all the coalesced packets to the transport. """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self._write_buffer and self.transport:
+            self.packets_per_flush[len(self._write_buffer)] += 1
+            self.transport.writelines(self._write_buffer)
+
+        self._write_buffer = []
+        self._write_buffer_size = 0
+
     @classmethod
     def _encode_packet(cls, packet):
         """ Encode dict to network bytes. """
-        data_buffer = []
-        write = data_buffer.append
+        return encode_box(packet)
 
-        for k, v in packet.items():
-            k = k.encode('ascii')
+    def _dispatch_command(self, packet, deadline=None):
+        """
+        Run the responder for an incoming command. Responders that are plain
+        functions are called right away and answered in the same tick. For
+        coroutines, a Task is created and returned.
 
-            key_length = len(k)
-            value_length = len(v)
+        When a `deadline` is given, the command is dropped if the caller
+        gave up already, and the Task is cancelled when the deadline passes.
+        """
+        command = _string.decode(packet['_command'])
 
-            if key_length > MAX_KEY_LENGTH:
-                raise TooLongError()
+        if deadline is not None and asyncio.get_event_loop().time() >= deadline:
+            self._discard_packet(command, packet)
+            return
 
-            if value_length > MAX_VALUE_LENGTH:
-                raise TooLongError()
+        if '_batch' in packet:
+            return self._track_packet(command, packet,
+                    self._cancel_at(deadline, asyncio.Task(self._handle_batch_packet(packet))))
 
-            # Write key
-            write(pack("!H", key_length))
-            write(k)
+        cache_key = None
+        if self.response_cache is not None and command in self._cacheable_commands and '_ask' in packet:
+            cache_key = self._answer_from_cache(command, packet)
+            if cache_key is None:
+                return
 
-            # Write value
-            write(pack("!H", value_length))
-            write(v)
+        function = self._sync_responders.get(command)
 
-        data_buffer.append(bytes((0, 0)))
-        return b''.join(data_buffer)
+        # (When writing is paused, the reply has to wait; use a Task.)
+        if function is None or self._paused:
+            return self._track_packet(command, packet,
+                    self._cancel_at(deadline, asyncio.Task(self._handle_command_packet(packet, cache_key))))
+
+        decoded = self._decode_command_packet(packet)
+        if decoded is None:
+            return
+
+        command_cls, id, kwargs = decoded
+        metrics = self.metrics
+        start = metrics.responder_started() if metrics is not None else None
+
+        # (Nothing may escape from here to `data_received`, or the other
+        # packets of the same read are lost.)
+        try:
+            result = function(self, ** kwargs)
+
+            # The function returned a Future or coroutine after all.
+            if inspect.isgenerator(result) or inspect.isawaitable(result):
+                task = asyncio.Task(self._wait_and_reply(command_cls, id, result, start, cache_key))
+                task.add_done_callback(lambda task: self._close_streams(kwargs))
+                return self._track_packet(command, packet, self._cancel_at(deadline, task))
+
+            self._reply(command_cls, id, result, cache_key)
+        except Exception as e:
+            self._reply_exception(command_cls, id, e)
+            failed = True
+        else:
+            failed = False
+
+        if start is not None:
+            metrics.responder_finished(command_cls.__name__, start, failed)
+        self._close_streams(kwargs)
+
+    @staticmethod
+    def _cancel_at(deadline, task):
+        """ Cancel the task when the deadline passes. Returns the task. """
+        if deadline is not None:
+            handle = asyncio.get_event_loop().call_at(deadline, task.cancel)
+            task.add_done_callback(lambda task: handle.cancel())
+        return task
+
+    def _answer_from_cache(self, command, packet):
+        """
+        Send the stored answer to a cacheable command. Returns None when that
+        has been done, or otherwise the key for `_reply` to store the answer.
+        """
+        cache = self.response_cache
+        key = cache.key(command, packet)
+
+        # (When writing is paused, the answer has to wait for the responder.)
+        if not self._paused:
+            answer = cache.get(key, self._compression)
+            if answer is not None:
+                self._send_data(answer + _ANSWER_KEY + encode_value(packet['_ask']) + _TERMINATOR)
+                self._discard_shared_memory(packet)
+                return
+
+        return key, cache.generation
 
     @asyncio.coroutine
-    def _handle_command_packet(self, packet):
-        command = String().decode(packet.pop('_command'))
-        id = packet.pop('_ask', None) # If '_ask' is missing, we shouldn't return an answer.
+    def _handle_command_packet(self, packet, cache_key=None):
+        decoded = self._decode_command_packet(packet)
+        if decoded is not None:
+            command_cls, id, kwargs = decoded
+            responder = self.responders[command_cls.__name__]
+            start = self.metrics.responder_started() if self.metrics is not None else None
 
-        def send_error_reply(error_code, description):
-            self._send_packet({
-                    '_error': id,
-                    '_error_code': String().encode(error_code),
-                    '_error_description': String().encode(description),
-                    })
+            if command_cls.__name__ in self._executor_responders:
+                coroutine = self._run_in_executor(responder, kwargs)
+            else:
+                coroutine = responder(self, ** kwargs)
+            try:
+                yield from self._wait_and_reply(command_cls, id, coroutine, start, cache_key)
+            finally:
+                self._close_streams(kwargs)
+
+    @asyncio.coroutine
+    def _handle_batch_packet(self, packet):
+        """ Run the responders for a batch of calls and send one answer. """
+        command = _string.decode(packet.pop('_command'))
+        id = packet.pop('_ask', None)
+
+        batch_responder = self._batch_responders.get(command)
+        responder = self.responders.get(command)
+
+        if batch_responder is None and responder is None:
+            self._discard_packet(command, packet)
+            self._send_error_reply(id, UNHANDLED_ERROR_CODE, 'Unhandled Command: %r' % command)
+            return
+
+        try:
+            if batch_responder is not None:
+                command_cls = batch_responder._responds_to_amp_batch
+                calls = [command_cls._decode_arguments(item, self) for item in _split_batch(packet)]
+            else:
+                command_cls = responder._responds_to_amp_command
+                calls = [self._decode_arguments(command, command_cls, item) for item in _split_batch(packet)]
+        except Exception as e:
+            self._discard_packet(command, packet)
+            self._reply_exception(command_cls, id, e)
+            return
+
+        start = self.metrics.responder_started() if self.metrics is not None else None
+
+        try:
+            if batch_responder is not None:
+                results = yield from self._call_batch_responder(batch_responder, command_cls, calls)
+            else:
+                results = yield from self._call_responders(responder, command, calls)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._reply_exception(command_cls, id, e)
+            failed = True
+        else:
+            if id is not None:
+                try:
+                    yield from self._drain()
+                except ConnectionLostError:
+                    # (Then `_reply_batch` doesn't send anything.)
+                    pass
+            self._reply_batch(command_cls, id, results)
+            failed = False
+        finally:
+            for kwargs in calls:
+                self._close_streams(kwargs)
+
+        if start is not None:
+            self.metrics.responder_finished(command_cls.__name__, start, failed)
+
+    @asyncio.coroutine
+    def _call_batch_responder(self, batch_responder, command_cls, calls):
+        kwargs = { name: [call[name] for call in calls] for name, argument in command_cls.arguments }
+        results = yield from batch_responder(self, ** kwargs)
+
+        if len(results) != len(calls):
+            raise Exception('Batch responder returned %i results for %i calls' % (len(results), len(calls)))
+        return results
+
+    @asyncio.coroutine
+    def _call_responders(self, responder, command, calls):
+        """
+        Call the normal responder for every item of a batch. Plain functions
+        are called one after the other, coroutines run concurrently. Returns
+        the results, with the exceptions in the place of failed calls.
+        """
+        if command in self._executor_responders:
+            return (yield from asyncio.gather(
+                    *[self._run_in_executor(responder, kwargs) for kwargs in calls], return_exceptions=True))
+
+        function = self._sync_responders.get(command)
+        if function is None:
+            return (yield from asyncio.gather(
+                    *[responder(self, ** kwargs) for kwargs in calls], return_exceptions=True))
+
+        results = []
+        for kwargs in calls:
+            try:
+                result = function(self, ** kwargs)
+                if inspect.isgenerator(result) or inspect.isawaitable(result):
+                    result = yield from result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result = e
+            results.append(result)
+        return results
+
+    @asyncio.coroutine
+    def _run_in_executor(self, function, kwargs):
+        """
+        Run a responder in its executor, and count it for
+        `max_executor_jobs`.
+        """
+        executor = self.executor if function._amp_executor is True else function._amp_executor
+
+        self._executor_jobs += 1
+        if self.max_executor_jobs is not None and self._executor_jobs >= self.max_executor_jobs:
+            self._pause_reading('executor')
+        try:
+            return (yield from asyncio.get_event_loop().run_in_executor(
+                    executor, functools.partial(function, ** kwargs)))
+        finally:
+            self._executor_jobs -= 1
+            if self.max_executor_jobs is not None and self._executor_jobs < self.max_executor_jobs:
+                self._resume_reading('executor')
+
+    @staticmethod
+    def _close_streams(kwargs):
+        """
+        Discard what the responder didn't read from incoming streams, and
+        the values in shared memory that a lazy responder didn't access.
+        """
+        for value in kwargs.values():
+            if isinstance(value, StreamReader):
+                value.close()
+            elif isinstance(value, LazyArguments):
+                AMPProtocol._close_streams(value._decoded)
+                value._discard_unread()
+
+    def _decode_command_packet(self, packet):
+        """
+        Return a (command_cls, id, kwargs) tuple for an incoming command, or
+        None when there's no responder for it or the arguments are invalid.
+        (Then the error has been sent already.)
+        """
+        command = _string.decode(packet.pop('_command'))
+        id = packet.pop('_ask', None) # If '_ask' is missing, we shouldn't return an answer.
 
         # Get responder
         if command in self.responders:
             responder = self.responders[command]
         else:
-            send_error_reply(UNHANDLED_ERROR_CODE, 'Unhandled Command: %r' % command)
+            self._discard_packet(command, packet)
+            self._send_error_reply(id, UNHANDLED_ERROR_CODE, 'Unhandled Command: %r' % command)
             return
 
-        # Decode
         command_cls = responder._responds_to_amp_command
-        kwargs = _deserialize_command(command_cls, packet)
-
-        # Call responder
         try:
-            result = yield from responder(self, ** kwargs)
+            return command_cls, id, self._decode_arguments(command, command_cls, packet)
+        except Exception as e:
+            self._discard_packet(command, packet)
+            self._reply_exception(command_cls, id, e)
 
-            # Send answer.
-            if id is not None:
-                # (This can still raise TooLongError if the response is too long.)
-                reply = { '_answer': id }
-                reply.update(_serialize_answer(command_cls, result))
-                self._send_packet(reply)
-        except TooLongError as e:
-            if id is not None:
-                send_error_reply(UNKNOWN_ERROR_CODE, 'Response too long')
-            #raise
+    def _decode_arguments(self, command, command_cls, packet):
+        """ Return the keyword arguments for the responder of a command. """
+        if command in self._lazy_responders:
+            return { 'arguments': LazyArguments(command_cls, packet, self) }
+        else:
+            return command_cls._decode_arguments(packet, self)
+
+    @asyncio.coroutine
+    def _wait_and_reply(self, command_cls, id, coroutine, start=None, cache_key=None):
+        """
+        Wait for the result of a responder and send the answer. (`start` is
+        the start time for the metrics, if enabled. `cache_key` is given when
+        the answer has to be stored in the `response_cache`.)
+        """
+        try:
+            result = yield from coroutine
+        except asyncio.CancelledError:
+            # The caller gave up. Don't reply.
+            raise
         except Exception as e:
+            self._reply_exception(command_cls, id, e)
+            failed = True
+        else:
             if id is not None:
-                # Send error to client
-                error_code = (type(e).__name__ if type(e).__name__ in command_cls.errors else UNKNOWN_ERROR_CODE)
-                send_error_reply(error_code, e.args[0])
+                try:
+                    yield from self._drain()
+                except ConnectionLostError:
+                    # (Then `_reply` doesn't send anything.)
+                    pass
+            self._reply(command_cls, id, result, cache_key)
+            failed = False
+
+        if start is not None:
+            self.metrics.responder_finished(command_cls.__name__, start, failed)
+
+    def _reply(self, command_cls, id, result, cache_key=None):
+        """
+        Send the answer to a command. (Unless the connection has been lost
+        while the responder was running.)
+        """
+        if id is not None and self.transport is not None:
+            # (This can still raise TooLongError if the response is too long.)
+            try:
+                if cache_key is None:
+                    data, streams = self._encode_with_streams(
+                            command_cls._encode_response, result, _ANSWER_KEY + encode_value(id) + _TERMINATOR)
+                else:
+                    # Store the answer without the ID. (Cacheable commands
+                    # have no streams.)
+                    answer, streams = self._encode_with_streams(command_cls._encode_response, result, b'')
+                    data = answer + _ANSWER_KEY + encode_value(id) + _TERMINATOR
+            except Exception as e:
+                self._reply_exception(command_cls, id, e)
+            else:
+                if cache_key is not None:
+                    key, generation = cache_key
+                    self.response_cache.put(key, generation, self._compression, answer)
+                self._send_data(data)
+                self._start_streams(streams)
+
+    def _reply_batch(self, command_cls, id, results):
+        """ Send the answer to a batch of calls. """
+        if id is not None and self.transport is not None:
+            def encode(results, tail, protocol):
+                return _join_batch([self._encode_batch_item(command_cls, r) for r in results], tail)
+
+            data, streams = self._encode_with_streams(
+                    encode, results, _ANSWER_KEY + encode_value(id) + _TERMINATOR)
+            self._send_data(data)
+            self._start_streams(streams)
+
+    def _encode_batch_item(self, command_cls, result):
+        """ Encode the result, or exception, of one call in a batch. """
+        if not isinstance(result, Exception):
+            try:
+                item = command_cls._encode_response(result, _TERMINATOR, self)
+            except Exception as e:
+                result = e
+            else:
+                if len(item) <= MAX_VALUE_LENGTH:
+                    return item
+                result = TooLongError()
+
+        error_code, description = _error_for_exception(command_cls, result)
+        return encode_box({
+                '_error_code': _string.encode(error_code),
+                '_error_description': _string.encode(description),
+                })
+
+    def _reply_exception(self, command_cls, id, e):
+        """ Send the exception raised by a responder to the client. """
+        error_code, description = _error_for_exception(command_cls, e)
+        self._send_error_reply(id, error_code, description)
+
+    def _send_error_reply(self, id, error_code, description):
+        if id is not None and self.transport is not None:
+            self._send_packet({
+                    '_error': id,
+                    '_error_code': _string.encode(error_code),
+                    '_error_description': _string.encode(description),
+                    })
 
     @asyncio.coroutine
-    def call_remote(self, command, **kwargs):
+    def call_remote(self, command, _timeout=None, **kwargs):
         """
         ::
 
             yield from protocol.call_remote(EchoCommand, message='text')
+
+        `_timeout` is the maximum time in seconds to wait for the answer.
+        (`command.timeout` by default.) When it expires, this raises
+        `asyncio.TimeoutError`. The remaining time is sent along with the
+        call, so that the other side can drop the work when we stopped
+        waiting.
+        """
+        if not command.requires_answer:
+            yield from self._drain()
+            self.send_remote(command, **kwargs)
+            return
+
+        timeout = command.timeout if _timeout is None else _timeout
+
+        if self.coalesce_calls and command.idempotent:
+            return (yield from self._coalesced_call(command, kwargs, timeout))
+        else:
+            return (yield from self._call_with_timeout(command, kwargs, timeout))
+
+    @asyncio.coroutine
+    def _call_with_timeout(self, command, kwargs, timeout):
+        if timeout is None:
+            return (yield from self._call_and_wait(command, kwargs, None))
+        else:
+            deadline = asyncio.get_event_loop().time() + timeout
+            return (yield from asyncio.wait_for(self._call_and_wait(command, kwargs, deadline), timeout))
+
+    @asyncio.coroutine
+    def _coalesced_call(self, command, kwargs, timeout):
         """
-        # Create packet
-        packet = _serialize_command(command, kwargs)
-        packet['_command'] = String().encode(command.__name__)
+        Wait for the answer of an identical call in progress, or make the call
+        in a Task that later identical calls can share.
+        """
+        try:
+            key = (command, timeout, frozenset(kwargs.items()))
+            task = self._coalesced_calls.get(key)
+        except TypeError:
+            # Unhashable arguments; don't share this call.
+            return (yield from self._call_with_timeout(command, kwargs, timeout))
 
-        # If we want to wait for an answer, add _ask and counter.
-        self._counter += 1
-        packet['_ask'] = Integer().encode(self._counter)
+        if task is None:
+            task = self._coalesced_calls[key] = asyncio.Task(self._call_with_timeout(command, kwargs, timeout))
+            task.add_done_callback(lambda task: self._coalesced_calls.pop(key, None))
+        elif self.metrics is not None:
+            self.metrics.call_coalesced()
 
-        self._send_packet(packet)
+        # (A caller that is cancelled doesn't cancel the call of the others.)
+        return (yield from asyncio.shield(task))
 
-        # Receive packet from remote end.
-        f = asyncio.Future()
-        self._queries[self._counter] = f
+    @asyncio.coroutine
+    def call_remote_many(self, command, calls, batch_size=1000, return_exceptions=False, _timeout=None):
+        """
+        ::
+
+            results = yield from protocol.call_remote_many(EchoCommand, [
+                    { 'message': 'a' }, { 'message': 'b' } ])
+
+        Call the command once for every dict of arguments in `calls`. Up to
+        `batch_size` calls are sent in one packet, and their results are
+        received in one answer. Returns the list of results, in the same
+        order. When calls failed, the first exception is raised, or, with
+        `return_exceptions`, the exceptions are returned in their place.
+
+        `_timeout` applies to all the calls together.
+        """
+        calls = list(calls)
+        batches = [calls[i:i + batch_size] for i in range(0, len(calls), batch_size)]
+
+        if not command.requires_answer:
+            for batch in batches:
+                yield from self._drain()
+                data, streams = self._encode_with_streams(
+                        command._encode_argument_batch, batch, command._command_field + _TERMINATOR)
+                self._send_data(data)
+                self._start_streams(streams)
+            return
+
+        timeout = command.timeout if _timeout is None else _timeout
+        deadline = None if timeout is None else asyncio.get_event_loop().time() + timeout
+
+        waiting = asyncio.gather(*[self._call_and_wait(command, batch, deadline, True) for batch in batches])
+        if timeout is not None:
+            waiting = asyncio.wait_for(waiting, timeout)
+
+        results = [result for batch_results in (yield from waiting) for result in batch_results]
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def send_remote(self, command, **kwargs):
+        """
+        Send a command without asking for an answer. This doesn't create a
+        Future and returns immediately, without waiting for flow control. (Use
+        `call_remote` on a Command with `requires_answer = False` for that.)
+        """
+        data, streams = self._encode_with_streams(
+                command._encode_arguments, kwargs, command._command_field + _TERMINATOR)
+        self._send_data(data)
+        self._start_streams(streams)
+
+    @asyncio.coroutine
+    def _call_and_wait(self, command, kwargs, deadline, batch=False):
+        # Wait for a free slot and for the transport to accept writes.
+        if self._query_slots is not None:
+            yield from self._query_slots.acquire()
+
+        metrics = self.metrics
+        if metrics is not None:
+            start = metrics.call_started()
+        failed = True
 
         try:
-            packet = yield from f
-            return _deserialize_answer(command, packet)
-        except RemoteAmpError as e:
-            if e.error_code == UNKNOWN_ERROR_CODE:
-                raise UnknownRemoteError(e.error_description)
+            yield from self._drain()
+            ask, future = self._call_remote(command, kwargs, deadline, batch)
 
-            if e.error_code == UNHANDLED_ERROR_CODE:
-                raise UnhandledCommandError(e.error_description)
+            # Fail the call ourselves at the deadline. (The outer `wait_for`
+            # only covers the waiting above: its cancellation can arrive a
+            # loop iteration after the TimeoutError has been raised.)
+            if deadline is not None:
+                expiry = asyncio.get_event_loop().call_at(deadline, self._expire_query, ask, future)
 
-            elif e.error_code in command.errors:
-                raise command.errors[e.error_code](e.error_description) from e
-            else:
+            try:
+                packet = yield from future
+            except asyncio.CancelledError:
+                # Cancelled by the caller. Forget about this query, and drop
+                # the answer if it arrived already.
+                self._queries.pop(ask)
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    self._discard_shared_memory(future.result())
                 raise
+            except RemoteAmpError as e:
+                raise _exception_for_error(command, e.error_code, e.error_description) from e
+            finally:
+                if deadline is not None:
+                    expiry.cancel()
+
+            if batch:
+                result = self._decode_batch_response(command, packet)
+            else:
+                result = command._decode_response(packet, self)
+            failed = False
+        finally:
+            if self._query_slots is not None:
+                self._query_slots.release()
+            if metrics is not None:
+                metrics.call_finished(command.__name__, start, failed)
+
+        return result
+
+    def _expire_query(self, ask, future):
+        """ Forget about a call that has passed its deadline, and fail it. """
+        self._queries.pop(ask)
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
+
+    def _decode_batch_response(self, command, packet):
+        results = []
+        for item in _split_batch(packet):
+            if '_error_code' in item:
+                results.append(_exception_for_error(command,
+                        _string.decode(item['_error_code']), _string.decode(item['_error_description'])))
+            else:
+                results.append(command._decode_response(item, self))
+        return results
+
+    def _call_remote(self, command, kwargs, deadline=None, batch=False):
+        """
+        Send the call. Returns the encoded ID and the Future that receives the
+        answer packet. (With `batch`, `kwargs` is a list of calls.)
+        """
+        # Register the Future that receives the answer, and add its ID as _ask.
+        f = asyncio.Future()
+        ask = self._queries.add(command, f)
+        tail = command._command_field + _ASK_KEY + encode_value(ask)
+
+        if deadline is not None:
+            timeout = max(0, deadline - asyncio.get_event_loop().time())
+            tail += _TIMEOUT_KEY + encode_value(_float.encode(timeout))
+
+        # Create and send packet.
+        encode = command._encode_argument_batch if batch else command._encode_arguments
+        try:
+            data, streams = self._encode_with_streams(encode, kwargs, tail + _TERMINATOR)
+            self._send_data(data)
+        except:
+            self._queries.pop(ask)
+            raise
+
+        self._start_streams(streams)
+        return ask, f
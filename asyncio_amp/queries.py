@@ -0,0 +1,99 @@
+import itertools
+import sys
+import time
+from collections import OrderedDict
+
+__all__ = ('QueryTable', )
+
+
+# (Plain dicts keep the insertion order from Python 3.7 on.)
+_ordered_dict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+
+class QueryTable:
+    """
+    The calls of a protocol that wait for an answer, by the encoded ID that
+    was sent as '_ask'. (So that answers are looked up without decoding the
+    ID.) Every entry is a (future, command, start time) tuple.
+
+    IDs are allocated from 1 up to `max_id`. Then they wrap around, skipping
+    the IDs that are still in use.
+
+    The entries are kept in the order in which they were added, so the
+    oldest calls are the first ones.
+    """
+    max_id = 0x7fffffff
+
+    def __init__(self, max_id=None):
+        if max_id is not None:
+            self.max_id = max_id
+
+        self._queries = _ordered_dict()
+        self.counter = 0 # The last allocated ID.
+        self.wrapped = False
+
+    def __len__(self):
+        return len(self._queries)
+
+    def __contains__(self, ask):
+        return ask in self._queries
+
+    def add(self, command, future, _monotonic=time.monotonic):
+        """ Allocate an ID for a call. Returns the encoded ID. """
+        self.counter = counter = self.counter + 1
+
+        if counter <= self.max_id and not self.wrapped:
+            ask = b'%d' % counter
+        else:
+            ask = self._next_free_id()
+
+        self._queries[ask] = (future, command, _monotonic())
+        return ask
+
+    def _next_free_id(self):
+        """ Wrap around, and find the next ID that is not in use. """
+        if len(self._queries) >= self.max_id:
+            self.counter -= 1
+            raise OverflowError('All query IDs are in use.')
+
+        self.counter -= 1
+        while True:
+            self.counter += 1
+            if self.counter > self.max_id:
+                self.counter = 1
+                self.wrapped = True
+
+            ask = b'%d' % self.counter
+            if ask not in self._queries:
+                return ask
+
+    def pop(self, ask):
+        """ Remove and return the (future, command, start) entry for this ID, or None. """
+        return self._queries.pop(ask, None)
+
+    def is_late(self, ask):
+        """
+        True when an answer to an unknown ID can be a late answer to a call
+        that we stopped waiting for. (Otherwise, we never sent this ID.)
+        """
+        return self.wrapped or int(ask) <= self.counter
+
+    def fail_all(self, exception_factory):
+        """
+        Set an exception, created by calling `exception_factory`, on all the
+        calls, and forget about them.
+        """
+        queries, self._queries = self._queries, _ordered_dict()
+
+        for future, command, start in queries.values():
+            if not future.done():
+                future.set_exception(exception_factory())
+
+    def oldest(self, count=10):
+        """
+        Return (id, command, age in seconds) for the `count` oldest calls,
+        oldest first.
+        """
+        now = time.monotonic()
+        return [(int(ask), command, now - start)
+                for ask, (future, command, start) in itertools.islice(self._queries.items(), count)]
@@ -0,0 +1,259 @@
+"""
+Recording of the boxes that protocols send and receive, and a load generator
+that replays the recorded calls against a server.
+
+A capture file starts with `MAGIC`, followed by one record per box: the time
+in seconds since the recorder was created (a double), the connection number
+(uint32), the direction (byte: 0 for received, 1 for sent) and the length of
+the encoded box (uint32), all big-endian, and then the encoded box itself.
+
+::
+
+    python -m asyncio_amp.recording replay capture.amp --port 8000 --connections 4
+    python -m asyncio_amp.recording replay capture.amp --port 8000 --speed 1
+"""
+import argparse
+import asyncio
+import itertools
+import struct
+import time
+
+from .codec import decode_box
+from .compression import decompress_packet
+from .exceptions import RemoteAmpError
+from .protocol import AMPProtocol, Command
+
+__all__ = ('TrafficRecorder', 'read_capture', 'replay_capture', )
+
+
+MAGIC = b'AMPCAP1\n'
+
+RECEIVED = 0
+SENT = 1
+
+_record_header = struct.Struct('!dIBI')
+
+# The reserved keys of a call that are sent again. (Others, like '_timeout'
+# and '_compressed', applied to the recorded connection only.)
+_REPLAYED_KEYS = ('_command', '_ask', '_batch')
+
+
+class TrafficRecorder:
+    """
+    Writes the boxes of protocols to a capture file. Assign an instance to
+    the `recorder` attribute of a protocol class to record all its
+    connections.
+
+    ::
+
+        class MyProtocol(asyncio_amp.AMPProtocol):
+            recorder = asyncio_amp.TrafficRecorder('capture.amp')
+
+    The boxes are written as they are on the wire, through a buffer of
+    `buffer_size` bytes. Call `close()` to flush it.
+    """
+    def __init__(self, path, buffer_size=0x100000):
+        self._file = open(path, 'wb', buffering=buffer_size)
+        self._file.write(MAGIC)
+        self._start = time.perf_counter()
+        self._connections = itertools.count()
+        self.records = 0
+
+    def new_connection(self):
+        """ Return the number under which a connection is recorded. """
+        return next(self._connections)
+
+    def received(self, connection, data):
+        """ Write an encoded box that has been received. """
+        self._record(connection, RECEIVED, data)
+
+    def sent(self, connection, data):
+        """ Write encoded data that has been sent. (One box.) """
+        self._record(connection, SENT, data)
+
+    def _record(self, connection, direction, data):
+        self._file.write(_record_header.pack(time.perf_counter() - self._start, connection, direction, len(data)))
+        self._file.write(data)
+        self.records += 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    Read a capture file. Yields (time, connection, direction, packet)
+    tuples, where `packet` is the decoded box.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a capture file: %r' % path)
+
+        while True:
+            header = f.read(_record_header.size)
+            if not header:
+                break
+            if len(header) < _record_header.size:
+                raise ValueError('Truncated capture file: %r' % path)
+
+            timestamp, connection, direction, length = _record_header.unpack(header)
+            yield timestamp, connection, direction, decode_box(f.read(length))
+
+
+def _replayed_packet(packet):
+    """ Return a copy of a recorded call, to send it again. """
+    packet = dict(packet)
+    if '_compressed' in packet:
+        decompress_packet(packet)
+
+    for key in [key for key in packet if key.startswith('_') and key not in _REPLAYED_KEYS]:
+        del packet[key]
+    return packet
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.))]
+
+
+@asyncio.coroutine
+def replay_capture(host, port, records, connections=1, speed=None, max_in_flight=100,
+                   direction=RECEIVED, protocol_factory=AMPProtocol):
+    """
+    Send the calls of a capture again to a server, spread over `connections`
+    connections. `records` are the tuples from `read_capture`; the boxes with
+    a '_command' in the given `direction` are sent. (RECEIVED for a capture
+    of the server, SENT for a capture of a client.)
+
+    With `speed`, the calls are sent at the recorded pace (1.0), or faster
+    or slower. Without, they are sent as fast as possible, with up to
+    `max_in_flight` calls waiting for an answer per connection.
+
+    Returns a dict with the total 'duration', and the 'calls', 'errors',
+    'calls_per_sec' and latency percentiles in seconds of every command, by
+    name, under 'commands'.
+
+    (Values that were sent through shared memory or as a `Stream` can't be
+    replayed.)
+    """
+    loop = asyncio.get_event_loop()
+    records = [r for r in records if r[2] == direction and '_command' in r[3]]
+
+    protocols = []
+    for i in range(connections):
+        transport, protocol = yield from loop.create_connection(protocol_factory, host, port)
+        protocols.append(protocol)
+    slots = [asyncio.Semaphore(max_in_flight) for p in protocols]
+
+    latencies = { }
+    errors = { }
+    tasks = []
+
+    # The calls are sent as they were recorded, so we don't need the real
+    # `Command` classes. These stand-ins only carry the names.
+    commands = { }
+
+    @asyncio.coroutine
+    def send(protocol, slot, packet):
+        name = packet['_command'].decode('utf-8')
+        if name not in commands:
+            commands[name] = type(Command)(name, (Command, ), { })
+            latencies[name] = []
+            errors[name] = 0
+
+        try:
+            yield from protocol._drain()
+
+            if '_ask' not in packet:
+                protocol._send_packet(packet)
+                return
+
+            future = asyncio.Future()
+            packet['_ask'] = protocol._queries.add(commands[name], future)
+            start = time.perf_counter()
+            protocol._send_packet(packet)
+
+            try:
+                yield from future
+            except RemoteAmpError:
+                errors[name] += 1
+            latencies[name].append(time.perf_counter() - start)
+        finally:
+            slot.release()
+
+    start = time.perf_counter()
+    first = records[0][0] if records else 0
+
+    for i, (timestamp, connection, direction, packet) in enumerate(records):
+        if speed is not None:
+            delay = (timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                yield from asyncio.sleep(delay)
+
+        n = i % len(protocols)
+        yield from slots[n].acquire()
+        tasks.append(asyncio.Task(send(protocols[n], slots[n], _replayed_packet(packet))))
+
+    if tasks:
+        yield from asyncio.wait(tasks)
+    duration = time.perf_counter() - start
+
+    for protocol in protocols:
+        protocol.transport.close()
+    for task in tasks:
+        task.result()
+
+    report = { }
+    for command, values in latencies.items():
+        values.sort()
+        calls = len(values) or sum(1 for r in records if r[3]['_command'].decode('utf-8') == command)
+        report[command] = {
+            'calls': calls,
+            'errors': errors[command],
+            'calls_per_sec': calls / duration,
+        }
+        if values:
+            report[command].update({
+                'p50': _percentile(values, 50),
+                'p90': _percentile(values, 90),
+                'p99': _percentile(values, 99),
+                'max': values[-1],
+            })
+
+    return { 'duration': duration, 'commands': report }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m asyncio_amp.recording',
+                                     description='Replay the calls of a capture file against a server.')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    replay = subparsers.add_parser('replay')
+    replay.add_argument('capture')
+    replay.add_argument('--host', default='localhost')
+    replay.add_argument('--port', type=int, default=8000)
+    replay.add_argument('--connections', type=int, default=1)
+    replay.add_argument('--speed', type=float, default=None,
+                        help='1 for the recorded pace. (Default: as fast as possible.)')
+    replay.add_argument('--max-in-flight', type=int, default=100)
+    replay.add_argument('--sent', action='store_true',
+                        help='Replay the sent calls (of a client capture) instead of the received ones.')
+    args = parser.parse_args(args)
+
+    result = asyncio.get_event_loop().run_until_complete(replay_capture(
+            args.host, args.port, read_capture(args.capture), connections=args.connections,
+            speed=args.speed, max_in_flight=args.max_in_flight,
+            direction=SENT if args.sent else RECEIVED))
+
+    print('%-32s %8s %8s %10s %10s %10s %10s %10s' % (
+            'command', 'calls', 'errors', 'calls/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for command, stats in sorted(result['commands'].items()):
+        print('%-32s %8i %8i %10.1f %s' % (
+                command, stats['calls'], stats['errors'], stats['calls_per_sec'],
+                ' '.join('%10.3f' % (stats[p] * 1000) if p in stats else '%10s' % '-'
+                         for p in ('p50', 'p90', 'p99', 'max'))))
+    print('Duration: %.3fs' % result['duration'])
+
+
+if __name__ == '__main__':
+    main()
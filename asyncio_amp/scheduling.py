@@ -0,0 +1,40 @@
+from collections import deque
+
+__all__ = ('ResponderSlots', )
+
+
+class ResponderSlots:
+    """
+    Limit the amount of responders that can run at the same time, over all
+    the protocols that share this object. Assign an instance to the
+    `responder_slots` attribute of an `AMPProtocol` subclass to apply a
+    limit to the whole server.
+
+    Protocols that have to wait for a slot are served in FIFO order, so that
+    one busy connection can't starve the others.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = deque()
+
+    def acquire(self, callback):
+        """
+        Take a slot and return True when one is available. Otherwise, return
+        False and call `callback` (without arguments) as soon as a slot has
+        been released.
+        """
+        if self.in_use < self.limit:
+            self.in_use += 1
+            return True
+
+        if callback not in self._waiters:
+            self._waiters.append(callback)
+        return False
+
+    def release(self):
+        self.in_use -= 1
+
+        # Wake up waiters, until one of them takes the slot.
+        while self._waiters and self.in_use < self.limit:
+            self._waiters.popleft()()
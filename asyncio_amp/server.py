@@ -0,0 +1,296 @@
+"""
+Server that runs the event loop in several worker processes, to use more
+than one CPU core. (Unix only, because it uses fork.)
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import traceback
+
+from .metrics import GAUGES, merge_snapshots
+
+__all__ = ('MultiProcessServer', )
+
+
+class MultiProcessServer:
+    """
+    Fork `workers` processes that accept the connections of one listening
+    socket, each running `loop.create_server(protocol_factory, ...)` on its
+    own event loop.
+
+    By default, the socket is created once and inherited by the workers.
+    With `reuse_port`, every worker creates its own socket with SO_REUSEPORT,
+    and the kernel spreads the connections over them.
+
+    ::
+
+        server = MultiProcessServer(MyProtocol, 'localhost', 8000, workers=4)
+        server.run()
+
+    `run` blocks until SIGTERM or SIGINT. SIGHUP does a graceful restart:
+    new workers are started and the old ones are drained. When draining, a
+    worker stops accepting connections and waits up to `drain_timeout`
+    seconds for its clients to disconnect, before closing the rest.
+
+    When `protocol_factory` has a `Metrics` instance as `metrics` attribute,
+    every worker reports it to the master every `metrics_interval` seconds.
+    `metrics()` returns the merged snapshot.
+    """
+    def __init__(self, protocol_factory, host, port, workers=None, reuse_port=False,
+                 backlog=100, drain_timeout=10., metrics_interval=1.):
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported on this platform.')
+
+        self.protocol_factory = protocol_factory
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.drain_timeout = drain_timeout
+        self.metrics_interval = metrics_interval
+
+        self._socket = None
+        self._pids = set() # Workers of the current generation.
+        self._old_pids = set() # Workers that are being drained.
+        self._metrics_dir = None
+        self._final_metrics = None
+        self._stopping = False
+
+    @property
+    def pids(self):
+        """ The process IDs of the current workers. """
+        return set(self._pids)
+
+    def _create_socket(self):
+        family, type, proto, canonname, address = socket.getaddrinfo(
+                self.host, self.port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+
+        sock = socket.socket(family, type, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def start(self):
+        """ Create the socket and fork the workers. Returns immediately. """
+        self._metrics_dir = tempfile.mkdtemp(prefix='asyncio-amp-metrics-')
+        if not self.reuse_port:
+            self._socket = self._create_socket()
+
+        for i in range(self.workers):
+            self._pids.add(self._spawn())
+
+    def restart(self):
+        """
+        Graceful restart: start a new generation of workers, and drain the
+        old ones.
+        """
+        old_pids = self._pids
+        self._pids = set()
+
+        for i in range(self.workers):
+            self._pids.add(self._spawn())
+
+        for pid in old_pids:
+            self._kill(pid)
+        self._old_pids |= old_pids
+
+    def stop(self):
+        """ Drain all workers, wait until they have exited, and clean up. """
+        self._stopping = True
+
+        for pid in self._pids | self._old_pids:
+            self._kill(pid)
+
+        for pid in self._pids | self._old_pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self._pids = set()
+        self._old_pids = set()
+
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+        if self._metrics_dir is not None:
+            self._final_metrics = self.metrics()
+            shutil.rmtree(self._metrics_dir, ignore_errors=True)
+            self._metrics_dir = None
+
+    @staticmethod
+    def _kill(pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self):
+        """ Collect exited workers, and replace the ones that crashed. """
+        for pid in list(self._pids | self._old_pids):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+
+            if done:
+                self._old_pids.discard(pid)
+                if pid in self._pids:
+                    self._pids.remove(pid)
+                    if not self._stopping:
+                        self._pids.add(self._spawn())
+
+    def run(self):
+        """
+        Start the workers and block until SIGTERM or SIGINT. Then drain the
+        workers and return.
+        """
+        loop = asyncio.get_event_loop()
+        events = []
+        wakeup = asyncio.Future()
+
+        def notify(event):
+            events.append(event)
+            if not wakeup.done():
+                wakeup.set_result(None)
+
+        self.start()
+        loop.add_signal_handler(signal.SIGTERM, notify, 'stop')
+        loop.add_signal_handler(signal.SIGINT, notify, 'stop')
+        loop.add_signal_handler(signal.SIGHUP, notify, 'restart')
+
+        # (The workers are forked while the loop is not running, so that
+        # they can start their own.)
+        try:
+            while 'stop' not in events:
+                if 'restart' in events:
+                    events[:] = [e for e in events if e != 'restart']
+                    self.restart()
+                self._reap()
+
+                wakeup = asyncio.Future()
+                loop.run_until_complete(asyncio.wait([wakeup], timeout=1))
+        finally:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                loop.remove_signal_handler(signum)
+            self.stop()
+
+    def metrics(self):
+        """
+        Merged snapshot of the metrics of all workers, including the workers
+        that have exited already. (None when the protocol has no metrics.)
+        """
+        if self._metrics_dir is None:
+            return self._final_metrics
+
+        live = self._pids | self._old_pids
+        snapshots = []
+        for filename in os.listdir(self._metrics_dir):
+            if filename.endswith('.json'):
+                try:
+                    with open(os.path.join(self._metrics_dir, filename)) as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+                # The last snapshot of a worker that exited (or crashed)
+                # still has the calls that were in flight back then.
+                if int(filename[:-len('.json')]) not in live:
+                    for key in GAUGES:
+                        snapshot[key] = 0
+                snapshots.append(snapshot)
+
+        return merge_snapshots(snapshots) if snapshots else None
+
+    def _spawn(self):
+        """ Fork a worker. Returns the PID in the master process. """
+        pid = os.fork()
+        if pid:
+            return pid
+
+        # In the worker: never return into the code of the master.
+        status = 1
+        try:
+            self._run_worker()
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def _run_worker(self):
+        # The master handles these.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        sock = self._create_socket() if self.reuse_port else self._socket
+        protocols = []
+
+        def factory():
+            # (Forget about the connections that have been closed.)
+            protocols[:] = [p for p in protocols if getattr(p, 'transport', None) is not None]
+
+            protocol = self.protocol_factory()
+            protocols.append(protocol)
+            return protocol
+
+        server = loop.run_until_complete(loop.create_server(factory, sock=sock))
+
+        stopping = asyncio.Future()
+        def stop():
+            if not stopping.done():
+                stopping.set_result(None)
+        loop.add_signal_handler(signal.SIGTERM, stop)
+
+        metrics = getattr(self.protocol_factory, 'metrics', None)
+        if metrics is not None:
+            def report():
+                self._write_metrics(metrics)
+                loop.call_later(self.metrics_interval, report)
+            loop.call_later(self.metrics_interval, report)
+
+        loop.run_until_complete(stopping)
+        loop.run_until_complete(self._drain(server, protocols))
+
+        if metrics is not None:
+            self._write_metrics(metrics)
+        loop.close()
+
+    @asyncio.coroutine
+    def _drain(self, server, protocols):
+        """
+        Stop accepting connections, and wait for the clients to disconnect.
+        """
+        server.close()
+        deadline = asyncio.get_event_loop().time() + self.drain_timeout
+
+        while asyncio.get_event_loop().time() < deadline:
+            if all(getattr(p, 'transport', None) is None for p in protocols):
+                break
+            yield from asyncio.sleep(.1)
+
+        for protocol in protocols:
+            if getattr(protocol, 'transport', None) is not None:
+                protocol.transport.close()
+
+        # Let the transports call connection_lost.
+        yield from asyncio.sleep(0)
+
+    def _write_metrics(self, metrics):
+        path = os.path.join(self._metrics_dir, '%i.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(metrics.snapshot(), f)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,137 @@
+"""
+Shared memory for large values between two protocols on the same host.
+
+The sending side creates a directory in `SHARED_MEMORY_DIR` (/dev/shm,
+when it exists) for every connection, and writes every large value to a new
+file in there. Only the file name is sent. The receiving side maps the file
+and removes it, so the value doesn't have to go through the socket, and is
+not copied on arrival.
+
+When the connection is made, the sender writes a random token to a probe
+file, and the receiver checks that it can read the same token from there.
+That way, shared memory is only used when both sides really see the same
+files.
+"""
+import atexit
+import binascii
+import mmap
+import os
+import re
+import shutil
+import stat
+import tempfile
+import weakref
+
+__all__ = ('SharedMemorySegments', )
+
+
+if os.path.isdir('/dev/shm'):
+    SHARED_MEMORY_DIR = '/dev/shm'
+else:
+    SHARED_MEMORY_DIR = tempfile.gettempdir()
+
+# (We compare the owner of the directories with our own user ID.)
+AVAILABLE = hasattr(os, 'getuid')
+
+_PREFIX = 'asyncio-amp-'
+_DIRECTORY_NAME = re.compile(r'^%s[a-z0-9_]+$' % re.escape(_PREFIX))
+_PROBE = 'probe'
+
+# The directories of this process, that have to be removed at exit, if the
+# connections are still open.
+_open_segments = weakref.WeakSet()
+
+
+class SharedMemorySegments:
+    """
+    The directory in which one protocol writes the values that it sends.
+    """
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix=_PREFIX, dir=SHARED_MEMORY_DIR)
+        self.token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self._counter = 0
+
+        with open(os.path.join(self.directory, _PROBE), 'w') as f:
+            f.write(self.token)
+        _open_segments.add(self)
+
+    def write(self, data):
+        """ Write a value to a new file. Returns the file name, as bytes. """
+        self._counter += 1
+        name = str(self._counter)
+
+        with open(os.path.join(self.directory, name), 'xb') as f:
+            f.write(data)
+        return name.encode('ascii')
+
+    def close(self):
+        """ Remove the directory, including the values that were not read. """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        _open_segments.discard(self)
+
+
+@atexit.register
+def _close_all():
+    for segments in list(_open_segments):
+        segments.close()
+
+
+def check_directory(directory, token):
+    """
+    True when `directory` is a directory of `SharedMemorySegments`, owned by
+    our user, that contains the probe with this token.
+    """
+    if (os.path.dirname(directory) != SHARED_MEMORY_DIR or
+            not _DIRECTORY_NAME.match(os.path.basename(directory))):
+        return False
+
+    try:
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            return False
+
+        with open(os.path.join(directory, _PROBE)) as f:
+            return f.read() == token
+    except OSError:
+        return False
+
+
+def _segment_path(directory, name):
+    name = name.decode('ascii')
+    if not name.isdigit():
+        raise ValueError('Invalid shared memory segment: %r' % name)
+    return os.path.join(directory, name)
+
+
+def open_segment(directory, name):
+    """
+    Map a value that has been written to `directory`, and remove the file.
+    Returns a read-only memoryview.
+    """
+    path = _segment_path(directory, name)
+    with open(path, 'rb') as f:
+        # (An empty file can't be mapped.)
+        if os.fstat(f.fileno()).st_size == 0:
+            data = memoryview(b'')
+        else:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    # The mapping stays valid after removing the file. (Where it's not
+    # possible to remove a mapped file, the sender removes it when the
+    # connection is closed.)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    return data
+
+
+def remove_segment(directory, name):
+    """
+    Remove a value that won't be read. (Invalid names, and values that have
+    been removed already, are ignored.)
+    """
+    try:
+        os.unlink(_segment_path(directory, name))
+    except (ValueError, OSError):
+        pass
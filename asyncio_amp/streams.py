@@ -0,0 +1,97 @@
+import asyncio
+from collections import deque
+
+__all__ = ('StreamReader', )
+
+
+class StreamReader:
+    """
+    Receiving end of a `Stream` argument.
+
+    ::
+
+        while True:
+            chunk = yield from reader.read()
+            if not chunk:
+                break
+            ...
+
+    When more than `limit` bytes are waiting to be read, the protocol stops
+    reading from its transport, until the chunks have been consumed.
+    """
+    def __init__(self, protocol, limit):
+        self._protocol = protocol
+        self._limit = limit
+        self._chunks = deque()
+        self._size = 0
+        self._eof = False
+        self._exception = None
+        self._closed = False
+        self._waiter = None
+        self._claimed = False
+
+    @property
+    def finished(self):
+        """ True when the end of the stream (or an error) has been received. """
+        return self._eof or self._exception is not None
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        self._waiter = None
+
+    def feed_chunk(self, chunk):
+        if self._closed:
+            return
+
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        self._wakeup()
+
+        if self._size > self._limit:
+            self._protocol._pause_reading(self)
+
+    def feed_eof(self):
+        self._eof = True
+        self._wakeup()
+
+    def set_exception(self, exc):
+        self._exception = exc
+        self._wakeup()
+
+    @asyncio.coroutine
+    def read(self):
+        """ Return the next chunk, or b'' at the end of the stream. """
+        while not self._chunks:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof or self._closed:
+                return b''
+
+            self._waiter = asyncio.Future()
+            yield from self._waiter
+
+        chunk = self._chunks.popleft()
+        self._size -= len(chunk)
+
+        if self._size <= self._limit:
+            self._protocol._resume_reading(self)
+        return chunk
+
+    @asyncio.coroutine
+    def read_all(self):
+        """ Read until the end of the stream, and return everything. """
+        chunks = []
+        while True:
+            chunk = yield from self.read()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def close(self):
+        """ Discard the rest of the stream. """
+        self._closed = True
+        self._chunks.clear()
+        self._size = 0
+        self._protocol._resume_reading(self)
+        self._wakeup()
@@ -0,0 +1,31 @@
+"""
+Benchmark suite for asyncio_amp. Everything runs locally: the end-to-end
+benchmarks use loopback TCP and Unix sockets.
+
+::
+
+    python -m benchmarks                            # Run everything.
+    python -m benchmarks parser echo                # Run some of them.
+    python -m benchmarks -o after.json              # Save the results.
+    python -m benchmarks.compare before.json after.json
+    python -m benchmarks.parser                     # Run one, directly.
+
+Every module has a `run()` function that returns a list of results: dicts
+with a 'case' name and the measured numbers.
+"""
+
+# In the order in which they are run.
+NAMES = ('codec', 'parser', 'arguments', 'compression', 'queries', 'responders', 'batch', 'cache',
+         'echo', 'recording', 'sharedmemory', 'memory', 'multiprocess')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.4g' % value
+    return str(value)
+
+
+def print_results(name, results):
+    for result in results:
+        print('%-12s %-36s %s' % (name, result['case'], '  '.join(
+            '%s=%s' % (k, format_value(v)) for k, v in sorted(result.items()) if k != 'case')))
@@ -0,0 +1,44 @@
+"""
+Run the benchmarks, print the results, and optionally write them as JSON.
+"""
+import argparse
+import datetime
+import importlib
+import json
+import platform
+import sys
+
+from asyncio_amp import codec
+from benchmarks import NAMES, print_results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument('names', nargs='*', metavar='name', help='one of: %s' % ', '.join(NAMES))
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in NAMES:
+            parser.error('Unknown benchmark: %r' % name)
+
+    output = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'speedups': codec.has_speedups,
+        'results': { },
+    }
+
+    for name in args.names or NAMES:
+        results = importlib.import_module('benchmarks.' + name).run()
+        print_results(name, results)
+        output['results'][name] = results
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Microbenchmark for encoding and decoding each `Argument` type. Compares the
+text based `Integer` and `Float` with the fixed-width `Int32`, `Int64` and
+`Double`, and a list of 1000 numbers as `ListOf` versus `PackedArray`.
+"""
+import time
+
+from asyncio_amp import (
+    AmpList, Boolean, Bytes, Double, Float, Int32, Int64, Integer, ListOf,
+    PackedArray, String,
+)
+
+COUNT = 200000
+LIST = list(range(-500, 500))
+
+
+def bench(argument, value, count):
+    encode, decode = argument.encode, argument.decode
+
+    start = time.perf_counter()
+    for i in range(count):
+        data = encode(value)
+    encode_time = (time.perf_counter() - start) / count
+
+    data = bytes(data)
+    start = time.perf_counter()
+    for i in range(count):
+        decode(data)
+    decode_time = (time.perf_counter() - start) / count
+
+    return len(data), encode_time, decode_time
+
+
+def run():
+    cases = [
+        ('Integer', Integer(), 1234567890, COUNT),
+        ('Int32', Int32(), 1234567890, COUNT),
+        ('Int64', Int64(), 1234567890, COUNT),
+        ('Float', Float(), 3.14159265358979, COUNT),
+        ('Double', Double(), 3.14159265358979, COUNT),
+        ('Boolean', Boolean(), True, COUNT),
+        ('Bytes', Bytes(), b'Hello world', COUNT),
+        ('String', String(), 'Hello world', COUNT),
+        ('ListOf(Integer)', ListOf(Integer()), LIST, COUNT // 200),
+        ('ListOf(Int32)', ListOf(Int32()), LIST, COUNT // 200),
+        ("PackedArray('i')", PackedArray('i'), LIST, COUNT // 200),
+        ("PackedArray('q')", PackedArray('q'), LIST, COUNT // 200),
+        ('AmpList', AmpList([('key', Integer()), ('value', String())]),
+                [{ 'key': i, 'value': 'value' } for i in range(100)], COUNT // 200),
+    ]
+
+    results = []
+    for name, argument, value, count in cases:
+        size, encode_time, decode_time = bench(argument, value, count)
+        results.append({
+            'case': name,
+            'bytes': size,
+            'encode_us': encode_time * 1e6,
+            'decode_us': decode_time * 1e6,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('arguments', run())
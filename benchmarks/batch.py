@@ -0,0 +1,61 @@
+"""
+Benchmark for 10000 lookups over a local connection: one `call_remote` per
+lookup, versus `call_remote_many` with a normal responder and with a batch
+responder.
+"""
+import asyncio
+import time
+
+from asyncio_amp import AMPProtocol, Command, Integer
+
+COUNT = 10000
+
+
+class LookupCommand(Command):
+    arguments = [('key', Integer())]
+    response = [('value', Integer())]
+
+
+class ServerProtocol(AMPProtocol):
+    @LookupCommand.responder
+    def lookup(self, key):
+        return { 'value': key * 2 }
+
+
+class BatchServerProtocol(AMPProtocol):
+    @LookupCommand.batch_responder
+    def lookup_many(self, key):
+        return [{ 'value': k * 2 } for k in key]
+
+
+@asyncio.coroutine
+def bench(server_class, batch):
+    loop = asyncio.get_event_loop()
+    server = yield from loop.create_server(server_class, 'localhost', 8000)
+    transport, protocol = yield from loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+    start = time.perf_counter()
+    if batch:
+        yield from protocol.call_remote_many(LookupCommand, [{ 'key': i } for i in range(COUNT)])
+    else:
+        yield from asyncio.gather(*[protocol.call_remote(LookupCommand, key=i) for i in range(COUNT)])
+    duration = time.perf_counter() - start
+
+    transport.close()
+    server.close()
+    yield from server.wait_closed()
+    return COUNT / duration
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    return [{ 'case': name, 'calls_per_sec': loop.run_until_complete(bench(server_class, batch)) }
+            for name, server_class, batch in [
+                ('call_remote', ServerProtocol, False),
+                ('call_remote_many', ServerProtocol, True),
+                ('batch_responder', BatchServerProtocol, True)]]
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('batch', run())
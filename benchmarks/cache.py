@@ -0,0 +1,56 @@
+"""
+Benchmark for 10000 lookups of 100 distinct keys over a local connection,
+with a responder that decodes a larger answer: without a response cache,
+and with a `ResponseCache`. (The cache answers 99% of the calls.)
+"""
+import asyncio
+import time
+
+from asyncio_amp import AMPProtocol, Command, ListOf, ResponseCache, String
+
+COUNT = 10000
+
+
+class LookupCommand(Command):
+    arguments = [('key', String())]
+    response = [('values', ListOf(String()))]
+    cacheable = True
+
+
+class ServerProtocol(AMPProtocol):
+    @LookupCommand.responder
+    def lookup(self, key):
+        return { 'values': [key * 10] * 20 }
+
+
+class CachingServerProtocol(ServerProtocol):
+    response_cache = ResponseCache()
+
+
+@asyncio.coroutine
+def bench(server_class):
+    loop = asyncio.get_event_loop()
+    server = yield from loop.create_server(server_class, 'localhost', 8000)
+    transport, protocol = yield from loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+    start = time.perf_counter()
+    yield from asyncio.gather(*[protocol.call_remote(LookupCommand, key=str(i % 100)) for i in range(COUNT)])
+    duration = time.perf_counter() - start
+
+    transport.close()
+    server.close()
+    yield from server.wait_closed()
+    return COUNT / duration
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    return [{ 'case': name, 'calls_per_sec': loop.run_until_complete(bench(server_class)) }
+            for name, server_class in [
+                ('no_cache', ServerProtocol),
+                ('response_cache', CachingServerProtocol)]]
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('cache', run())
@@ -0,0 +1,51 @@
+"""
+Microbenchmark for encoding and decoding AMP boxes, comparing the pure
+Python codec with the C speedups (if they have been compiled), and
+`AMPProtocol._encode_packet`.
+"""
+import time
+
+from asyncio_amp import AMPProtocol, codec
+
+PACKET = { '_command': b'EchoCommand', '_ask': b'12345', 'text': b'Hello world', 'times': b'4' }
+COUNT = 200000
+
+
+def bench_encode(encode_box):
+    start = time.perf_counter()
+    for i in range(COUNT):
+        encode_box(PACKET)
+    return COUNT / (time.perf_counter() - start)
+
+
+def bench_scan(scan_boxes):
+    data = codec._py_encode_box(PACKET) * COUNT
+
+    start = time.perf_counter()
+    packets = scan_boxes(data, 0, { }, None)[0]
+    duration = time.perf_counter() - start
+
+    assert len(packets) == COUNT
+    return COUNT / duration
+
+
+def run():
+    implementations = [('python', codec._py_encode_box, codec._py_scan_boxes)]
+    if codec.has_speedups:
+        implementations.append(('C', codec.encode_box, codec.scan_boxes))
+
+    results = []
+    for name, encode_box, scan_boxes in implementations:
+        results.append({ 'case': '%s encode' % name, 'packets_per_sec': bench_encode(encode_box) })
+        results.append({ 'case': '%s decode' % name, 'packets_per_sec': bench_scan(scan_boxes) })
+
+    results.append({ 'case': '_encode_packet', 'packets_per_sec': bench_encode(AMPProtocol._encode_packet) })
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+
+    if not codec.has_speedups:
+        print('C speedups not available. (Run "setup.py build_ext --inplace".)')
+    print_results('codec', run())
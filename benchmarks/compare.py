@@ -0,0 +1,42 @@
+"""
+Compare two JSON files written by `python -m benchmarks -o`. Prints every
+number of the cases that are in both files, and the change in percent.
+"""
+import argparse
+import json
+
+from benchmarks import format_value
+
+
+def compare(before, after):
+    """ Yield (benchmark, case, key, old value, new value) tuples. """
+    for name, results in sorted(after['results'].items()):
+        old_results = { r['case']: r for r in before['results'].get(name, []) }
+
+        for result in results:
+            old = old_results.get(result['case'])
+            if old is not None:
+                for key, value in sorted(result.items()):
+                    if key != 'case' and key in old:
+                        yield name, result['case'], key, old[key], value
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.compare', description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    for name, case, key, old, new in compare(before, after):
+        change = '%+.1f%%' % ((new - old) * 100. / old) if old else '-'
+        print('%-12s %-36s %-16s %10s %10s %8s' % (
+            name, case, key, format_value(old), format_value(new), change))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Bytes on the wire and encode/decode time of a call with JSON-like values of
+different sizes, for each compression algorithm and threshold.
+"""
+import json
+import time
+
+from asyncio_amp import AMPProtocol, Command, String, COMPRESSORS
+from asyncio_amp.compression import decompress_packet
+from asyncio_amp.codec import BoxParser
+
+SIZES = (200, 2000, 20000, 60000)
+THRESHOLDS = (256, 1024, 8192)
+COUNT = 200
+
+
+class StoreCommand(Command):
+    arguments = [
+        ('key', String()),
+        ('document', String()),
+    ]
+
+
+def make_document(size):
+    record = json.dumps({ 'id': 12345, 'name': 'example', 'tags': ['a', 'b', 'c'], 'active': True })
+    return ((record + ', ') * (size // len(record) + 1))[:size]
+
+
+def bench(algorithm, threshold, document):
+    protocol = AMPProtocol()
+    protocol.compression_threshold = threshold
+    if algorithm:
+        protocol._activate_compression(algorithm)
+
+    values = { 'key': 'documents/1', 'document': document }
+    parser = BoxParser()
+
+    start = time.perf_counter()
+    for i in range(COUNT):
+        data = StoreCommand._encode_arguments(values, b'\0\0', protocol)
+    encode_time = (time.perf_counter() - start) / COUNT
+
+    start = time.perf_counter()
+    for i in range(COUNT):
+        packet = parser.feed(data)[0]
+        if '_compressed' in packet:
+            decompress_packet(packet)
+        StoreCommand._decode_arguments(packet)
+    decode_time = (time.perf_counter() - start) / COUNT
+
+    return len(data), encode_time, decode_time
+
+
+def run():
+    results = []
+    for size in SIZES:
+        document = make_document(size)
+        for algorithm in [None] + sorted(COMPRESSORS):
+            for threshold in (THRESHOLDS if algorithm else (None, )):
+                wire, encode_time, decode_time = bench(algorithm, threshold, document)
+                results.append({
+                    'case': '%s threshold=%s size=%i' % (algorithm or 'none', threshold or '-', size),
+                    'wire_bytes': wire,
+                    'encode_us': encode_time * 1e6,
+                    'decode_us': decode_time * 1e6,
+                })
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('compression', run())
@@ -0,0 +1,101 @@
+"""
+End-to-end echo benchmark over loopback TCP and a Unix socket. Measures the
+throughput and the p50/p99 latency of `call_remote`, for different amounts
+of concurrent calls and payload sizes. (Client and server share one event
+loop.)
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from asyncio_amp import AMPProtocol, Command, Bytes
+
+TRANSPORTS = ('tcp', 'unix')
+CONCURRENCY = (1, 10, 100)
+SIZES = (10, 1000, 30000)
+CALLS = 5000
+
+
+class EchoCommand(Command):
+    arguments = [('data', Bytes())]
+    response = [('data', Bytes())]
+
+
+class EchoProtocol(AMPProtocol):
+    @EchoCommand.responder
+    def echo(self, data):
+        return { 'data': data }
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.))]
+
+
+@asyncio.coroutine
+def connect(transport_name, directory):
+    loop = asyncio.get_event_loop()
+
+    if transport_name == 'tcp':
+        server = yield from loop.create_server(EchoProtocol, 'localhost', 8000)
+        transport, protocol = yield from loop.create_connection(AMPProtocol, 'localhost', 8000)
+    else:
+        path = os.path.join(directory, 'amp.sock')
+        server = yield from loop.create_unix_server(EchoProtocol, path)
+        transport, protocol = yield from loop.create_unix_connection(AMPProtocol, path)
+
+    return server, transport, protocol
+
+
+@asyncio.coroutine
+def bench(transport_name, concurrency, size, directory):
+    server, transport, protocol = yield from connect(transport_name, directory)
+    payload = b'x' * size
+    latencies = []
+
+    @asyncio.coroutine
+    def caller(count):
+        for i in range(count):
+            start = time.perf_counter()
+            yield from protocol.call_remote(EchoCommand, data=payload)
+            latencies.append(time.perf_counter() - start)
+
+    # Warm up.
+    yield from caller(100)
+    del latencies[:]
+
+    start = time.perf_counter()
+    yield from asyncio.gather(*[caller(CALLS // concurrency) for i in range(concurrency)])
+    duration = time.perf_counter() - start
+
+    transport.close()
+    server.close()
+    yield from server.wait_closed()
+
+    latencies.sort()
+    return {
+        'case': '%s concurrency=%i size=%i' % (transport_name, concurrency, size),
+        'calls_per_sec': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    directory = tempfile.mkdtemp()
+
+    try:
+        return [loop.run_until_complete(bench(transport_name, concurrency, size, directory))
+                for transport_name in TRANSPORTS
+                if transport_name == 'tcp' or hasattr(loop, 'create_unix_server')
+                for concurrency in CONCURRENCY
+                for size in SIZES]
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('echo', run())
@@ -0,0 +1,90 @@
+"""
+Memory usage of a client that keeps calling a server that doesn't read.
+With a huge write buffer limit, everything ends up in the write buffer of
+the transport. With the default limits, `max_queries` or a small
+`write_buffer_high`, the callers wait instead.
+
+The peak is measured with tracemalloc, so it only counts memory allocated by
+Python.
+"""
+import asyncio
+import time
+import tracemalloc
+
+from asyncio_amp import AMPProtocol, Command, Bytes
+
+CALLS = 2000
+PAYLOAD = b'x' * 10000
+STALL = .5 # Seconds that the server doesn't read.
+
+
+class UploadCommand(Command):
+    arguments = [('data', Bytes())]
+    response = []
+
+
+class SlowServerProtocol(AMPProtocol):
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        transport.pause_reading()
+        asyncio.get_event_loop().call_later(STALL, transport.resume_reading)
+
+    @UploadCommand.responder
+    def upload(self, data):
+        return { }
+
+
+class HugeWriteBufferProtocol(AMPProtocol):
+    # (Practically no flow control.)
+    write_buffer_high = 0x10000000
+
+
+class DefaultProtocol(AMPProtocol):
+    pass
+
+
+class MaxQueriesProtocol(AMPProtocol):
+    max_queries = 100
+
+
+class SmallWriteBufferProtocol(AMPProtocol):
+    write_buffer_high = 0x4000
+    write_buffer_low = 0x1000
+
+
+@asyncio.coroutine
+def bench(client_class):
+    loop = asyncio.get_event_loop()
+    server = yield from loop.create_server(SlowServerProtocol, 'localhost', 8000)
+    transport, protocol = yield from loop.create_connection(client_class, 'localhost', 8000)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    yield from asyncio.gather(*[protocol.call_remote(UploadCommand, data=PAYLOAD) for i in range(CALLS)])
+
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    transport.close()
+    server.close()
+    yield from server.wait_closed()
+
+    return {
+        'case': client_class.__name__,
+        'peak_mb': peak / 2. ** 20,
+        'duration_sec': duration,
+    }
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    return [loop.run_until_complete(bench(client_class))
+            for client_class in (HugeWriteBufferProtocol, DefaultProtocol,
+                                 MaxQueriesProtocol, SmallWriteBufferProtocol)]
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('memory', run())
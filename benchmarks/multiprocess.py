@@ -0,0 +1,84 @@
+"""
+Throughput of a `MultiProcessServer` with 1 up to N worker processes. The
+responder does some CPU work, and the load comes from several client
+processes, so that the clients are not the bottleneck.
+"""
+import asyncio
+import multiprocessing
+import sys
+import time
+
+from asyncio_amp import AMPProtocol, Command, Integer, MultiProcessServer
+
+CLIENTS = 8
+CONNECTIONS = 4 # Per client process.
+CALLS = 2000 # Per connection.
+
+
+class WorkCommand(Command):
+    arguments = [('n', Integer())]
+    response = [('result', Integer())]
+
+
+class ServerProtocol(AMPProtocol):
+    @WorkCommand.responder
+    def work(self, n):
+        return { 'result': sum(i * i for i in range(n)) }
+
+
+def client(start_event, queue):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    @asyncio.coroutine
+    def connection():
+        transport, protocol = yield from loop.create_connection(AMPProtocol, 'localhost', 8000)
+        for i in range(CALLS // 100):
+            yield from asyncio.gather(*[protocol.call_remote(WorkCommand, n=200) for j in range(100)])
+        transport.close()
+
+    start_event.wait()
+    loop.run_until_complete(asyncio.gather(*[connection() for i in range(CONNECTIONS)]))
+    queue.put(None)
+
+
+def bench(workers):
+    server = MultiProcessServer(ServerProtocol, 'localhost', 8000, workers=workers, drain_timeout=1)
+    server.start()
+    time.sleep(.2)
+
+    try:
+        start_event = multiprocessing.Event()
+        queue = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(start_event, queue)) for i in range(CLIENTS)]
+        for c in clients:
+            c.start()
+
+        start = time.perf_counter()
+        start_event.set()
+        for c in clients:
+            queue.get()
+        duration = time.perf_counter() - start
+
+        for c in clients:
+            c.join()
+    finally:
+        server.stop()
+
+    return CLIENTS * CONNECTIONS * CALLS / duration
+
+
+def run(max_workers=None):
+    max_workers = max_workers or multiprocessing.cpu_count()
+
+    results = []
+    workers = 1
+    while workers <= max_workers:
+        results.append({ 'case': 'workers=%i' % workers, 'calls_per_sec': bench(workers) })
+        workers *= 2
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('multiprocess', run(int(sys.argv[1]) if len(sys.argv) > 1 else None))
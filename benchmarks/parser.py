@@ -0,0 +1,74 @@
+"""
+Microbenchmark for the AMP box parsers.
+
+Feeds a stream of encoded packets to each parser in chunks of 64KB (the size
+asyncio typically passes to `data_received`) and measures packets/sec for
+small, mixed, 16KB and near-64KB packets.
+"""
+import random
+import time
+
+from asyncio_amp import AMPProtocol, BoxParser, LegacyBoxParser, ZeroCopyBoxParser
+
+CHUNK_SIZE = 0x10000
+
+
+def small_packets(count):
+    return [{ '_command': b'EchoCommand', '_ask': str(i).encode('ascii'), 'text': b'hello' }
+            for i in range(count)]
+
+
+def mixed_packets(count):
+    r = random.Random(0)
+    return [{ '_command': b'EchoCommand', '_ask': str(i).encode('ascii'),
+              'text': b'x' * r.choice((0, 10, 100, 1000, 10000)) }
+            for i in range(count)]
+
+
+def medium_packets(count):
+    return [{ '_answer': str(i).encode('ascii'), 'text': b'x' * 0x4000 }
+            for i in range(count)]
+
+
+def big_packets(count):
+    return [{ '_answer': str(i).encode('ascii'), 'text': b'x' * 0xff00 }
+            for i in range(count)]
+
+
+def bench(parser_class, data, count):
+    chunks = [data[i:i+CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+    parser = parser_class()
+    received = 0
+
+    start = time.perf_counter()
+    for chunk in chunks:
+        received += len(parser.feed(chunk))
+    duration = time.perf_counter() - start
+
+    assert received == count
+    return count / duration
+
+
+def run():
+    workloads = [
+        ('small', small_packets, 100000),
+        ('mixed', mixed_packets, 20000),
+        ('16KB', medium_packets, 2000),
+        ('near-64KB', big_packets, 500),
+    ]
+
+    results = []
+    for name, factory, count in workloads:
+        data = b''.join(AMPProtocol._encode_packet(p) for p in factory(count))
+
+        for parser_class in (BoxParser, LegacyBoxParser, ZeroCopyBoxParser):
+            results.append({
+                'case': '%s %s' % (name, parser_class.__name__),
+                'packets_per_sec': bench(parser_class, data, count),
+            })
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('parser', run())
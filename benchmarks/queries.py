@@ -0,0 +1,110 @@
+"""
+Bookkeeping of calls in flight: allocating IDs, looking up answers and
+failing all calls at once, with one million calls outstanding. Compares the
+`QueryTable` with the plain dict of Futures by decoded ID that was used
+before.
+"""
+import asyncio
+import time
+
+from asyncio_amp import Command
+from asyncio_amp.queries import QueryTable
+
+COUNT = 1000000
+
+
+class EchoCommand(Command):
+    pass
+
+
+def bench_dict(futures):
+    queries = { }
+    counter = 0
+
+    start = time.perf_counter()
+    asks = []
+    for f in futures:
+        counter += 1
+        asks.append(str(counter).encode('ascii'))
+        queries[counter] = f
+    add_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ask in asks:
+        id = int(ask)
+        queries.get(id)
+        del queries[id]
+    answer_time = time.perf_counter() - start
+
+    # What connection_lost did.
+    for i, f in enumerate(futures):
+        queries[i] = f
+    start = time.perf_counter()
+    for f in queries.values():
+        if not f.done():
+            f.set_exception(Exception())
+    queries = { }
+    fail_time = time.perf_counter() - start
+
+    for f in futures:
+        f.exception()
+
+    return add_time, answer_time, fail_time
+
+
+def bench_table(futures):
+    table = QueryTable()
+
+    start = time.perf_counter()
+    asks = [table.add(EchoCommand, f) for f in futures]
+    add_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ask in asks:
+        table.pop(ask)
+    answer_time = time.perf_counter() - start
+
+    for f in futures:
+        table.add(EchoCommand, f)
+    start = time.perf_counter()
+    table.oldest(10)
+    oldest_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table.fail_all(Exception)
+    fail_time = time.perf_counter() - start
+
+    # (Retrieve the exceptions, so that they are not logged.)
+    for f in futures:
+        f.exception()
+
+    return add_time, answer_time, oldest_time, fail_time
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    futures = [asyncio.Future(loop=loop) for i in range(COUNT)]
+
+    add_time, answer_time, fail_time = bench_dict(futures)
+    results = [{
+        'case': 'dict',
+        'add_per_sec': COUNT / add_time,
+        'answer_per_sec': COUNT / answer_time,
+        'fail_all_sec': fail_time,
+    }]
+
+    futures = [asyncio.Future(loop=loop) for i in range(COUNT)]
+    add_time, answer_time, oldest_time, fail_time = bench_table(futures)
+    results.append({
+        'case': 'QueryTable',
+        'add_per_sec': COUNT / add_time,
+        'answer_per_sec': COUNT / answer_time,
+        'oldest_us': oldest_time * 1e6,
+        'fail_all_sec': fail_time,
+    })
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('queries', run())
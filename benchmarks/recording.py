@@ -0,0 +1,97 @@
+"""
+Overhead of the `TrafficRecorder`: echo throughput over loopback TCP with
+and without recording on the server, and the throughput of replaying the
+capture with `replay_capture`.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from asyncio_amp import AMPProtocol, TrafficRecorder, read_capture, replay_capture
+
+from benchmarks.echo import EchoCommand, EchoProtocol
+
+SIZES = (10, 1000)
+CONCURRENCY = 100
+CALLS = 5000
+CONNECTIONS = (1, 4)
+
+
+@asyncio.coroutine
+def bench(size, recorder):
+    loop = asyncio.get_event_loop()
+
+    class ServerProtocol(EchoProtocol):
+        pass
+    ServerProtocol.recorder = recorder
+
+    server = yield from loop.create_server(ServerProtocol, 'localhost', 8000)
+    transport, protocol = yield from loop.create_connection(AMPProtocol, 'localhost', 8000)
+    payload = b'x' * size
+
+    @asyncio.coroutine
+    def caller(count):
+        for i in range(count):
+            yield from protocol.call_remote(EchoCommand, data=payload)
+
+    start = time.perf_counter()
+    yield from asyncio.gather(*[caller(CALLS // CONCURRENCY) for i in range(CONCURRENCY)])
+    duration = time.perf_counter() - start
+
+    transport.close()
+    server.close()
+    yield from server.wait_closed()
+
+    return {
+        'case': '%s size=%i' % ('recording' if recorder else 'plain', size),
+        'calls_per_sec': CALLS / duration,
+    }
+
+
+@asyncio.coroutine
+def bench_replay(path, size, connections):
+    loop = asyncio.get_event_loop()
+    server = yield from loop.create_server(EchoProtocol, 'localhost', 8000)
+
+    report = yield from replay_capture('localhost', 8000, read_capture(path), connections=connections)
+
+    server.close()
+    yield from server.wait_closed()
+
+    stats = report['commands']['EchoCommand']
+    return {
+        'case': 'replay size=%i connections=%i' % (size, connections),
+        'calls_per_sec': stats['calls_per_sec'],
+        'p50_ms': stats['p50'] * 1000,
+        'p99_ms': stats['p99'] * 1000,
+    }
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    directory = tempfile.mkdtemp()
+    results = []
+
+    try:
+        for size in SIZES:
+            path = os.path.join(directory, 'capture-%i.amp' % size)
+            results.append(loop.run_until_complete(bench(size, None)))
+
+            recorder = TrafficRecorder(path)
+            results.append(loop.run_until_complete(bench(size, recorder)))
+            recorder.close()
+            results[-1]['capture_bytes'] = os.path.getsize(path)
+
+            for connections in CONNECTIONS:
+                results.append(loop.run_until_complete(bench_replay(path, size, connections)))
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('recording', run())
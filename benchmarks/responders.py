@@ -0,0 +1,72 @@
+"""
+Benchmark for dispatching incoming commands to a responder that is a plain
+function (called inline) versus a coroutine (which gets its own Task).
+
+The packets are fed directly into `data_received`, so this measures only the
+dispatching, decoding and encoding; not the network.
+"""
+import asyncio
+import time
+
+from asyncio_amp import AMPProtocol, Command, Integer
+
+COUNT = 100000
+
+
+class LookupCommand(Command):
+    arguments = [('key', Integer())]
+    response = [('value', Integer())]
+
+
+class SyncProtocol(AMPProtocol):
+    @LookupCommand.responder
+    def lookup(self, key):
+        return { 'value': key * 2 }
+
+
+class CoroutineProtocol(AMPProtocol):
+    @LookupCommand.responder
+    def lookup(self, key):
+        return { 'value': key * 2 }
+        yield
+
+
+class CountingTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+
+@asyncio.coroutine
+def bench(protocol_class, data):
+    protocol = protocol_class()
+    transport = CountingTransport()
+    protocol.connection_made(transport)
+
+    start = time.perf_counter()
+    protocol.data_received(data)
+
+    # Wait until every reply has been written.
+    while transport.writes < COUNT:
+        yield from asyncio.sleep(0)
+
+    return COUNT / (time.perf_counter() - start)
+
+
+def run():
+    data = b''.join(AMPProtocol._encode_packet({
+        '_command': b'LookupCommand', '_ask': str(i).encode('ascii'), 'key': str(i).encode('ascii') })
+        for i in range(COUNT))
+
+    loop = asyncio.get_event_loop()
+    return [{ 'case': protocol_class.__name__,
+              'commands_per_sec': loop.run_until_complete(bench(protocol_class, data)) }
+            for protocol_class in (SyncProtocol, CoroutineProtocol)]
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('responders', run())
@@ -0,0 +1,88 @@
+"""
+Benchmark for sending large `SharedBytes` values over a Unix socket: through
+the socket, versus in shared memory. Uploads values from 64KB to 64MB, one
+after the other, and reads every byte on the receiving side. Measures
+MB/sec.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from asyncio_amp import AMPProtocol, Command, Integer, SharedBytes
+
+SIZES = (0x10000, 0x40000, 0x100000, 0x1000000, 0x4000000)
+
+# Bytes to send per case.
+TOTAL = 0x10000000
+
+
+class UploadCommand(Command):
+    arguments = [('data', SharedBytes())]
+    response = [('checksum', Integer())]
+
+
+class ServerProtocol(AMPProtocol):
+    @UploadCommand.responder
+    def upload(self, data):
+        # Touch every page, like a real receiver would.
+        return { 'checksum': sum(memoryview(data)[::4096]) }
+
+
+class SharedMemoryServerProtocol(ServerProtocol):
+    shared_memory = True
+
+
+class SharedMemoryClientProtocol(AMPProtocol):
+    # (Use shared memory for every size, to find the break-even point.)
+    shared_memory = True
+    shared_memory_threshold = 0
+
+
+@asyncio.coroutine
+def bench(server_class, client_class, size, directory):
+    loop = asyncio.get_event_loop()
+    path = os.path.join(directory, 'amp.sock')
+    server = yield from loop.create_unix_server(server_class, path)
+    transport, protocol = yield from loop.create_unix_connection(client_class, path)
+    if protocol.shared_memory_negotiated is not None:
+        yield from protocol.shared_memory_negotiated
+
+    payload = os.urandom(size)
+    count = max(4, TOTAL // size)
+
+    start = time.perf_counter()
+    for i in range(count):
+        yield from protocol.call_remote(UploadCommand, data=payload)
+    duration = time.perf_counter() - start
+
+    transport.close()
+    server.close()
+    yield from server.wait_closed()
+    os.unlink(path)
+    return count * size / duration / 0x100000
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    directory = tempfile.mkdtemp()
+    results = []
+
+    try:
+        for size in SIZES:
+            for name, server_class, client_class in [
+                    ('socket', ServerProtocol, AMPProtocol),
+                    ('shared_memory', SharedMemoryServerProtocol, SharedMemoryClientProtocol)]:
+                results.append({
+                    'case': '%s %iKB' % (name, size // 1024),
+                    'mb_per_sec': loop.run_until_complete(bench(server_class, client_class, size, directory)),
+                })
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+if __name__ == '__main__':
+    from benchmarks import print_results
+    print_results('sharedmemory', run())
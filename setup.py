@@ -1,8 +1,34 @@
 #!/usr/bin/env python
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+
+
+class optional_build_ext(build_ext):
+    """
+    The C speedups are optional. If they fail to compile, we fall back to the
+    pure Python implementation.
+    """
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError as e:
+            self._warn(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError) as e:
+            self._warn(e)
+
+    def _warn(self, e):
+        print('WARNING: Could not compile the C speedups (%s). '
+              'Using the pure Python implementation.' % e)
+
 
 setup(
         name='asyncio_amp',
@@ -14,5 +40,9 @@ setup(
         description='PEP 3156 implementation of the AMP protocol.',
         long_description=open("README.rst").read(),
         packages=['asyncio_amp'],
+        ext_modules=[
+            Extension('asyncio_amp._speedups', ['asyncio_amp/_speedups.c']),
+        ],
+        cmdclass={ 'build_ext': optional_build_ext },
         install_requires = [ 'asyncio' ],
 )
@@ -2,16 +2,57 @@
 
 import unittest
 import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from asyncio_amp import codec
+from asyncio_amp.compression import decompress_packet
+from asyncio_amp.queries import QueryTable
+from asyncio_amp import sharedmemory
+from asyncio_amp import recording
 from asyncio_amp import (
     Integer,
     Bytes,
     Float,
     Boolean,
     String,
+    Int32,
+    Int64,
+    Double,
+    ListOf,
+    AmpList,
+    PackedArray,
+    BigBytes,
+    BigString,
+    SharedBytes,
+    Stream,
     AMPProtocol,
+    BoxParser,
+    LegacyBoxParser,
+    ZeroCopyBoxParser,
 
     Command,
+    ConnectionPool,
+    LazyArguments,
+    ReconnectingClient,
+    ResponseCache,
+    COMPRESSORS,
+    Metrics,
+    MultiProcessServer,
+    ResponderSlots,
+    TrafficRecorder,
+    read_capture,
+    replay_capture,
+
+    ClientClosedError,
+    ConnectionLostError,
+    DecompressionError,
+    PoolClosedError,
 
     RemoteAmpError,
     TooLongError,
@@ -49,11 +90,168 @@ class ArgumentsTest(unittest.TestCase):
                 (String(), 'my-string', b'my-string'),
                 (Boolean(), True, b'True'),
                 (Boolean(), False, b'False'),
+                (Int32(), -2, b'\xff\xff\xff\xfe'),
+                (Int64(), 1, b'\x00\x00\x00\x00\x00\x00\x00\x01'),
+                (Double(), 1.5, b'?\xf8\x00\x00\x00\x00\x00\x00'),
+                (ListOf(Integer()), [1, 22], b'\x00\x011\x00\x0222'),
+                (ListOf(String()), [], b''),
+                (AmpList([('a', Integer())]), [{ 'a': 1 }, { 'a': 2 }],
+                        b'\x00\x01a\x00\x011\x00\x00\x00\x01a\x00\x012\x00\x00'),
         ]
         for type, value, encoded in tuples:
             self.assertEqual(type.encode(value), encoded)
             self.assertEqual(type.decode(encoded), value)
 
+    def test_packed_array(self):
+        import array
+
+        for typecode, values in [('i', [1, -2, 3]), ('q', [2 ** 40, -1]), ('d', [1.5, -.25])]:
+            argument = PackedArray(typecode)
+            for obj in (values, array.array(typecode, values)):
+                encoded = bytes(argument.encode(obj))
+                self.assertEqual(len(encoded), len(values) * array.array(typecode).itemsize)
+                self.assertEqual(list(argument.decode(encoded)), values)
+
+        self.assertEqual(bytes(PackedArray('i').encode([1])), b'\x01\x00\x00\x00')
+
+        with self.assertRaises(ValueError):
+            PackedArray('b')
+
+        # Through a compiled command.
+        class ArrayCommand(Command):
+            arguments = [('values', PackedArray('q'))]
+
+        data = ArrayCommand._encode_arguments({ 'values': range(1000) }, b'\x00\x00')
+        packet = BoxParser().feed(data)[0]
+        self.assertEqual(ArrayCommand._decode_arguments(packet)['values'].tolist(), list(range(1000)))
+
+
+class ParserTest(unittest.TestCase):
+    packets = [
+            { '_command': b'EchoCommand', '_ask': b'1', 'text': b'my-text' },
+            { 'empty': b'', 'other': b'value' },
+            { },
+            { 'big': b'x' * 0xffff },
+    ]
+
+    def _encode(self):
+        return b''.join(AMPProtocol._encode_packet(p) for p in self.packets)
+
+    def test_parse_at_once(self):
+        for parser_class in (BoxParser, LegacyBoxParser, ZeroCopyBoxParser):
+            parser = parser_class()
+            self.assertEqual(parser.feed(self._encode()), self.packets)
+
+    def test_parse_byte_by_byte(self):
+        data = self._encode()
+
+        for parser_class in (BoxParser, LegacyBoxParser, ZeroCopyBoxParser):
+            parser = parser_class()
+            result = []
+            for i in range(len(data)):
+                result.extend(parser.feed(data[i:i+1]))
+            self.assertEqual(result, self.packets)
+
+    def test_parse_chunks(self):
+        data = self._encode()
+        for parser_class in (BoxParser, ZeroCopyBoxParser):
+            parser = parser_class()
+            result = []
+            for i in range(0, len(data), 1000):
+                result.extend(parser.feed(data[i:i+1000]))
+            self.assertEqual(result, self.packets)
+
+    def test_zero_copy(self):
+        # Large values are slices of the received data, small ones are bytes.
+        packets = ZeroCopyBoxParser().feed(self._encode())
+        self.assertIsInstance(packets[0]['text'], bytes)
+        self.assertIsInstance(packets[3]['big'], memoryview)
+        self.assertEqual(packets[3]['big'], b'x' * 0xffff)
+
+        # Values that are split over two reads are copied.
+        data = self._encode()
+        parser = ZeroCopyBoxParser()
+        packets = parser.feed(data[:-10]) + parser.feed(data[-10:])
+        self.assertEqual(packets, self.packets)
+        self.assertIsInstance(packets[3]['big'], bytes)
+        self.assertEqual(len(parser._buffer), 0)
+
+
+class CodecConformanceTest(unittest.TestCase):
+    """
+    Check that the C speedups give exactly the same results as the pure
+    Python implementation.
+    """
+    packets = ParserTest.packets + [
+            { 'bytearray': bytearray(b'abc'), 'memoryview': memoryview(b'def') },
+            { 'k' * 0xff: b'' },
+    ]
+
+    def _implementations(self):
+        yield codec._py_encode_box, codec._py_scan_boxes
+        if codec.has_speedups:
+            yield codec.encode_box, codec.scan_boxes
+
+    def test_encode(self):
+        for encode_box, scan_boxes in self._implementations():
+            for packet in self.packets:
+                self.assertEqual(encode_box(packet), AMPProtocol._encode_packet(packet))
+                self.assertEqual(encode_box(packet), codec._py_encode_box(packet))
+
+    def test_encode_errors(self):
+        for encode_box, scan_boxes in self._implementations():
+            with self.assertRaises(TooLongError):
+                encode_box({ 'k' * 0x100: b'' })
+            with self.assertRaises(TooLongError):
+                encode_box({ 'k': b'x' * 0x10000 })
+            with self.assertRaises(UnicodeEncodeError):
+                encode_box({ '\xe9': b'' })
+            with self.assertRaises(TypeError):
+                encode_box({ 'k': 'not bytes' })
+
+    def test_scan(self):
+        data = b''.join(codec._py_encode_box(p) for p in self.packets)
+        expected = [{ k: bytes(v) for k, v in p.items() } for p in self.packets]
+
+        for encode_box, scan_boxes in self._implementations():
+            self.assertEqual(scan_boxes(data, 0, { }, None), (expected, len(data), { }, None))
+
+            # Scanning a partial stream returns the partial box.
+            self.assertEqual(scan_boxes(data[:30], 0, { }, None),
+                             ([], 29, { '_command': b'EchoCommand' }, '_ask'))
+            self.assertEqual(scan_boxes(bytearray(data), 29, { '_command': b'EchoCommand' }, '_ask'),
+                             (expected, len(data), { }, None))
+
+            # With `min_view_size`, large values are memoryviews.
+            packets = scan_boxes(data, 0, { }, None, 1000)[0]
+            self.assertEqual(packets, expected)
+            self.assertEqual([k for p in packets for k, v in p.items() if isinstance(v, memoryview)], ['big'])
+
+    def test_scan_errors(self):
+        for encode_box, scan_boxes in self._implementations():
+            with self.assertRaises(UnicodeDecodeError):
+                scan_boxes(b'\x00\x01\xe9', 0, { }, None)
+            for pos in (-1, -0x10000, 4, 0x10000):
+                with self.assertRaises(ValueError):
+                    scan_boxes(b'\x00\x01a', pos, { }, None)
+
+
+class CompiledCommandTest(unittest.TestCase):
+    def test_encode_arguments(self):
+        data = EchoCommand._encode_arguments({ 'text': 'my-text', 'times': 2 },
+                                             EchoCommand._command_field + b'\x00\x00')
+        self.assertEqual(data, AMPProtocol._encode_packet({
+                'text': b'my-text', 'times': b'2', '_command': b'EchoCommand' }))
+
+    def test_decode(self):
+        packet = { 'text': b'my-text', 'times': b'2' }
+        self.assertEqual(EchoCommand._decode_arguments(packet), { 'text': 'my-text', 'times': 2 })
+        self.assertEqual(EchoCommand._decode_response(packet), { 'text': 'my-text' })
+
+    def test_too_long(self):
+        with self.assertRaises(TooLongError):
+            EchoCommand._encode_response({ 'text': 'x' * 0x10000 }, b'\x00\x00')
+
 
 class RemoteCallTest(unittest.TestCase):
     def setUp(self):
@@ -114,6 +312,47 @@ class RemoteCallTest(unittest.TestCase):
 
         self.loop.run_until_complete(run())
 
+    def test_sync_responder_detection(self):
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text * times }
+
+        class CoroutineServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                yield from asyncio.sleep(.1)
+                return { 'text': text * times }
+
+        self.assertIn('EchoCommand', ServerProtocol._sync_responders)
+        self.assertNotIn('EchoCommand', CoroutineServerProtocol._sync_responders)
+
+    def test_async_def_responder(self):
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            async def echo(self, text, times):
+                await asyncio.sleep(.01)
+                return { 'text': text * times }
+
+        self.assertNotIn('EchoCommand', ServerProtocol._sync_responders)
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+            try:
+                result = yield from protocol.call_remote(EchoCommand, text='hi', times=1)
+                self.assertEqual(result['text'], 'hi')
+
+                results = yield from protocol.call_remote_many(EchoCommand, [
+                        { 'text': 'a', 'times': 1 }, { 'text': 'b', 'times': 2 } ])
+                self.assertEqual([r['text'] for r in results], ['a', 'bb'])
+            finally:
+                transport.close()
+                server.close()
+                yield from asyncio.sleep(.01)
+
+        self.loop.run_until_complete(run())
+
     def test_coroutine_responder(self):
         class ServerProtocol(AMPProtocol):
             @EchoCommand.responder
@@ -201,5 +440,1658 @@ class RemoteCallTest(unittest.TestCase):
 
         self.loop.run_until_complete(run())
 
+    def test_invalid_arguments(self):
+        """
+        A call that can't be decoded gets an error, and doesn't affect the
+        other calls in the same read.
+        """
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                if not times:
+                    raise MyException()
+                return { 'text': text * times }
+
+        class ClientProtocol(AMPProtocol):
+            coalesce_writes = True
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol =  yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+
+            try:
+                # Send a call without 'times', and valid calls in the same
+                # write.
+                invalid = asyncio.Future()
+                ask = protocol._queries.add(EchoCommand, invalid)
+                protocol._send_packet({ '_command': b'EchoCommand', '_ask': ask, 'text': b'a' })
+
+                results = yield from asyncio.gather(
+                        protocol.call_remote(EchoCommand, text='b', times=2),
+                        protocol.call_remote(EchoCommand, text='c', times=0),
+                        return_exceptions=True)
+
+                with self.assertRaises(RemoteAmpError):
+                    yield from invalid
+                self.assertEqual(results[0], { 'text': 'bb' })
+
+                # An exception without arguments.
+                self.assertIsInstance(results[1], MyException)
+                self.assertEqual(results[1].args, ('', ))
+            finally:
+                transport.close()
+                server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_coalesce_writes(self):
+        class ServerProtocol(AMPProtocol):
+            coalesce_writes = True
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text * times }
+
+        class ClientProtocol(AMPProtocol):
+            coalesce_writes = True
+            coalesce_max_packets = 50
+
+        def run():
+            # Create server and client
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol =  yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+
+            # Fire many calls in the same loop iteration.
+            calls = [protocol.call_remote(EchoCommand, text=str(i), times=2) for i in range(120)]
+            results = yield from asyncio.gather(*calls)
+            self.assertEqual([r['text'] for r in results], [str(i) * 2 for i in range(120)])
+
+            # The calls were written in batches of at most 50 packets.
+            self.assertEqual(sum(protocol.packets_per_flush.values()), 3)
+            self.assertEqual(max(protocol.packets_per_flush), 50)
+
+            # Shut down server.
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_slow_reader(self):
+        """ The write buffer should stay bounded when the peer doesn't read. """
+        servers = []
+
+        class ServerProtocol(AMPProtocol):
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                # Small socket buffers on both ends, so that the kernel
+                # doesn't absorb all the calls.
+                transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0x10000)
+                # (Python 3.6 starts reading after `connection_made`.)
+                asyncio.get_event_loop().call_soon(transport.pause_reading)
+                servers.append(self)
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': str(len(text)) }
+
+        class ClientProtocol(AMPProtocol):
+            write_buffer_high = 0x10000
+            write_buffer_low = 0x4000
+            max_queries = 100
+
+            def connection_made(self, transport):
+                transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 0x1000)
+                super().connection_made(transport)
+
+        def run():
+            # Create server and client
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol =  yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+
+            try:
+                # Send 30MB of calls to a server that doesn't read.
+                calls = [asyncio.Task(protocol.call_remote(EchoCommand, text='x' * 0xf000, times=1))
+                         for i in range(500)]
+                yield from asyncio.sleep(.5)
+
+                # Only part of the calls has been written, and the rest waits.
+                self.assertLessEqual(transport.get_write_buffer_size(), 0x10000 + 0x10000)
+                self.assertLessEqual(len(protocol._queries), 100)
+                self.assertFalse(any(call.done() for call in calls))
+
+                # Let the server read again.
+                servers[0].transport.resume_reading()
+                results = yield from asyncio.gather(*calls)
+                self.assertEqual(results, [{ 'text': str(0xf000) }] * 500)
+            finally:
+                transport.close()
+                server.close()
+                yield from asyncio.sleep(.01)
+
+        self.loop.run_until_complete(run())
+
+
+class ResponderLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_limits(self):
+        running = [0]
+        max_running = [0]
+        servers = []
+
+        class ServerProtocol(AMPProtocol):
+            max_concurrent_responders = 3
+            max_pending_commands = 10
+            responder_slots = ResponderSlots(4)
+
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                servers.append(self)
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+                yield from asyncio.sleep(.01)
+                running[0] -= 1
+                return { 'text': text * times }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            clients = []
+            for i in range(2):
+                transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+                clients.append(protocol)
+
+            calls = [asyncio.Task(p.call_remote(EchoCommand, text=str(i), times=1))
+                     for i in range(50) for p in clients]
+            yield from asyncio.sleep(.005)
+
+            # At most 3 per connection, and 4 for the whole server.
+            self.assertEqual(sorted(s._running_responders for s in servers), [1, 3])
+            self.assertTrue(all('commands' in s._read_pauses for s in servers))
+
+            results = yield from asyncio.gather(*calls)
+            self.assertEqual(len(results), 100)
+            self.assertEqual(max_running[0], 4)
+            self.assertEqual(servers[0].responder_slots.in_use, 0)
+            self.assertFalse(servers[0]._read_pauses)
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_lost_while_paused(self):
+        # A responder that finishes after its peer disconnected, while
+        # writing was paused, releases its slot.
+        servers = []
+        release = asyncio.Event()
+
+        class ServerProtocol(AMPProtocol):
+            responder_slots = ResponderSlots(1)
+
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                servers.append(self)
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                if text == 'wait':
+                    yield from release.wait()
+                return { 'text': text * times }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+            try:
+                call = asyncio.Task(protocol.call_remote(EchoCommand, text='wait', times=1))
+                yield from asyncio.sleep(.05)
+
+                servers[0].pause_writing()
+                transport.close()
+                yield from asyncio.sleep(.05)
+
+                release.set()
+                yield from asyncio.sleep(.01)
+                self.assertEqual(ServerProtocol.responder_slots.in_use, 0)
+
+                # Calls on the lost connection fail right away.
+                with self.assertRaises(ConnectionLostError):
+                    yield from servers[0].call_remote(EchoCommand, text='a', times=1)
+
+                # Another client gets the slot.
+                transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+                result = yield from protocol.call_remote(EchoCommand, _timeout=1, text='b', times=1)
+                self.assertEqual(result, { 'text': 'b' })
+
+                with self.assertRaises(ConnectionLostError):
+                    yield from call
+            finally:
+                transport.close()
+                server.close()
+                yield from asyncio.sleep(.01)
+
+        self.loop.run_until_complete(run())
+
+    def test_priority(self):
+        class UrgentCommand(EchoCommand):
+            priority = 10
+
+        order = []
+
+        class ServerProtocol(AMPProtocol):
+            max_concurrent_responders = 1
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                order.append(text)
+                yield from asyncio.sleep(.01)
+                return { 'text': text }
+
+            @UrgentCommand.responder
+            def urgent(self, text, times):
+                order.append(text)
+                return { 'text': text }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            calls = [asyncio.Task(protocol.call_remote(EchoCommand, text='slow-%i' % i, times=1))
+                     for i in range(3)]
+            calls.append(asyncio.Task(protocol.call_remote(UrgentCommand, text='urgent', times=1)))
+            yield from asyncio.gather(*calls)
+
+            self.assertEqual(order, ['slow-0', 'urgent', 'slow-1', 'slow-2'])
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_pool(self):
+        servers = []
+
+        class ServerProtocol(AMPProtocol):
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                self.calls = 0
+                servers.append(self)
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                self.calls += 1
+                yield from asyncio.sleep(.01)
+                if times < 0:
+                    raise MyException('Negative')
+                return { 'text': text * times }
+
+        def run():
+            server1 = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            server2 = yield from self.loop.create_server(ServerProtocol, 'localhost', 8001)
+            pool = ConnectionPool([('localhost', 8000), ('localhost', 8001)], size=2)
+
+            # The calls are spread over all connections.
+            calls = [pool.call_remote(EchoCommand, text=str(i), times=2) for i in range(40)]
+            results = yield from asyncio.gather(*calls)
+            self.assertEqual([r['text'] for r in results], [str(i) * 2 for i in range(40)])
+            self.assertEqual(len(servers), 4)
+            self.assertEqual(sum(s.calls for s in servers), 40)
+
+            # Exceptions are the same as for call_remote.
+            with self.assertRaises(MyException):
+                yield from pool.call_remote(EchoCommand, text='text', times=-1)
+
+            # Connections are made again, after they are lost.
+            for s in servers:
+                s.transport.close()
+            yield from asyncio.sleep(.01)
+            self.assertEqual(pool.protocols, [])
+
+            result = yield from pool.call_remote(EchoCommand, text='text', times=1)
+            self.assertEqual(result['text'], 'text')
+            self.assertEqual(len(pool.protocols), 4)
+
+            # Drain.
+            call = asyncio.Task(pool.call_remote(EchoCommand, text='text', times=1))
+            yield from asyncio.sleep(0)
+            yield from pool.drain()
+            self.assertEqual((yield from call)['text'], 'text')
+
+            with self.assertRaises(PoolClosedError):
+                yield from pool.call_remote(EchoCommand, text='text', times=1)
+
+            server1.close()
+            server2.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_backoff(self):
+        def run():
+            pool = ConnectionPool([('localhost', 8000)], min_backoff=10)
+
+            with self.assertRaises(ConnectionError) as first:
+                yield from pool.call_remote(EchoCommand, text='text', times=1)
+            self.assertIsInstance(first.exception.__cause__, OSError)
+
+            # While backing off, we don't try to connect again.
+            server = yield from self.loop.create_server(AMPProtocol, 'localhost', 8000)
+            with self.assertRaises(ConnectionError) as second:
+                yield from pool.call_remote(EchoCommand, text='text', times=1)
+
+            # (Every call gets its own exception.)
+            self.assertIsNot(second.exception, first.exception)
+            self.assertIs(second.exception.__cause__, first.exception.__cause__)
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_no_endpoints(self):
+        def run():
+            pool = ConnectionPool([])
+
+            with self.assertRaises(ConnectionError):
+                yield from pool.call_remote(EchoCommand, text='text', times=1)
+
+        self.loop.run_until_complete(run())
+
+
+class IdempotentEchoCommand(EchoCommand):
+    idempotent = True
+
+
+class ReconnectingClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_replay(self):
+        servers = []
+
+        class ServerProtocol(AMPProtocol):
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                servers.append(self)
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                yield from asyncio.sleep(.05)
+                return { 'text': text * times }
+
+            @IdempotentEchoCommand.responder
+            def idempotent_echo(self, text, times):
+                yield from asyncio.sleep(.05)
+                return { 'text': text * times }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            client = ReconnectingClient('localhost', 8000, min_backoff=.01)
+
+            result = yield from client.call_remote(EchoCommand, text='a', times=2)
+            self.assertEqual(result['text'], 'aa')
+
+            # Lose the connection while both calls wait for an answer.
+            call = asyncio.Task(client.call_remote(EchoCommand, text='b', times=2))
+            idempotent_call = asyncio.Task(client.call_remote(IdempotentEchoCommand, text='c', times=2))
+            yield from asyncio.sleep(.01)
+            servers[0].transport.close()
+
+            # The other call fails right away, the idempotent call is sent again.
+            with self.assertRaises(ConnectionLostError):
+                yield from call
+            self.assertFalse(idempotent_call.done())
+
+            result = yield from idempotent_call
+            self.assertEqual(result['text'], 'cc')
+            self.assertEqual(len(servers), 2)
+            self.assertEqual(client.reconnects, 1)
+            self.assertEqual(client.replays, 1)
+
+            client.close()
+            with self.assertRaises(ClientClosedError):
+                yield from client.call_remote(IdempotentEchoCommand, text='d', times=1)
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_backoff(self):
+        def run():
+            client = ReconnectingClient('localhost', 8000, min_backoff=.01)
+
+            # Other calls fail when connecting fails.
+            with self.assertRaises(OSError):
+                yield from client.call_remote(EchoCommand, text='a', times=1)
+
+            # Idempotent calls keep trying, until their timeout.
+            with self.assertRaises(asyncio.TimeoutError):
+                yield from client.call_remote(IdempotentEchoCommand, text='a', times=1, _timeout=.1)
+
+            call = asyncio.Task(client.call_remote(IdempotentEchoCommand, text='a', times=1, _timeout=2))
+            yield from asyncio.sleep(.05)
+            server = yield from self.loop.create_server(AMPProtocol, 'localhost', 8000)
+
+            # (The server doesn't handle the command.)
+            with self.assertRaises(UnhandledCommandError):
+                yield from call
+
+            client.close()
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+
+class CoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_coalescing(self):
+        calls = []
+
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                calls.append(text)
+                yield from asyncio.sleep(.01)
+                return { 'text': text * times }
+
+            @IdempotentEchoCommand.responder
+            def idempotent_echo(self, text, times):
+                calls.append(text)
+                yield from asyncio.sleep(.01)
+                if times < 0:
+                    raise MyException('Negative')
+                return { 'text': text * times }
+
+        class ClientProtocol(AMPProtocol):
+            coalesce_calls = True
+            metrics = Metrics()
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+
+            try:
+                # Identical calls share one call.
+                results = yield from asyncio.gather(*(
+                        [protocol.call_remote(IdempotentEchoCommand, text='a', times=2) for i in range(10)] +
+                        [protocol.call_remote(IdempotentEchoCommand, text='b', times=2) for i in range(10)]))
+                self.assertEqual([r['text'] for r in results], ['aa'] * 10 + ['bb'] * 10)
+                self.assertEqual(sorted(calls), ['a', 'b'])
+                self.assertEqual(ClientProtocol.metrics.coalesced_calls, 18)
+
+                # Only calls of idempotent commands.
+                del calls[:]
+                yield from asyncio.gather(*[protocol.call_remote(EchoCommand, text='c', times=2) for i in range(3)])
+                self.assertEqual(calls, ['c'] * 3)
+
+                # Errors are raised for every caller.
+                del calls[:]
+                results = yield from asyncio.gather(*[protocol.call_remote(IdempotentEchoCommand, text='d', times=-1)
+                                                      for i in range(3)], return_exceptions=True)
+                self.assertTrue(all(isinstance(r, MyException) for r in results))
+                self.assertEqual(calls, ['d'])
+
+                # Cancelling one caller doesn't cancel the others.
+                first = asyncio.Task(protocol.call_remote(IdempotentEchoCommand, text='e', times=2))
+                second = asyncio.Task(protocol.call_remote(IdempotentEchoCommand, text='e', times=2))
+                yield from asyncio.sleep(0)
+                first.cancel()
+                self.assertEqual((yield from second)['text'], 'ee')
+                self.assertEqual(protocol._coalesced_calls, { })
+            finally:
+                transport.close()
+                server.close()
+
+        self.loop.run_until_complete(run())
+
+
+class BlobCommand(Command):
+    arguments = [
+            ('name', String()),
+            ('data', BigBytes()),
+    ]
+    response = [
+            ('text', BigString()),
+    ]
+
+
+class UploadCommand(Command):
+    arguments = [
+            ('data', Stream()),
+    ]
+    response = [
+            ('size', Integer()),
+    ]
+
+
+class DownloadCommand(Command):
+    arguments = [
+            ('size', Integer()),
+    ]
+    response = [
+            ('data', Stream()),
+    ]
+
+
+class LargePayloadTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_big_bytes_keys(self):
+        """ The keys are compatible with Twisted's BigString. """
+        fields = BigBytes().to_box('data', b'x' * 0x20000, None)
+        self.assertEqual([k for k, v in fields], ['data', 'data.2', 'data.3'])
+        self.assertEqual([len(v) for k, v in fields], [0xffff, 0xffff, 2])
+
+        packet = { k: bytes(v) for k, v in fields }
+        self.assertEqual(BigBytes().from_box('data', packet, None), b'x' * 0x20000)
+
+    def test_big_arguments(self):
+        class ServerProtocol(AMPProtocol):
+            @BlobCommand.responder
+            def blob(self, name, data):
+                return { 'text': name * len(data) }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            result = yield from protocol.call_remote(BlobCommand, name='\xe9', data=b'x' * 0x30000)
+            self.assertEqual(result['text'], '\xe9' * 0x30000)
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_streams(self):
+        max_buffered = [0]
+
+        class ServerProtocol(AMPProtocol):
+            stream_buffer_size = 0x20000
+
+            @UploadCommand.responder
+            def upload(self, data):
+                size = 0
+                while True:
+                    max_buffered[0] = max(max_buffered[0], data._size)
+                    chunk = yield from data.read()
+                    if not chunk:
+                        return { 'size': size }
+                    size += len(chunk)
+                    yield from asyncio.sleep(0)
+
+            @DownloadCommand.responder
+            def download(self, size):
+                return { 'data': (b'x' * 1000 for i in range(size // 1000)) }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            # Upload 20MB, from a generator.
+            result = yield from protocol.call_remote(UploadCommand, data=(b'x' * 0x10000 for i in range(320)))
+            self.assertEqual(result['size'], 320 * 0x10000)
+            # (The buffer can exceed the limit by what's read from the socket at once.)
+            self.assertLessEqual(max_buffered[0], 0x20000 + 0x40000)
+
+            # Download.
+            result = yield from protocol.call_remote(DownloadCommand, size=1000000)
+            data = yield from result['data'].read_all()
+            self.assertEqual(data, b'x' * 1000000)
+            self.assertEqual(protocol._incoming_streams, { })
+
+            # Errors in the stream.
+            def failing():
+                yield b'data'
+                raise Exception('Stream failed')
+
+            result = yield from protocol.call_remote(DownloadCommand, size=0)
+            self.assertEqual((yield from result['data'].read()), b'')
+
+            with self.assertRaises(UnknownRemoteError):
+                yield from protocol.call_remote(UploadCommand, data=failing())
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+
+    def test_unhandled_streams(self):
+        """
+        The chunks of a stream whose command doesn't reach a responder are
+        dropped, so that they don't stop the connection.
+        """
+        servers = []
+
+        class ServerProtocol(AMPProtocol):
+            stream_buffer_size = 0x10000
+
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                servers.append(self)
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text * times }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            try:
+                with self.assertRaises(UnhandledCommandError):
+                    yield from protocol.call_remote(UploadCommand, data=(b'x' * 0x10000 for i in range(10)))
+
+                result = yield from protocol.call_remote(EchoCommand, _timeout=2, text='a', times=2)
+                self.assertEqual(result['text'], 'aa')
+
+                yield from asyncio.sleep(.1)
+                self.assertEqual(servers[0]._incoming_streams, { })
+                self.assertEqual(servers[0]._read_pauses, set())
+            finally:
+                transport.close()
+                server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_unread_streams(self):
+        """
+        The streams that a responder didn't read are closed when it's done,
+        also when a plain function returns a coroutine.
+        """
+        servers = []
+
+        class ServerProtocol(AMPProtocol):
+            stream_buffer_size = 0x10000
+
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                servers.append(self)
+
+            @UploadCommand.responder
+            def upload(self, data):
+                return self.later()
+
+            @asyncio.coroutine
+            def later(self):
+                yield from asyncio.sleep(.01)
+                return { 'size': 0 }
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text * times }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            try:
+                self.assertIn('UploadCommand', ServerProtocol._sync_responders)
+                result = yield from protocol.call_remote(UploadCommand, data=(b'x' * 0x10000 for i in range(10)))
+                self.assertEqual(result['size'], 0)
+
+                result = yield from protocol.call_remote(EchoCommand, _timeout=2, text='a', times=2)
+                self.assertEqual(result['text'], 'aa')
+
+                yield from asyncio.sleep(.1)
+                self.assertEqual(servers[0]._incoming_streams, { })
+                self.assertEqual(servers[0]._read_pauses, set())
+            finally:
+                transport.close()
+                server.close()
+                yield from asyncio.sleep(.01)
+
+        self.loop.run_until_complete(run())
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_metrics(self):
+        class ServerProtocol(AMPProtocol):
+            metrics = Metrics()
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                if times < 0:
+                    raise MyException('Negative')
+                return { 'text': text * times }
+
+        class ClientProtocol(AMPProtocol):
+            metrics = Metrics()
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+
+            for i in range(10):
+                yield from protocol.call_remote(EchoCommand, text='text', times=1)
+            with self.assertRaises(MyException):
+                yield from protocol.call_remote(EchoCommand, text='text', times=-1)
+
+            client = ClientProtocol.metrics.snapshot()
+            server_metrics = ServerProtocol.metrics.snapshot()
+
+            self.assertEqual(client['packets_out'], 11)
+            self.assertEqual(client['packets_in'], 11)
+            self.assertEqual(client['bytes_out'], server_metrics['bytes_in'])
+            self.assertEqual(client['in_flight'], 0)
+
+            for stats in (client['client']['EchoCommand'], server_metrics['server']['EchoCommand']):
+                self.assertEqual(stats['calls'], 11)
+                self.assertEqual(stats['errors'], 1)
+                self.assertEqual(stats['latency']['count'], 11)
+
+            self.assertIsNotNone(ClientProtocol.metrics.client['EchoCommand'].latency.percentile(99))
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+
+class NotifyCommand(Command):
+    arguments = [
+            ('text', String()),
+    ]
+    requires_answer = False
+
+
+class FireAndForgetTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_no_answer(self):
+        received = []
+
+        class ServerProtocol(AMPProtocol):
+            @NotifyCommand.responder
+            def notify(self, text):
+                received.append(text)
+                return { }
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            for i in range(10):
+                protocol.send_remote(NotifyCommand, text=str(i))
+            result = yield from protocol.call_remote(NotifyCommand, text='10')
+            self.assertIsNone(result)
+            self.assertEqual(protocol._queries.counter, 0)
+            self.assertEqual(len(protocol._queries), 0)
+
+            # (Wait for everything to be handled.)
+            yield from protocol.call_remote(EchoCommand, text='text', times=1)
+            self.assertEqual(received, [str(i) for i in range(11)])
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+
+class TimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_timeout(self):
+        class SlowCommand(EchoCommand):
+            timeout = .05
+
+        finished = []
+
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                yield from asyncio.sleep(.2)
+                finished.append(text)
+                return { 'text': text }
+
+            @SlowCommand.responder
+            def slow(self, text, times):
+                yield from asyncio.sleep(.2)
+                finished.append(text)
+                return { 'text': text }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            # Timeout per call.
+            with self.assertRaises(asyncio.TimeoutError):
+                yield from protocol.call_remote(EchoCommand, _timeout=.05, text='call', times=1)
+            self.assertEqual(len(protocol._queries), 0)
+
+            # Default timeout of the Command.
+            with self.assertRaises(asyncio.TimeoutError):
+                yield from protocol.call_remote(SlowCommand, text='command', times=1)
+            self.assertEqual(len(protocol._queries), 0)
+
+            # The server cancelled the responders.
+            yield from asyncio.sleep(.3)
+            self.assertEqual(finished, [])
+
+            # Overriding the default.
+            result = yield from protocol.call_remote(SlowCommand, _timeout=1, text='ok', times=1)
+            self.assertEqual(result['text'], 'ok')
+            self.assertEqual(finished, ['ok'])
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_late_answer(self):
+        """ Answers to calls that timed out are ignored. """
+        protocol = AMPProtocol()
+        protocol._queries.counter = 5
+        protocol._handle_incoming_packet({ '_answer': b'3' })
+
+        with self.assertRaises(Exception):
+            protocol._handle_incoming_packet({ '_answer': b'6' })
+
+
+class LookupCommand(Command):
+    arguments = [
+            ('key', String()),
+    ]
+    response = [
+            ('value', String()),
+    ]
+    errors = { 'MyException': MyException }
+    cacheable = True
+
+
+class SlowLookupCommand(LookupCommand):
+    pass
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def _run_server(self, cache, test):
+        calls = []
+
+        class ServerProtocol(AMPProtocol):
+            response_cache = cache
+
+            @LookupCommand.responder
+            def lookup(self, key):
+                calls.append(key)
+                if key == 'error':
+                    raise MyException('Error')
+                return { 'value': key.upper() }
+
+            @SlowLookupCommand.responder
+            def slow_lookup(self, key):
+                calls.append(key)
+                yield from asyncio.sleep(.01)
+                return { 'value': key.upper() }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+            try:
+                yield from test(protocol, calls)
+            finally:
+                transport.close()
+                server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_cache(self):
+        cache = ResponseCache(max_entries=2)
+
+        def test(protocol, calls):
+            for command in (LookupCommand, SlowLookupCommand):
+                for key in ('a', 'a', 'b', 'a'):
+                    result = yield from protocol.call_remote(command, key=key)
+                    self.assertEqual(result['value'], key.upper())
+            self.assertEqual(calls, ['a', 'b', 'a', 'b'])
+            self.assertEqual(cache.snapshot(), { 'entries': 2, 'hits': 4, 'misses': 4, 'evictions': 2 })
+
+            # Errors are not stored.
+            for i in range(2):
+                with self.assertRaises(MyException):
+                    yield from protocol.call_remote(LookupCommand, key='error')
+            self.assertEqual(calls[-2:], ['error', 'error'])
+
+            # Invalidation of one call, and of a command.
+            yield from protocol.call_remote(LookupCommand, key='a')
+            yield from protocol.call_remote(LookupCommand, key='b')
+            del calls[:]
+            cache.invalidate(LookupCommand, key='a')
+            yield from protocol.call_remote(LookupCommand, key='a')
+            yield from protocol.call_remote(LookupCommand, key='b')
+            self.assertEqual(calls, ['a'])
+
+            cache.invalidate(LookupCommand)
+            self.assertEqual(len(cache), 0)
+
+            # An answer that was computed before an invalidation is not stored.
+            call = asyncio.Task(protocol.call_remote(SlowLookupCommand, key='c'))
+            yield from asyncio.sleep(.005)
+            cache.invalidate()
+            yield from call
+            self.assertEqual(len(cache), 0)
+
+        self._run_server(cache, test)
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=.05)
+
+        def test(protocol, calls):
+            yield from protocol.call_remote(LookupCommand, key='a')
+            yield from protocol.call_remote(LookupCommand, key='a')
+            yield from asyncio.sleep(.06)
+            yield from protocol.call_remote(LookupCommand, key='a')
+            self.assertEqual(calls, ['a', 'a'])
+            self.assertEqual(cache.evictions, 1)
+
+        self._run_server(cache, test)
+
+    def test_stream(self):
+        with self.assertRaises(TypeError):
+            class CacheableUploadCommand(UploadCommand):
+                cacheable = True
+
+
+class CountingString(String):
+    decoded = 0
+
+    def decode(self, data):
+        CountingString.decoded += 1
+        return super().decode(data)
+
+
+class WideCommand(Command):
+    arguments = [
+            ('name', CountingString()),
+            ('payload', Bytes()),
+            ('extra', AmpList([('a', String()), ('b', String())])),
+    ]
+    response = [
+            ('name', String()),
+            ('payload', Bytes()),
+    ]
+
+
+class LazyArgumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_lazy_responder(self):
+        received = []
+
+        class ServerProtocol(AMPProtocol):
+            parser_class = ZeroCopyBoxParser
+
+            @WideCommand.responder(lazy=True)
+            def wide(self, arguments):
+                received.append(arguments.raw('payload'))
+                received.append(sorted(arguments))
+
+                # Forward the payload as it was received.
+                return { 'name': 'forwarded', 'payload': arguments['payload'] }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            CountingString.decoded = 0
+            payload = bytes(range(256)) * 16
+            result = yield from protocol.call_remote(WideCommand, name='name', payload=payload,
+                                                     extra=[{ 'a': 'a', 'b': 'b' }] * 100)
+            self.assertEqual(result, { 'name': 'forwarded', 'payload': payload })
+
+            # Unused arguments are not decoded, and the payload is not copied.
+            self.assertEqual(CountingString.decoded, 0)
+            self.assertIsInstance(received[0], memoryview)
+            self.assertEqual(received[1], ['extra', 'name', 'payload'])
+
+            transport.close()
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_lazy_arguments(self):
+        protocol = AMPProtocol()
+        packet = { 'name': b'name', 'payload': b'data', 'extra': b'' }
+        arguments = LazyArguments(WideCommand, packet, protocol)
+
+        CountingString.decoded = 0
+        self.assertEqual(arguments['name'], 'name')
+        self.assertEqual(arguments['name'], 'name')
+        self.assertEqual(CountingString.decoded, 1)
+        self.assertEqual(len(arguments), 3)
+        self.assertEqual(dict(arguments), { 'name': 'name', 'payload': b'data', 'extra': [] })
+
+        with self.assertRaises(KeyError):
+            arguments['unknown']
+
+
+class SharedEchoCommand(Command):
+    arguments = [
+            ('data', SharedBytes()),
+    ]
+    response = [
+            ('data', SharedBytes()),
+    ]
+
+
+class SharedMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def _run(self, server_shared_memory, test):
+        received = []
+
+        class ServerProtocol(AMPProtocol):
+            shared_memory = server_shared_memory
+
+            @SharedEchoCommand.responder
+            def echo(self, data):
+                received.append(data)
+                return { 'data': data }
+
+        class ClientProtocol(AMPProtocol):
+            shared_memory = True
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+            yield from protocol.shared_memory_negotiated
+            try:
+                yield from test(protocol, received)
+            finally:
+                transport.close()
+                server.close()
+                yield from asyncio.sleep(.01)
+
+        self.loop.run_until_complete(run())
+
+    def test_shared_memory(self):
+        def test(protocol, received):
+            self.assertTrue(protocol.uses_shared_memory)
+            directory = protocol._shared_memory.directory
+
+            # Large values are mapped, small ones are sent inline.
+            data = os.urandom(0x100000)
+            result = yield from protocol.call_remote(SharedEchoCommand, data=data)
+            self.assertEqual(result['data'], data)
+            self.assertIsInstance(received[0], memoryview)
+            self.assertIsInstance(result['data'], memoryview)
+
+            result = yield from protocol.call_remote(SharedEchoCommand, data=b'small')
+            self.assertEqual(result['data'], b'small')
+            self.assertIsInstance(received[1], bytes)
+
+            # The values have been removed after reading them.
+            self.assertEqual(os.listdir(directory), ['probe'])
+
+            # The directory is removed when the connection is closed.
+            protocol.transport.close()
+            yield from asyncio.sleep(0)
+            self.assertFalse(os.path.exists(directory))
+
+        self._run(True, test)
+
+    def test_not_accepted(self):
+        def test(protocol, received):
+            self.assertFalse(protocol.uses_shared_memory)
+
+            data = os.urandom(0x100000)
+            result = yield from protocol.call_remote(SharedEchoCommand, data=data)
+            self.assertEqual(result['data'], data)
+            self.assertIsInstance(received[0], bytes)
+
+        self._run(False, test)
+
+    def test_discarded(self):
+        # Values in shared memory are removed when their packet is dropped
+        # without being decoded.
+        servers = []
+
+        class UnhandledSharedCommand(Command):
+            arguments = [
+                    ('data', SharedBytes()),
+            ]
+
+        class SlowSharedEchoCommand(SharedEchoCommand):
+            pass
+
+        class ServerProtocol(AMPProtocol):
+            shared_memory = True
+            max_concurrent_responders = 1
+
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                servers.append(self)
+
+            @SharedEchoCommand.responder
+            def echo(self, data):
+                return { 'data': data }
+
+            @SlowSharedEchoCommand.responder
+            def slow_echo(self, data):
+                yield from asyncio.sleep(.1)
+                return { 'data': os.urandom(0x100000) }
+
+        class ClientProtocol(AMPProtocol):
+            shared_memory = True
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+            try:
+                yield from protocol.shared_memory_negotiated
+                yield from servers[0].shared_memory_negotiated
+                data = os.urandom(0x100000)
+
+                # Unhandled command.
+                with self.assertRaises(UnhandledCommandError):
+                    yield from protocol.call_remote(UnhandledSharedCommand, data=data)
+                self.assertEqual(os.listdir(protocol._shared_memory.directory), ['probe'])
+
+                # Command that waits for a responder slot past its deadline.
+                slow = asyncio.Task(protocol.call_remote(SlowSharedEchoCommand, data=b''))
+                with self.assertRaises(asyncio.TimeoutError):
+                    yield from protocol.call_remote(SharedEchoCommand, _timeout=.05, data=data)
+                yield from slow
+                self.assertEqual(os.listdir(protocol._shared_memory.directory), ['probe'])
+
+                # Late answer to a call that timed out.
+                with self.assertRaises(asyncio.TimeoutError):
+                    yield from protocol.call_remote(SlowSharedEchoCommand, _timeout=.05, data=b'')
+                yield from asyncio.sleep(.2)
+                self.assertEqual(os.listdir(servers[0]._shared_memory.directory), ['probe'])
+            finally:
+                transport.close()
+                server.close()
+                yield from asyncio.sleep(.01)
+
+        self.loop.run_until_complete(run())
+
+    def test_check_directory(self):
+        segments = sharedmemory.SharedMemorySegments()
+        try:
+            self.assertTrue(sharedmemory.check_directory(segments.directory, segments.token))
+            self.assertFalse(sharedmemory.check_directory(segments.directory, 'other token'))
+            self.assertFalse(sharedmemory.check_directory('/etc', segments.token))
+            self.assertFalse(sharedmemory.check_directory(segments.directory + '/../etc', segments.token))
+
+            with self.assertRaises(ValueError):
+                sharedmemory.open_segment(segments.directory, b'../probe')
+        finally:
+            segments.close()
+
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+        fd, self.path = tempfile.mkstemp(suffix='.amp')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_record_and_replay(self):
+        recorder = TrafficRecorder(self.path)
+        calls = []
+
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                calls.append(text)
+                if text == 'error':
+                    raise MyException('Error')
+                return { 'text': text * times }
+
+        class RecordingProtocol(ServerProtocol):
+            pass
+        RecordingProtocol.recorder = recorder
+
+        def run():
+            server = yield from self.loop.create_server(RecordingProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+            try:
+                for text in ('a', 'b', 'c'):
+                    yield from protocol.call_remote(EchoCommand, _timeout=10, text=text, times=2)
+                with self.assertRaises(MyException):
+                    yield from protocol.call_remote(EchoCommand, text='error', times=1)
+            finally:
+                transport.close()
+                server.close()
+                yield from asyncio.sleep(.01)
+        self.loop.run_until_complete(run())
+        recorder.close()
+
+        # Four calls and their answers.
+        records = list(read_capture(self.path))
+        self.assertEqual(recorder.records, 8)
+        self.assertEqual([r[2] for r in records], [recording.RECEIVED, recording.SENT] * 4)
+        self.assertEqual(records[0][3]['_command'], b'EchoCommand')
+        self.assertEqual(records[0][3]['text'], b'a')
+        self.assertEqual(records[1][3]['text'], b'aa')
+        self.assertIn('_timeout', records[0][3])
+        self.assertEqual(sorted(r[0] for r in records), [r[0] for r in records])
+
+        # Replay against a server without recorder.
+        def replay():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            try:
+                return (yield from replay_capture('localhost', 8000, records, connections=2))
+            finally:
+                server.close()
+                yield from asyncio.sleep(.01)
+
+        del calls[:]
+        report = self.loop.run_until_complete(replay())
+        self.assertEqual(sorted(calls), ['a', 'b', 'c', 'error'])
+
+        stats = report['commands']['EchoCommand']
+        self.assertEqual(stats['calls'], 4)
+        self.assertEqual(stats['errors'], 1)
+        self.assertGreater(stats['calls_per_sec'], 0)
+        self.assertLessEqual(stats['p50'], stats['p99'])
+        self.assertLessEqual(stats['p99'], stats['max'])
+
+    def test_replayed_packet(self):
+        """ Reserved keys of the recorded connection are not sent again. """
+        packet = {
+            '_command': b'EchoCommand',
+            '_ask': b'1',
+            '_timeout': b'0.5',
+            '_compressed': b'zlib:text',
+            'text': COMPRESSORS['zlib'][0](b'a' * 100),
+            'times': b'1',
+        }
+        self.assertEqual(recording._replayed_packet(packet),
+                         { '_command': b'EchoCommand', '_ask': b'1', 'text': b'a' * 100, 'times': b'1' })
+        self.assertIn('_timeout', packet)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a capture')
+
+        with self.assertRaises(ValueError):
+            list(read_capture(self.path))
+
+
+class QueryTableTest(unittest.TestCase):
+    def test_ids(self):
+        table = QueryTable(max_id=3)
+        futures = [asyncio.Future() for i in range(4)]
+
+        self.assertEqual([table.add(EchoCommand, f) for f in futures[:3]], [b'1', b'2', b'3'])
+        with self.assertRaises(OverflowError):
+            table.add(EchoCommand, futures[3])
+
+        # IDs wrap around, and skip the ones in use.
+        self.assertIs(table.pop(b'2')[0], futures[1])
+        self.assertIsNone(table.pop(b'2'))
+        self.assertEqual(table.add(EchoCommand, futures[3]), b'2')
+        self.assertEqual(len(table), 3)
+        self.assertTrue(table.is_late(b'3'))
+
+        self.assertEqual([(id, command) for id, command, age in table.oldest(2)],
+                         [(1, EchoCommand), (3, EchoCommand)])
+
+        table.fail_all(lambda: MyException('Lost'))
+        self.assertEqual(len(table), 0)
+        for f in (futures[0], futures[2], futures[3]):
+            self.assertIsInstance(f.exception(), MyException)
+
+    def test_late_answer(self):
+        table = QueryTable()
+        table.add(EchoCommand, asyncio.Future())
+        self.assertTrue(table.is_late(b'1'))
+        self.assertFalse(table.is_late(b'2'))
+
+    def test_outstanding_calls(self):
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                yield from asyncio.sleep(.1 * times)
+                return { 'text': text }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            calls = [asyncio.Task(protocol.call_remote(EchoCommand, text='', times=i)) for i in range(1, 4)]
+            yield from asyncio.sleep(.15)
+
+            outstanding = protocol.outstanding_calls()
+            self.assertEqual([id for id, command, age in outstanding], [2, 3])
+            self.assertGreater(outstanding[0][2], .1)
+
+            yield from asyncio.gather(*calls)
+            self.assertEqual(protocol.outstanding_calls(), [])
+
+            server.close()
+
+        self.loop = asyncio.get_event_loop()
+        self.loop.run_until_complete(run())
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_compression(self):
+        class ServerProtocol(AMPProtocol):
+            compression = ('zlib', )
+            metrics = Metrics()
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text * times }
+
+        class ClientProtocol(AMPProtocol):
+            compression = ('lzma', 'zlib')
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+
+            yield from protocol.compression_negotiated
+            self.assertEqual(protocol.compression_algorithm, 'zlib')
+
+            # Large values are compressed, in both directions.
+            bytes_in = ServerProtocol.metrics.bytes_in
+            text = '{"key": "value"}, ' * 2000
+            result = yield from protocol.call_remote(EchoCommand, text=text, times=1)
+            self.assertEqual(result['text'], text)
+            self.assertLess(ServerProtocol.metrics.bytes_in - bytes_in, 1000)
+
+            # Small values are not.
+            data = EchoCommand._encode_arguments({ 'text': 'short', 'times': 1 }, b'', protocol)
+            self.assertNotIn(b'_compressed', data)
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_no_compression(self):
+        """ Nothing is compressed when the other side doesn't want it. """
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text * times }
+
+        class ClientProtocol(AMPProtocol):
+            compression = ('zlib', )
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(ClientProtocol, 'localhost', 8000)
+
+            yield from protocol.compression_negotiated
+            self.assertIsNone(protocol.compression_algorithm)
+
+            result = yield from protocol.call_remote(EchoCommand, text='a' * 10000, times=1)
+            self.assertEqual(result['text'], 'a' * 10000)
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_decompress_packet(self):
+        compress = COMPRESSORS['zlib'][0]
+        packet = { 'a': compress(b'x' * 100), 'b': b'y', '_compressed': b'zlib:a' }
+        decompress_packet(packet)
+        self.assertEqual(packet, { 'a': b'x' * 100, 'b': b'y' })
+
+        with self.assertRaises(DecompressionError):
+            decompress_packet({ 'a': b'x', '_compressed': b'zlib:a' })
+        with self.assertRaises(DecompressionError):
+            decompress_packet({ 'a': compress(b'x' * 0x20000), '_compressed': b'zlib:a' })
+        with self.assertRaises(DecompressionError):
+            decompress_packet({ 'a': b'x', '_compressed': b'unknown:a' })
+
+    def test_inherited_responders(self):
+        class BaseProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': text }
+
+        class SubProtocol(BaseProtocol):
+            pass
+
+        self.assertIn('EchoCommand', SubProtocol.responders)
+        self.assertIn('NegotiateCompression', SubProtocol.responders)
+
+
+class UnknownCommand(Command):
+    arguments = [
+            ('text', String()),
+    ]
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_batch(self):
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.responder
+            def echo(self, text, times):
+                if times < 0:
+                    raise MyException('Negative')
+                return { 'text': text * times }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            calls = [{ 'text': str(i), 'times': 2 } for i in range(2500)]
+            results = yield from protocol.call_remote_many(EchoCommand, calls)
+            self.assertEqual(results, [{ 'text': str(i) * 2 } for i in range(2500)])
+            self.assertEqual(protocol._queries.counter, 3)
+
+            # Errors per call.
+            calls = [{ 'text': 'a', 'times': 1 }, { 'text': 'b', 'times': -1 }]
+            results = yield from protocol.call_remote_many(EchoCommand, calls, return_exceptions=True)
+            self.assertEqual(results[0], { 'text': 'a' })
+            self.assertIsInstance(results[1], MyException)
+
+            with self.assertRaises(MyException):
+                yield from protocol.call_remote_many(EchoCommand, calls)
+
+            # No responder.
+            with self.assertRaises(UnhandledCommandError):
+                yield from protocol.call_remote_many(UnknownCommand, [{ 'text': 'a' }])
+
+            self.assertEqual((yield from protocol.call_remote_many(EchoCommand, [])), [])
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_batch_responder(self):
+        batches = []
+
+        class ServerProtocol(AMPProtocol):
+            @EchoCommand.batch_responder
+            def echo_many(self, text, times):
+                batches.append(len(text))
+                yield from asyncio.sleep(0)
+                return [{ 'text': t * n } if n >= 0 else MyException('Negative')
+                        for t, n in zip(text, times)]
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            try:
+                calls = [{ 'text': 'x', 'times': i % 3 - 1 } for i in range(30)]
+                results = yield from protocol.call_remote_many(
+                        EchoCommand, calls, batch_size=20, return_exceptions=True)
+
+                # (The batches are sent concurrently, in any order.)
+                self.assertEqual(sorted(batches), [10, 20])
+                for call, result in zip(calls, results):
+                    if call['times'] < 0:
+                        self.assertIsInstance(result, MyException)
+                    else:
+                        self.assertEqual(result, { 'text': 'x' * call['times'] })
+
+                # Single calls still need a normal responder.
+                with self.assertRaises(UnhandledCommandError):
+                    yield from protocol.call_remote(EchoCommand, text='x', times=1)
+            finally:
+                transport.close()
+                server.close()
+
+        self.loop.run_until_complete(run())
+
+
+class MultiProcessServerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Requires fork.')
+    def test_workers(self):
+        class ServerProtocol(AMPProtocol):
+            metrics = Metrics()
+
+            @EchoCommand.responder
+            def echo(self, text, times):
+                return { 'text': str(os.getpid()) }
+
+        @asyncio.coroutine
+        def call(count):
+            pids = set()
+            transports = []
+            for i in range(count):
+                transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+                result = yield from protocol.call_remote(EchoCommand, text='', times=1)
+                pids.add(int(result['text']))
+                transports.append(transport)
+
+            for transport in transports:
+                transport.close()
+            yield from asyncio.sleep(.3) # Wait for the metrics.
+            return pids
+
+        server = MultiProcessServer(ServerProtocol, 'localhost', 8000, workers=2,
+                                    drain_timeout=1, metrics_interval=.05)
+        server.start()
+        try:
+            first_pids = server.pids
+            self.assertEqual(len(first_pids), 2)
+            self.assertTrue(self.loop.run_until_complete(call(8)) <= first_pids)
+
+            # The metrics of the workers are merged.
+            self.assertEqual(server.metrics()['server']['EchoCommand']['calls'], 8)
+
+            # Calls in flight of workers that have exited are not counted.
+            snapshot = Metrics().snapshot()
+            snapshot['in_flight'] = 5
+            with open(os.path.join(server._metrics_dir, '1.json'), 'w') as f:
+                json.dump(snapshot, f)
+            self.assertEqual(server.metrics()['in_flight'], 0)
+
+            # Graceful restart.
+            server.restart()
+            self.assertFalse(server.pids & first_pids)
+
+            # (Give the old workers the time to stop accepting connections.)
+            self.loop.run_until_complete(asyncio.sleep(.2))
+            self.assertTrue(self.loop.run_until_complete(call(4)) <= server.pids)
+        finally:
+            server.stop()
+
+        self.assertEqual(server.metrics()['server']['EchoCommand']['calls'], 12)
+
+
+class ProcessCommand(Command):
+    response = [
+            ('pid', Integer()),
+    ]
+    executor = True
+
+
+class ExecutorProtocol(AMPProtocol):
+    # (Defined at module level, so that the responder can be pickled.)
+    @ProcessCommand.responder
+    def get_pid():
+        return { 'pid': os.getpid() }
+
+
+class ExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_thread_executor(self):
+        protocols = []
+
+        class ServerProtocol(AMPProtocol):
+            executor = ThreadPoolExecutor(4)
+            max_executor_jobs = 2
+
+            def connection_made(self, transport):
+                super().connection_made(transport)
+                protocols.append(self)
+
+            @EchoCommand.responder(executor=True)
+            def slow_echo(text, times):
+                time.sleep(.2)
+                return { 'text': threading.current_thread().name }
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            calls = [asyncio.Task(protocol.call_remote(EchoCommand, text='', times=1)) for i in range(3)]
+
+            # The loop of the server is not blocked, but it stops reading
+            # when two or more jobs are running.
+            yield from asyncio.sleep(.1)
+            self.assertEqual(protocols[0]._executor_jobs, 3)
+            self.assertIn('executor', protocols[0]._read_pauses)
+
+            results = yield from asyncio.gather(*calls)
+            for result in results:
+                self.assertNotEqual(result['text'], threading.current_thread().name)
+            self.assertEqual(protocols[0]._read_pauses, set())
+
+            server.close()
+
+        self.loop.run_until_complete(run())
+        ServerProtocol.executor.shutdown()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Requires fork.')
+    def test_process_executor(self):
+        executor = ProcessPoolExecutor(1)
+
+        class ServerProtocol(ExecutorProtocol):
+            pass
+        ServerProtocol.executor = executor
+
+        def run():
+            server = yield from self.loop.create_server(ServerProtocol, 'localhost', 8000)
+            transport, protocol = yield from self.loop.create_connection(AMPProtocol, 'localhost', 8000)
+
+            result = yield from protocol.call_remote(ProcessCommand)
+            self.assertNotEqual(result['pid'], os.getpid())
+
+            server.close()
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            executor.shutdown()
+
+
 if __name__ == '__main__':
     unittest.main()